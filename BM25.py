@@ -1,6 +1,11 @@
 from helperClasses import *
+from analyzer import Analyzer
 from loader import BucketIndexLoader
+from instrumentation import stage, count
 from sklearn.preprocessing import MaxAbsScaler
+import os
+import pickle
+import threading
 
 
 class BM25:
@@ -10,7 +15,8 @@ class BM25:
         self.index = index
         self.N = len(DL)
         self.DL = DL
-        self.AVGDL = sum(DL.values()) / self.N
+        lengths = DL.values()
+        self.AVGDL = (int(lengths.sum(dtype=np.int64)) if isinstance(lengths, np.ndarray) else sum(lengths)) / self.N
         self.idf = None
         self.freqs = {}
         self.folder_name = folder_name
@@ -40,11 +46,10 @@ class BM25:
         res = set()
         for token in np.unique(query):
             if token in index.df.keys():
-                pl = BucketIndexLoader.load_posting_lists_for_token(token, index, self.folder_name)
-                self.freqs[token] = {}
-                for doc_id, tf in pl:
-                    self.freqs[token][doc_id] = tf
-                    res.add(doc_id)
+                doc_ids, tfs = BucketIndexLoader.load_posting_arrays_for_token(token, index, self.folder_name)
+                doc_ids = doc_ids.tolist()
+                self.freqs[token] = dict(zip(doc_ids, tfs.tolist()))
+                res.update(doc_ids)
         return res
 
     def search(self, tokenized_query, N=100):
@@ -54,10 +59,12 @@ class BM25:
         :param N: Maximum length of the result.
         :return: Sorted list of the result, with maximum length of N.
         """
-        self.idf = self.calc_idf(tokenized_query)
-        candid_list = self.get_candidate_docs(tokenized_query, self.index)
-        res = sorted([(doc_id, self._score(tokenized_query, doc_id)) for doc_id in candid_list], key=lambda x: x[1],
-                     reverse=True)[:N]
+        with stage('score'):
+            self.idf = self.calc_idf(tokenized_query)
+            candid_list = self.get_candidate_docs(tokenized_query, self.index)
+            count('candidates', len(candid_list))
+            res = sorted([(doc_id, self._score(tokenized_query, doc_id)) for doc_id in candid_list],
+                         key=lambda x: x[1], reverse=True)[:N]
         return res
 
     def _score(self, query, doc_id):
@@ -86,6 +93,388 @@ class BM25:
         :param scores: List of (doc_id, score)
         :return: List of (doc_id, norm_score)
         """
-        vals = np.array([score for _, score in scores])
-        norm_scores = MaxAbsScaler().fit_transform(vals.reshape(-1, 1))[:, 0]
-        return [(scores[i][0], norm_scores[i]) for i in range(len(scores))]
\ No newline at end of file
+        if not scores:
+            return []
+        with stage('normalize'):
+            vals = np.array([score for _, score in scores])
+            norm_scores = MaxAbsScaler().fit_transform(vals.reshape(-1, 1))[:, 0]
+        return [(scores[i][0], norm_scores[i]) for i in range(len(scores))]
+
+
+class BM25Scorer:
+    """
+    Array based BM25 scorer, which gives the same scores as the BM25 class.
+    Scores are accumulated term by term into a numpy array over the candidate documents, instead of scoring every
+    document by itself. The scorer is built once per index and can be shared between requests.
+    Document lengths are taken from the 'DL' attribute of a DocumentStore.
+    """
+    MAX_CACHED_NORMS = 8
+    VARIANT_CHUNK_ELEMENTS = 2 ** 24
+
+    def __init__(self, index: InvertedIndex, doc_store, folder_name="text_inverted_index"):
+        self.index = index
+        self.folder_name = folder_name
+        self.doc_store = doc_store
+        lengths = doc_store.view('DL').values()
+        self.N = len(lengths)
+        self.AVGDL = int(lengths.sum(dtype=np.int64)) / self.N
+        self.doc_ids = doc_store.ids
+        # Documents without a length keep a length of 0, like DL.get(doc_id, 0) in BM25._score.
+        self.doc_lens = doc_store.attributes['DL'].astype(np.float64)
+        self._length_norms = {}
+        self._max_impacts = {}
+        self._lock = threading.Lock()
+
+    def length_norm(self, k1, b):
+        """
+        Returns k1 * (1 - b + b * dl / avgdl) for every document, computed once per (k1, b) pair.
+        :param k1: BM25 k1 parameter.
+        :param b: BM25 b parameter.
+        :return: numpy array aligned with self.doc_ids.
+        """
+        norms = self._length_norms.get((k1, b))
+        if norms is None:
+            norms = k1 * (1 - b + b * self.doc_lens / self.AVGDL)
+            with self._lock:
+                if len(self._length_norms) >= self.MAX_CACHED_NORMS:
+                    self._length_norms.pop(next(iter(self._length_norms)), None)
+                self._length_norms[(k1, b)] = norms
+        return norms
+
+    def gather_length_norm(self, doc_ids, k1, b):
+        """
+        Returns the length normalization of the given documents. Documents without a length get a length of 0,
+        like in BM25._score.
+        :param doc_ids: numpy array of doc_ids.
+        :param k1: BM25 k1 parameter.
+        :param b: BM25 b parameter.
+        :return: numpy array aligned with doc_ids.
+        """
+        norms = self.length_norm(k1, b)
+        pos, found = self.doc_store.dense_ids(doc_ids)
+        return np.where(found, norms[pos], k1 * (1 - b + b * 0 / self.AVGDL))
+
+    def calc_idf(self, tokens):
+        """
+        Calculates the idf score for given tokens, like BM25.calc_idf.
+        :param tokens: Iterable of distinct tokens.
+        :return: Dictionary - token: idf_score
+        """
+        idf = {}
+        for term, n_ti in Analyzer.resolve(tokens, self.index).items():
+            idf[term] = np.log(1 + (self.N - n_ti + 0.5) / (n_ti + 0.5))
+        return idf
+
+    def load_postings(self, tokenized_query):
+        """
+        Loads the posting arrays of the distinct query tokens which appear in the index.
+        :param tokenized_query: List of tokens.
+        :return: Dictionary - token: (doc_ids, tfs)
+        """
+        return {token: BucketIndexLoader.load_posting_arrays_for_token(token, self.index, self.folder_name)
+                for token in Analyzer.resolve(tokenized_query, self.index)}
+
+    def score(self, tokenized_query, k1, b, postings=None):
+        """
+        Scores all the candidate documents of the query.
+        Contributions are added in query order (repeated tokens are added again), which is the order of the sum in
+        BM25._score, so the scores are identical.
+        :param tokenized_query: List of tokens.
+        :param k1: BM25 k1 parameter.
+        :param b: BM25 b parameter.
+        :param postings: Optional dictionary of already loaded postings - token: (doc_ids, tfs).
+        :return: tuple of (candidate doc_ids, scores) numpy arrays.
+        """
+        if postings is None:
+            postings = self.load_postings(tokenized_query)
+        postings = {token: pl for token, pl in postings.items() if len(pl[0])}
+        if not postings:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+        idf = self.calc_idf(postings.keys())
+        candidates = sorted_unique(np.concatenate([doc_ids for doc_ids, _ in postings.values()]))
+        count('candidates', len(candidates))
+        norms = self.gather_length_norm(candidates, k1, b)
+        scores = np.zeros(len(candidates), dtype=np.float64)
+        contributions = {}
+        for term in tokenized_query:
+            if term not in postings:
+                continue
+            if term not in contributions:
+                doc_ids, tfs = postings[term]
+                pos = np.searchsorted(candidates, doc_ids)
+                freq = tfs.astype(np.float64)
+                contributions[term] = pos, idf[term] * freq * (k1 + 1) / (freq + norms[pos])
+            pos, contribution = contributions[term]
+            scores[pos] += contribution
+        return candidates, scores
+
+    def search(self, tokenized_query, k1, b, N=100):
+        """
+        Searches for the best matches for the query.
+        :param tokenized_query: List of tokens.
+        :param k1: BM25 k1 parameter.
+        :param b: BM25 b parameter.
+        :param N: Maximum length of the result.
+        :return: Sorted list of (doc_id, score), with maximum length of N.
+        """
+        candidates, scores = self.score(tokenized_query, k1, b)
+        return self.top_n(candidates, scores, N)
+
+    def score_variants(self, tokenized_query, params, postings=None):
+        """
+        Scores all the candidate documents of the query for several (k1, b) pairs in one pass over the postings.
+        The (k1, b) pairs are broadcast as columns, so every row is identical to the scores of `score` for its pair.
+        Pairs are scored and yielded in chunks whose arrays hold about VARIANT_CHUNK_ELEMENTS values, so only one
+        chunk of scores is in memory at a time for long lists.
+        :param tokenized_query: List of tokens.
+        :param params: List of (k1, b) pairs.
+        :param postings: Optional dictionary of already loaded postings - token: (doc_ids, tfs).
+        :return: generator of tuples of (List of (k1, b) pairs, candidate doc_ids, scores) - the scores with a row per
+                 pair of the chunk.
+        """
+        if postings is None:
+            postings = self.load_postings(tokenized_query)
+        postings = {token: pl for token, pl in postings.items() if len(pl[0])}
+        if not postings:
+            yield list(params), np.empty(0, dtype=np.int64), np.empty((len(params), 0), dtype=np.float64)
+            return
+        idf = self.calc_idf(postings.keys())
+        candidates = sorted_unique(np.concatenate([doc_ids for doc_ids, _ in postings.values()]))
+        pos, found = self.doc_store.dense_ids(candidates)
+        doc_lens = np.where(found, self.doc_lens[pos], 0.0)
+        positions = {token: np.searchsorted(candidates, doc_ids) for token, (doc_ids, _) in postings.items()}
+        row_elements = 2 * len(candidates) + sum(len(doc_ids) for doc_ids, _ in postings.values())
+        chunk = max(1, self.VARIANT_CHUNK_ELEMENTS // row_elements)
+        for start in range(0, len(params), chunk):
+            pairs = list(params[start:start + chunk])
+            k1 = np.array([p[0] for p in pairs], dtype=np.float64)[:, None]
+            b = np.array([p[1] for p in pairs], dtype=np.float64)[:, None]
+            norms = k1 * (1 - b + b * doc_lens / self.AVGDL)
+            scores = np.zeros((len(pairs), len(candidates)), dtype=np.float64)
+            contributions = {}
+            for term in tokenized_query:
+                if term not in postings:
+                    continue
+                if term not in contributions:
+                    freq = postings[term][1].astype(np.float64)
+                    contributions[term] = idf[term] * freq * (k1 + 1) / (freq + norms[:, positions[term]])
+                scores[:, positions[term]] += contributions[term]
+            del norms, contributions  # not kept while the caller consumes the chunk
+            yield pairs, candidates, scores
+
+    def contributions(self, doc_ids, tfs, idf, k1, b):
+        """
+        Calculates the BM25 contribution of every posting of a single term.
+        :param doc_ids: numpy array of doc_ids.
+        :param tfs: numpy array of matching term frequencies.
+        :param idf: idf of the term.
+        :param k1: BM25 k1 parameter.
+        :param b: BM25 b parameter.
+        :return: numpy array of contributions.
+        """
+        freq = tfs.astype(np.float64)
+        return idf * freq * (k1 + 1) / (freq + self.gather_length_norm(doc_ids, k1, b))
+
+    def max_impact(self, token, k1, b, postings=None):
+        """
+        Returns the maximal BM25 contribution of a token over its posting list, taken from the table loaded with
+        `load_max_impacts`. Tokens missing from the table (or without a table for (k1, b)) are computed from their
+        posting list, and are not kept.
+        :param token: String.
+        :param k1: BM25 k1 parameter.
+        :param b: BM25 b parameter.
+        :param postings: Optional (doc_ids, tfs) of the token, if already loaded.
+        :return: float - the maximal contribution, 0 if the token is not in the index.
+        """
+        impact = self._max_impacts.get((k1, b), {}).get(token)
+        if impact is not None:
+            return impact
+        if token not in self.index.df.keys():
+            return 0.0
+        if postings is None:
+            postings = BucketIndexLoader.load_posting_arrays_for_token(token, self.index, self.folder_name)
+        doc_ids, tfs = postings
+        idf = self.calc_idf([token])[token]
+        return float(self.contributions(doc_ids, tfs, idf, k1, b).max()) if len(doc_ids) else 0.0
+
+    @staticmethod
+    def max_impacts_path(folder_name, directory='.'):
+        """
+        :return: path of the max impact table of an index folder.
+        """
+        return os.path.join(directory, f'{folder_name}_max_impacts.pkl')
+
+    def build_max_impacts(self, k1, b, path=None):
+        """
+        Computes the maximal contribution of every token in the index, offline, and uses the table from now on.
+        :param k1: BM25 k1 parameter.
+        :param b: BM25 b parameter.
+        :param path: Optional path of a .pkl file to save the table to, see `max_impacts_path`.
+        :return: Dictionary - token: max_impact
+        """
+        table = {token: self.max_impact(token, k1, b) for token in self.index.df.keys()}
+        self._max_impacts[(k1, b)] = table
+        if path is not None:
+            with open(f'{path}.part', 'wb') as f:
+                pickle.dump({'k1': k1, 'b': b, 'N': self.N, 'avgdl': self.AVGDL, 'max_impacts': table}, f)
+            os.replace(f'{path}.part', path)
+        return table
+
+    def load_max_impacts(self, path):
+        """
+        Loads a table saved by `build_max_impacts`.
+        :param path: path of the .pkl file.
+        :return: tuple of the (k1, b) parameters of the table.
+        :raises ValueError: if the table was built for another collection (number of documents or average length).
+        """
+        with open(path, 'rb') as f:
+            saved = pickle.load(f)
+        if saved['N'] != self.N or saved['avgdl'] != self.AVGDL:
+            raise ValueError(f"{path} was built for {saved['N']} documents of average length {saved['avgdl']:.2f}, "
+                             f"not {self.N} of {self.AVGDL:.2f}")
+        self._max_impacts[(saved['k1'], saved['b'])] = saved['max_impacts']
+        return saved['k1'], saved['b']
+
+    def search_top_k(self, tokenized_query, k1, b, N=100):
+        """
+        Searches for the best N matches with MaxScore dynamic pruning, returning the same result as `search`.
+        Terms are visited in decreasing order of their maximal impact. Once the N-th best partial score is higher than
+        the bound of the remaining terms, documents which appear only in those terms cannot enter the top N, so the
+        remaining posting lists are only probed (binary search over the doc_id sorted lists) for the candidates we
+        already have, and candidates whose bound drops below the threshold are pruned.
+        The exact scores of the surviving candidates are then recomputed in query order.
+        :param tokenized_query: List of tokens.
+        :param k1: BM25 k1 parameter.
+        :param b: BM25 b parameter.
+        :param N: Maximum length of the result.
+        :return: Sorted list of (doc_id, score), with maximum length of N.
+        """
+        postings = {token: self._sorted(pl) for token, pl in self.load_postings(tokenized_query).items()
+                    if len(pl[0])}
+        if not postings or N <= 0:
+            return []
+        idf = self.calc_idf(postings.keys())
+        counts = Counter(term for term in tokenized_query if term in postings)
+        bounds = {term: counts[term] * self.max_impact(term, k1, b, postings[term]) for term in postings}
+        order = sorted(postings, key=lambda term: bounds[term], reverse=True)
+        rest = np.cumsum([bounds[term] for term in order][::-1])[::-1].tolist() + [0.0]
+        candidates = np.empty(0, dtype=np.int64)
+        partial = np.empty(0, dtype=np.float64)
+        threshold = -np.inf
+        for i, term in enumerate(order):
+            doc_ids, tfs = postings[term]
+            if len(candidates) >= N and rest[i] < threshold:
+                # Non-essential term - only probe the posting list for the current candidates.
+                pos = np.searchsorted(doc_ids, candidates)
+                pos[pos == len(doc_ids)] = 0
+                hit = doc_ids[pos] == candidates
+                pos = pos[hit]
+                partial[hit] += counts[term] * self.contributions(doc_ids[pos], tfs[pos], idf[term], k1, b)
+            else:
+                merged, inverse = np.unique(np.concatenate([candidates, doc_ids]), return_inverse=True)
+                new_partial = np.zeros(len(merged), dtype=np.float64)
+                new_partial[inverse[:len(candidates)]] = partial
+                new_partial[inverse[len(candidates):]] += counts[term] * self.contributions(doc_ids, tfs, idf[term],
+                                                                                             k1, b)
+                candidates, partial = merged, new_partial
+            if len(candidates) >= N:
+                threshold = np.partition(partial, len(partial) - N)[len(partial) - N] * (1 - 1e-9)
+                keep = partial + rest[i + 1] >= threshold
+                candidates, partial = candidates[keep], partial[keep]
+        scores = np.zeros(len(candidates), dtype=np.float64)
+        for term in tokenized_query:
+            if term not in postings:
+                continue
+            doc_ids, tfs = postings[term]
+            pos = np.searchsorted(doc_ids, candidates)
+            pos[pos == len(doc_ids)] = 0
+            hit = doc_ids[pos] == candidates
+            pos = pos[hit]
+            scores[hit] += self.contributions(doc_ids[pos], tfs[pos], idf[term], k1, b)
+        count('candidates', len(candidates))
+        return self.top_n(candidates, scores, N)
+
+    @staticmethod
+    def _sorted(postings):
+        """
+        Makes sure a posting list is sorted by doc_id.
+        :param postings: tuple of (doc_ids, tfs).
+        :return: tuple of (doc_ids, tfs) sorted by doc_id.
+        """
+        doc_ids, tfs = postings
+        if len(doc_ids) > 1 and np.any(doc_ids[1:] < doc_ids[:-1]):
+            order = np.argsort(doc_ids, kind='stable')
+            return doc_ids[order], tfs[order]
+        return doc_ids, tfs
+
+    @staticmethod
+    def top_n(doc_ids, scores, N=100):
+        """
+        Selecting the N best scores with a partial sort. Ties are broken by doc_id, also at the N-th score, so the
+        result doesn't depend on the order of the candidates.
+        :param doc_ids: numpy array of doc_ids.
+        :param scores: numpy array of matching scores.
+        :param N: Maximum length of the result.
+        :return: Sorted list of (doc_id, score), with maximum length of N.
+        """
+        n = min(N, len(scores))
+        if n <= 0:
+            return []
+        if n < len(scores):
+            cutoff = scores[np.argpartition(-scores, n - 1)[n - 1]]
+            top = np.flatnonzero(scores >= cutoff)
+        else:
+            top = np.arange(len(scores))
+        top = top[np.lexsort((doc_ids[top], -scores[top]))][:n]
+        return list(zip(doc_ids[top].tolist(), scores[top].tolist()))
+
+
+def rankings_match(exact, fast, tol=1e-9):
+    """
+    Checks that two BM25 rankings are the same, allowing different documents only when tied at the cutoff.
+    :param exact: List of (doc_id, score) from BM25.search.
+    :param fast: List of (doc_id, score) from another scorer.
+    :param tol: Tolerance for comparing scores.
+    :return: True if the rankings are equivalent.
+    """
+    if len(exact) != len(fast):
+        return False
+    if not np.allclose([s for _, s in exact], [s for _, s in fast], rtol=0, atol=tol):
+        return False
+    if not exact:
+        return True
+    cutoff = exact[-1][1]
+    exact_scores, fast_scores = dict(exact), dict(fast)
+    for doc_id in exact_scores.keys() ^ fast_scores.keys():
+        score = exact_scores.get(doc_id, fast_scores.get(doc_id))
+        if abs(score - cutoff) > tol:
+            return False
+    return all(abs(exact_scores[doc_id] - fast_scores[doc_id]) <= tol
+               for doc_id in exact_scores.keys() & fast_scores.keys())
+
+
+def verify_top_k(scorer: BM25Scorer, DL, tokenized_query, k1, b, N=100):
+    """
+    Checks that `BM25Scorer.search_top_k` returns the same top N as the exhaustive `BM25.search`.
+    :param scorer: BM25Scorer object.
+    :param DL: Dictionary - doc_id: doc_len.
+    :param tokenized_query: List of tokens.
+    :param k1: BM25 k1 parameter.
+    :param b: BM25 b parameter.
+    :param N: Maximum length of the result.
+    :return: True if the rankings are equivalent.
+    """
+    exact = BM25(scorer.index, DL, k1=k1, b=b, folder_name=scorer.folder_name).search(tokenized_query, N)
+    return rankings_match(exact, scorer.search_top_k(tokenized_query, k1, b, N))
+
+
+if __name__ == '__main__':
+    # python BM25.py - builds the max impact tables of the folders of the main search for their SEARCH_BM25_PARAMS,
+    # from the base indices. The backend loads them for search_top_k (/search?retrieval=maxscore).
+    import backend
+    for base_index, folder in zip(backend.snapshot.base_indices, backend.INDEX_FOLDERS):
+        if folder in backend.SEARCH_BM25_PARAMS:
+            folder_k1, folder_b = backend.SEARCH_BM25_PARAMS[folder]
+            BM25Scorer(base_index, backend.snapshot.base_doc_store, folder).build_max_impacts(
+                folder_k1, folder_b, BM25Scorer.max_impacts_path(folder))
+            print(f"built the max impact table of {folder}")
@@ -0,0 +1,92 @@
+import re
+from functools import cached_property, lru_cache
+from nltk.corpus import stopwords
+from nltk.stem.snowball import SnowballStemmer
+from inverted_index_gcp import InvertedIndex
+
+RE_WORD = re.compile(r"""[\#\@\w](['\-]?\w){2,24}""", re.UNICODE)
+STEM_CACHE_SIZE = 2 ** 16  # distinct tokens whose stem is kept, per analyzer
+
+
+class Analyzer:
+    """
+    A query analysis profile, built once per process and shared by all the requests.
+    The stopword set and the stemmer are created on first use instead of on every query, and the stems of recent
+    tokens are kept in a bounded memo, since query logs repeat the same words. `resolve` looks the analyzed tokens up
+    in an index once, so the scorers get the lexicon entries of the query instead of testing every token again.
+    """
+
+    def __init__(self, name, pattern=None, remove_stopwords=True, stem=False, stem_cache_size=STEM_CACHE_SIZE):
+        """
+        :param name: name of the profile.
+        :param pattern: compiled regular expression of a token, None to split on whitespace.
+        :param remove_stopwords: drop the english stopwords.
+        :param stem: strip a trailing '?' or '!' and stem the tokens with the Snowball stemmer.
+        :param stem_cache_size: maximal number of memoized stems.
+        """
+        self.name = name
+        self.pattern = pattern
+        self.remove_stopwords = remove_stopwords
+        self.stem = stem
+        self.stem_cache_size = stem_cache_size
+
+    @cached_property
+    def stopwords(self):
+        return frozenset(stopwords.words('english')) if self.remove_stopwords else frozenset()
+
+    @cached_property
+    def _stem(self):
+        return lru_cache(maxsize=self.stem_cache_size)(SnowballStemmer(language='english').stem)
+
+    def analyze(self, query):
+        """
+        Tokenizes a query.
+        :param query: String, query to be searched.
+        :return: List of tokens, in query order.
+        """
+        query = query.lower()
+        if self.pattern is not None:
+            tokens = [token.group() for token in self.pattern.finditer(query)]
+        else:
+            tokens = query.split()
+        if self.remove_stopwords:
+            english_stopwords = self.stopwords
+            tokens = [token for token in tokens if token not in english_stopwords]
+        if self.stem:
+            stem = self._stem
+            tokens = [stem(token[:-1] if token.endswith('?') or token.endswith('!') else token) for token in tokens]
+        return tokens
+
+    @staticmethod
+    def resolve(tokens, index: InvertedIndex):
+        """
+        Looks the distinct tokens up in the index.
+        :param tokens: List of tokens.
+        :param index: InvertedIndex object.
+        :return: Dictionary - token: df, of the tokens that appear in the index, in order of first occurrence.
+        """
+        df = index.df
+        entries = {}
+        for token in tokens:
+            if token not in entries:
+                n = df.get(token)
+                if n is not None:
+                    entries[token] = n
+        return entries
+
+    def stats(self):
+        """
+        :return: dictionary of the stem memo counters.
+        """
+        if not self.stem:
+            return {}
+        info = self._stem.cache_info()
+        lookups = info.hits + info.misses
+        return {'size': info.currsize, 'max_size': info.maxsize, 'hits': info.hits, 'misses': info.misses,
+                'hit_rate': info.hits / lookups if lookups else 0.0}
+
+
+# The analysis profiles of the endpoints.
+ASS3 = Analyzer('ass3')  # search_body - the tokenizer of assignment 3
+STEMMED = Analyzer('stemmed', stem=True)  # search, search_config and the batch API
+WORD = Analyzer('word', pattern=RE_WORD, remove_stopwords=False)  # search_title and search_anchor
@@ -0,0 +1,240 @@
+"""
+Asynchronous (ASGI) front end, with the routes and JSON responses of search_frontend.py.
+
+    uvicorn async_frontend:app --host 0.0.0.0 --port 8080
+
+Every query first loads its missing posting lists on the I/O executor of AsyncPostingLoader, without holding a query
+slot, and is then scored on the query executor, at most MAX_CONCURRENT_QUERIES at a time. A slow cold-term download
+only delays its own request. When MAX_PENDING_QUERIES requests are already in progress, new ones are rejected with
+503 and a Retry-After header.
+"""
+import asyncio
+import contextlib
+import contextvars
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, PlainTextResponse
+from starlette.routing import Route
+import backend
+from backend import SearchHandler, RETRIEVAL_MODES, INDEX_FOLDERS
+from analyzer import ASS3, STEMMED, WORD
+from async_postings import AsyncPostingLoader
+import instrumentation
+from instrumentation import metrics
+
+MAX_CONCURRENT_QUERIES = os.cpu_count() or 1  # queries scored at the same time
+MAX_PENDING_QUERIES = 256  # queries in progress, including those waiting for postings or a slot
+RETRY_AFTER_SECONDS = 1
+CONFIG_KEYS = ('body_k', 'body_b', 'body_w', 'title_k', 'title_b', 'title_w', 'page_rank_w', 'page_views_w')
+
+BODY_FOLDER, TITLE_FOLDER, ANCHOR_FOLDER = INDEX_FOLDERS
+
+
+class QueryGate:
+    """
+    Admission control of the queries: a bound on the queries in progress, and a semaphore of the scoring slots.
+    Used only from the event loop.
+    """
+
+    def __init__(self, max_concurrent=MAX_CONCURRENT_QUERIES, max_pending=MAX_PENDING_QUERIES):
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(max_concurrent, thread_name_prefix="query")
+        self.slots = asyncio.Semaphore(max_concurrent)
+        self.pending = 0
+        self.running = 0
+        self.rejected = 0
+
+    def admit(self):
+        """
+        :return: True if the query is admitted, and must be followed by `release`.
+        """
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            return False
+        self.pending += 1
+        return True
+
+    def release(self):
+        self.pending -= 1
+
+    async def run(self, fn, *args):
+        """
+        Runs a blocking query function on the query executor once a slot is free, in a copy of the caller's context.
+        :return: the result of the function.
+        """
+        async with self.slots:
+            self.running += 1
+            try:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(self.executor,
+                                                  functools.partial(contextvars.copy_context().run, fn, *args))
+            finally:
+                self.running -= 1
+
+    def stats(self):
+        return {'pending': self.pending, 'running': self.running, 'rejected': self.rejected,
+                'max_pending': self.max_pending}
+
+
+posting_loader = AsyncPostingLoader()
+gate = None  # created in the event loop, on startup
+
+
+def _prefetch_search(query, retrieval):
+    """
+    :return: List of (tokens, index, folder name) of the posting lists used by `search`. The impact indices don't
+             use the posting lists, and the champion tiers only read them when they fall back.
+    """
+    tokens = STEMMED.analyze(query)
+    retrieval = backend.DEFAULT_RETRIEVAL if retrieval is None else retrieval
+    served = {'impact': backend.impact_indices, 'champion': backend.champion_tiers}.get(retrieval, {})
+    return [(tokens, index, folder) for index, folder in ((backend.text_inverted_index, BODY_FOLDER),
+                                                          (backend.title_inverted_index, TITLE_FOLDER))
+            if folder not in served]
+
+
+def _prefetch_search_config(query):
+    tokens = STEMMED.analyze(query)
+    return [(tokens, backend.text_inverted_index, BODY_FOLDER), (tokens, backend.title_inverted_index, TITLE_FOLDER)]
+
+
+def _prefetch_search_body(query):
+    return [(ASS3.analyze(query), backend.text_inverted_index, BODY_FOLDER)]
+
+
+def _prefetch_search_title(query):
+    tokens = WORD.analyze(query)
+    return [(tokens, backend.title_inverted_index, TITLE_FOLDER)]
+
+
+def _prefetch_search_anchor(query):
+    tokens = WORD.analyze(query)
+    return [(tokens, backend.anchor_inverted_index, ANCHOR_FOLDER)]
+
+
+async def run_query(request, plan, fn, *args):
+    """
+    Runs a query through the gate: loads its postings, then scores it in a query slot.
+    :param request: Starlette request, used for the trace endpoint.
+    :param plan: function with no arguments, returning the (tokens, index, folder name) of the postings to load.
+    :param fn: blocking query function.
+    :return: JSONResponse of the result, or 503 when too many queries are in progress.
+    """
+    if not gate.admit():
+        return JSONResponse([], status_code=503, headers={'Retry-After': str(RETRY_AFTER_SECONDS)})
+    try:
+        with instrumentation.trace(request.url.path):
+            await asyncio.gather(*[posting_loader.prefetch(tokens, index, folder) for tokens, index, folder in plan()])
+            res = await gate.run(fn, *args)
+        return JSONResponse(res)
+    finally:
+        gate.release()
+
+
+async def search(request):
+    """ Same as `/search` of search_frontend.py, including the optional `retrieval` argument. """
+    query = request.query_params.get('query', '')
+    if len(query) == 0:
+        return JSONResponse([])
+    retrieval = request.query_params.get('retrieval')
+    if retrieval is not None and retrieval not in RETRIEVAL_MODES:
+        return JSONResponse([], status_code=400)
+    return await run_query(request, lambda: _prefetch_search(query, retrieval),
+                           functools.partial(SearchHandler.search, query, retrieval=retrieval))
+
+
+async def search_config(request):
+    """ Same as `/search_config` of search_frontend.py. Missing or invalid parameters return 400. """
+    query = request.query_params.get('query', '')
+    if len(query) == 0:
+        return JSONResponse([])
+    try:
+        config = {key: float(request.query_params[key]) for key in CONFIG_KEYS}
+    except (KeyError, ValueError):
+        return JSONResponse([], status_code=400)
+    return await run_query(request, lambda: _prefetch_search_config(query), SearchHandler.search_config, query, config)
+
+
+async def search_body(request):
+    """ Same as `/search_body` of search_frontend.py. """
+    query = request.query_params.get('query', '')
+    if len(query) == 0:
+        return JSONResponse([])
+    return await run_query(request, lambda: _prefetch_search_body(query), SearchHandler.search_body, query)
+
+
+async def search_title(request):
+    """ Same as `/search_title` of search_frontend.py. """
+    query = request.query_params.get('query', '')
+    if len(query) == 0:
+        return JSONResponse([])
+    return await run_query(request, lambda: _prefetch_search_title(query), SearchHandler.search_title, query)
+
+
+async def search_anchor(request):
+    """ Same as `/search_anchor` of search_frontend.py. """
+    query = request.query_params.get('query', '')
+    if len(query) == 0:
+        return JSONResponse([])
+    return await run_query(request, lambda: _prefetch_search_anchor(query), SearchHandler.search_anchor, query)
+
+
+async def get_pagerank(request):
+    """ Same as `/get_pagerank` of search_frontend.py - a POST of a json list of wiki ids. """
+    wiki_ids = await request.json()
+    if len(wiki_ids) == 0:
+        return JSONResponse([])
+    return JSONResponse(SearchHandler.search_page_rank(wiki_ids))
+
+
+async def get_pageview(request):
+    """ Same as `/get_pageview` of search_frontend.py - a POST of a json list of wiki ids. """
+    wiki_ids = await request.json()
+    if len(wiki_ids) == 0:
+        return JSONResponse([])
+    return JSONResponse(SearchHandler.search_page_view(wiki_ids))
+
+
+async def cache_stats(request):
+    """ Same as `/cache_stats` of search_frontend.py, with the counters of the query gate. """
+    return JSONResponse(dict(SearchHandler.cache_stats(), gate=gate.stats()))
+
+
+async def metrics_endpoint(request):
+    """ Same as `/metrics` of search_frontend.py, with the gauges of the query gate. """
+    gauges = instrumentation.flatten_gauges('ir_cache', SearchHandler.cache_stats())
+    gauges.update(instrumentation.flatten_gauges('ir_gate', gate.stats()))
+    if request.query_params.get('format') == 'json':
+        return JSONResponse(dict(metrics.snapshot(), gauges=gauges))
+    return PlainTextResponse(metrics.render(gauges), media_type='text/plain; version=0.0.4')
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    global gate
+    gate = QueryGate()
+    try:
+        yield
+    finally:
+        posting_loader.shutdown()
+        gate.executor.shutdown(wait=False)
+
+
+app = Starlette(routes=[
+    Route('/search', search),
+    Route('/search_config', search_config),
+    Route('/search_body', search_body),
+    Route('/search_title', search_title),
+    Route('/search_anchor', search_anchor),
+    Route('/get_pagerank', get_pagerank, methods=['POST']),
+    Route('/get_pageview', get_pageview, methods=['POST']),
+    Route('/cache_stats', cache_stats),
+    Route('/metrics', metrics_endpoint),
+], lifespan=lifespan)
+
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host='0.0.0.0', port=8080)
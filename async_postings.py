@@ -0,0 +1,58 @@
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from loader import BucketIndexLoader
+from cache import posting_cache
+from inverted_index_gcp import InvertedIndex
+
+IO_WORKERS = 16  # concurrent posting list reads
+
+
+class AsyncPostingLoader:
+    """
+    Non-blocking posting list I/O for the asynchronous front end.
+    Posting lists are read into the shared posting list cache on an I/O executor, from the local files or the block
+    store, so the event loop never waits on the bucket or the disk, and the scoring that follows finds its lists in
+    the cache. Concurrent requests for the same list share one read.
+    """
+
+    def __init__(self, io_workers=IO_WORKERS):
+        self.executor = ThreadPoolExecutor(io_workers, thread_name_prefix="posting-io")
+        self._flights = {}  # key: asyncio.Future of the running read
+
+    async def run(self, fn, *args):
+        """
+        Runs a blocking function on the I/O executor, in a copy of the caller's context so it is traced.
+        :return: the result of the function.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor,
+                                          functools.partial(contextvars.copy_context().run, fn, *args))
+
+    async def _single_flight(self, key, fn, *args):
+        """
+        Runs a blocking function once for all the concurrent callers with the same key.
+        """
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = asyncio.ensure_future(self.run(fn, *args))
+            flight.add_done_callback(lambda _: self._flights.pop(key, None))
+        return await asyncio.shield(flight)
+
+    async def prefetch(self, tokens, index: InvertedIndex, folder_name):
+        """
+        Loads the posting lists of the tokens which are not cached yet into the posting list cache.
+        :param tokens: List of tokens.
+        :param index: InvertedIndex object
+        :param folder_name: folder name
+        """
+        tokens = [token for token in dict.fromkeys(tokens)
+                  if token in index.posting_locs and not posting_cache.contains((folder_name, token))]
+        await asyncio.gather(*[
+            self._single_flight(('read', folder_name, token), BucketIndexLoader.load_posting_arrays_for_token,
+                                token, index, folder_name)
+            for token in tokens])
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
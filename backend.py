@@ -1,66 +1,272 @@
-import re
-from collections import defaultdict
+import contextvars
+import os
+import threading
 import numpy as np
 from loader import BucketIndexLoader
-from helperClasses import QueryProcessing, Calculator, ResultProcessor
-from BM25 import BM25
-from time import time
+from cache import posting_cache, result_cache, NoStore
+from concurrent.futures import ThreadPoolExecutor
+from posting_store import posting_store
+from block_store import block_store
+from helperClasses import ResultProcessor
+from analyzer import ASS3, STEMMED, WORD
+from BM25 import BM25, BM25Scorer
+from tfidf import TfIdfScorer
+from boolean_ranker import BooleanRanker
+from impact_index import ImpactIndex
+from champion import ChampionTier
+from segments import SegmentStore, SegmentedIndex, DeltaSegment, overlay_stores
+from startup import PhaseTimer, list_artifacts, download_artifacts, load_document_store
+from posting_compression import CompressedPostingReader
+from instrumentation import stage
+from time import monotonic, sleep
 import hashlib
 
 epsilon = .0000001
+RETRIEVAL_MODES = ('exhaustive', 'maxscore', 'impact', 'champion')
+# BM25 parameters of the main search - folder name: (k1, b). Built with `python impact_index.py <folder> <k1> <b>`.
+SEARCH_BM25_PARAMS = {"text_inverted_index": (5, 0.2), "title_inverted_index_with_stemming": (2, 0.05)}
+SEARCH_LEG_WORKERS = 8  # 0 runs the body and title legs one after the other
+SEARCH_LEG_TIMEOUT = None  # seconds, None waits for every leg
+SEARCH_ALLOW_PARTIAL = False  # return the merged result of the legs that finished, instead of failing
+INDEX_FOLDERS = ("text_inverted_index", "title_inverted_index_with_stemming", "anchor_inverted_index")
+BLOCK_PREFETCH = True  # download the blocks of the most frequent terms in the background at startup
+SEGMENT_MERGE_INTERVAL = 60.0  # seconds between two checks for new and mergeable delta segments, None to disable
+PREFORK_ENV = "IR_PREFORK"  # set to 1 by serve.py, which starts the segment merger in the forked workers
 
 
 def _hash(s):
     return hashlib.blake2b(bytes(s, encoding='utf8'), digest_size=5).hexdigest()
 
 
-RE_WORD = re.compile(r"""[\#\@\w](['\-]?\w){2,24}""", re.UNICODE)
-start = time()
+def load_impact_indices(doc_store):
+    """
+    Loads the impact indices that were built for the parameters of the main search.
+    :param doc_store: DocumentStore object the impact indices were built with.
+    :return: Dictionary - folder name: ImpactIndex.
+    """
+    impact_indices = {}
+    for folder_name, (k1, b) in SEARCH_BM25_PARAMS.items():
+        if not ImpactIndex.exists(folder_name):
+            continue
+        try:
+            impact_index = ImpactIndex(folder_name, doc_store)
+        except ValueError as e:
+            print(f"not using the impact index of {folder_name}: {e}")
+            continue
+        if impact_index.matches(k1, b):
+            impact_indices[folder_name] = impact_index
+        else:
+            print(f"not using the impact index of {folder_name}: built for k1={impact_index.k1}, b={impact_index.b}")
+    return impact_indices
+
+
+def load_champion_tiers():
+    """
+    Loads the champion tiers that were built for the parameters of the main search.
+    :return: Dictionary - folder name: ChampionTier.
+    """
+    champion_tiers = {}
+    for folder_name, (k1, b) in SEARCH_BM25_PARAMS.items():
+        if not ChampionTier.exists(folder_name):
+            continue
+        champion_tier = ChampionTier(folder_name)
+        if champion_tier.matches(k1, b):
+            champion_tiers[folder_name] = champion_tier
+        else:
+            print(f"not using the champion tier of {folder_name}: built for k1={champion_tier.k1}, b={champion_tier.b}")
+    return champion_tiers
+
+
+def load_max_impacts(scorers):
+    """
+    Loads the max impact tables that were built for the parameters of the main search into the scorers, for
+    `search_top_k`. Terms missing from a table are computed from their posting list when they are queried.
+    :param scorers: List of BM25Scorer objects of the folders of the main search.
+    """
+    for scorer in scorers:
+        path = BM25Scorer.max_impacts_path(scorer.folder_name)
+        if not os.path.exists(path):
+            continue
+        try:
+            params = scorer.load_max_impacts(path)
+        except ValueError as e:
+            print(f"not using the max impacts of {scorer.folder_name}: {e}")
+            continue
+        if params != SEARCH_BM25_PARAMS[scorer.folder_name]:
+            print(f"not using the max impacts of {scorer.folder_name}: built for k1={params[0]}, b={params[1]}")
+
+
+def default_retrieval(impact_indices, champion_tiers):
+    """
+    :param impact_indices: Dictionary - folder name: ImpactIndex.
+    :param champion_tiers: Dictionary - folder name: ChampionTier.
+    :return: the retrieval mode of the main search - 'impact' once the impact indices were built for both folders,
+             then 'champion' once the champion tiers were, and 'exhaustive' otherwise.
+    """
+    if len(impact_indices) == len(SEARCH_BM25_PARAMS):
+        return 'impact'
+    if len(champion_tiers) == len(SEARCH_BM25_PARAMS):
+        return 'champion'
+    return 'exhaustive'
+
+
+class IndexSnapshot:
+    """
+    The indices served by the backend - the base indices with the delta segments applied, and the document stores,
+    scorers and rankers built on them. A snapshot is never changed: updates build a new snapshot, which
+    `install_snapshot` swaps in, and a request reads the current snapshot once, so it finishes on the snapshot it
+    started with.
+    The impact indices, the champion tiers and the max impact tables are built from the base indices, and are only
+    used without segments.
+    """
+
+    def __init__(self, base_indices, base_doc_store, base_doc_titles, segments=(), generation=0):
+        """
+        :param base_indices: tuple of the body, title and anchor InvertedIndex objects of the base.
+        :param base_doc_store: DocumentStore object of the base.
+        :param base_doc_titles: TitleStore object of the base.
+        :param segments: List of DeltaSegment objects, oldest first.
+        :param generation: generation of the segments.
+        """
+        self.base_indices = base_indices
+        self.base_doc_store = base_doc_store
+        self.base_doc_titles = base_doc_titles
+        self.segments = list(segments)
+        self.generation = generation
+        if self.segments:
+            indices = tuple(SegmentedIndex(index, folder, self.segments)
+                            for index, folder in zip(base_indices, INDEX_FOLDERS))
+        else:
+            indices = tuple(base_indices)
+        self.text_inverted_index, self.title_inverted_index, self.anchor_inverted_index = indices
+        self.doc_store, self.doc_titles = overlay_stores(base_doc_store, base_doc_titles, self.segments)
+        self.DL = self.doc_store.view('DL')
+        self.body_scorer = BM25Scorer(self.text_inverted_index, self.doc_store, folder_name="text_inverted_index")
+        self.title_scorer = BM25Scorer(self.title_inverted_index, self.doc_store,
+                                       folder_name="title_inverted_index_with_stemming")
+        self.body_tfidf_scorer = TfIdfScorer(self.text_inverted_index, self.doc_store,
+                                             folder_name="text_inverted_index")
+        self.title_ranker = BooleanRanker(self.title_inverted_index, self.doc_store, self.doc_titles,
+                                          "title_inverted_index_with_stemming")
+        self.anchor_ranker = BooleanRanker(self.anchor_inverted_index, self.doc_store, self.doc_titles,
+                                           "anchor_inverted_index")
+        if not self.segments:
+            load_max_impacts((self.body_scorer, self.title_scorer))
+        self.impact_indices = {} if self.segments else load_impact_indices(self.doc_store)
+        self.champion_tiers = {} if self.segments else load_champion_tiers()
+        self.default_retrieval = default_retrieval(self.impact_indices, self.champion_tiers)
+
+    def with_segments(self, segments, generation):
+        """
+        :return: a new IndexSnapshot of the same base indices with other segments.
+        """
+        return IndexSnapshot(self.base_indices, self.base_doc_store, self.base_doc_titles, segments, generation)
+
+    def stats(self):
+        """
+        :return: dictionary of the segment counters.
+        """
+        stats = {'generation': self.generation, 'segments': len(self.segments),
+                 'documents': len(self.doc_store.ids) - len(self.base_doc_store.ids),
+                 'tombstones': sum(len(segment.tombstones) for segment in self.segments)}
+        if self.segments:
+            stats['merged_lists'] = {index.folder_name: index.cache.stats() for index in
+                                     (self.text_inverted_index, self.title_inverted_index, self.anchor_inverted_index)}
+        return stats
+
+
+def install_snapshot(new_snapshot):
+    """
+    Swaps in a new snapshot, with a single assignment, and drops the cached results of the previous one. Running
+    requests keep the snapshot they started with. The module attributes of the indices, stores and scorers are
+    updated for the other modules.
+    :param new_snapshot: IndexSnapshot object.
+    """
+    global snapshot, text_inverted_index, title_inverted_index, anchor_inverted_index, doc_store, doc_titles, DL, \
+        body_scorer, title_scorer, body_tfidf_scorer, title_ranker, anchor_ranker, impact_indices, champion_tiers, \
+        DEFAULT_RETRIEVAL
+    snapshot = new_snapshot
+    text_inverted_index, title_inverted_index, anchor_inverted_index = (snapshot.text_inverted_index,
+                                                                        snapshot.title_inverted_index,
+                                                                        snapshot.anchor_inverted_index)
+    doc_store, doc_titles, DL = snapshot.doc_store, snapshot.doc_titles, snapshot.DL
+    body_scorer, title_scorer, body_tfidf_scorer = snapshot.body_scorer, snapshot.title_scorer, \
+        snapshot.body_tfidf_scorer
+    title_ranker, anchor_ranker = snapshot.title_ranker, snapshot.anchor_ranker
+    impact_indices, champion_tiers = snapshot.impact_indices, snapshot.champion_tiers
+    DEFAULT_RETRIEVAL = snapshot.default_retrieval
+    result_cache.invalidate()
+
+
+timer = PhaseTimer()
 bucket_loader = BucketIndexLoader("project_bucket_316533942")
-print(f"loading indices -- {time() - start}")
-text_inverted_index, title_inverted_index, anchor_inverted_index = bucket_loader.load_all_indices()
-print(f"loading pageviews -- {time() - start}")
-page_views = bucket_loader.loda_page_views()
-print(f"normalizing pageviews -- {time() - start}")
-page_views_norm = QueryProcessing.normalize_pageviews(page_views)
-print(f"loading pagerank -- {time() - start}")
-page_rank, pr_norm = bucket_loader.load_page_rank_to_df()
-page_rank = page_rank.to_dict(defaultdict(int))
-pr_norm = pr_norm.to_dict(defaultdict(int))
-print(f"loading other dictionaries -- {time() - start}")
-doc_titles = bucket_loader.load_doc_titles()
-doc_norms = bucket_loader.load_doc_norms()
-DL = bucket_loader.load_doc_len()
+with timer.phase("downloading artifacts"):
+    generations = download_artifacts(bucket_loader, list_artifacts(bucket_loader))
+with timer.phase("loading indices"):
+    base_indices = bucket_loader.load_all_indices()
+for folder in INDEX_FOLDERS:
+    if CompressedPostingReader.exists(folder):  # converted with `python posting_compression.py <folder>`
+        BucketIndexLoader.use_compressed_postings(folder)
+if BLOCK_PREFETCH:
+    block_store.prefetch([(index, folder) for index, folder in zip(base_indices, INDEX_FOLDERS)
+                          if folder not in BucketIndexLoader.compressed_readers])
+base_doc_store, base_doc_titles = load_document_store(bucket_loader, generations, timer)
+segment_store = SegmentStore()
+with timer.phase("loading segments"):
+    segment_generation, delta_segments = segment_store.read()
+    install_snapshot(IndexSnapshot(base_indices, base_doc_store, base_doc_titles, delta_segments, segment_generation))
+del base_indices, delta_segments
+_update_lock = threading.Lock()  # serializes the snapshot updates
+leg_executor = ThreadPoolExecutor(SEARCH_LEG_WORKERS, thread_name_prefix="search-leg") if SEARCH_LEG_WORKERS else None
+startup_report = timer.report()
+print(f"backend ready -- {startup_report['total']:.2f}s")
 
 
 class SearchHandler:
     @staticmethod
-    def search_page_view(doc_ids, normalized=False):
+    def search_page_view(doc_ids, normalized=False, snap=None):
         """
         Handles the `get_pageview` request from the frontend.
         :param doc_ids: List of doc_id values, that we want to find their matching page views value.
         :param normalized: Boolean, determines if to use the normalized page views dictionary.
+        :param snap: IndexSnapshot object, defaults to the current snapshot.
         :return: List of matching page views.
         """
+        snap = snapshot if snap is None else snap
         if normalized:
-            res = [page_views_norm.get(doc_id, 0) for doc_id in doc_ids]
+            res = snap.doc_store.gather('page_views_norm', doc_ids)
         else:
-            res = [page_views.get(doc_id, 0) for doc_id in doc_ids]
-        return res
+            res = snap.doc_store.gather('page_views', doc_ids)
+        return res.tolist()
 
     @staticmethod
-    def search_page_rank(doc_ids, normalized=False):
+    def search_page_rank(doc_ids, normalized=False, snap=None):
         """
         Handles the `get_pagerank` request from the frontend.
         :param doc_ids: List of doc_id values, that we want to find their matching page rank value.
         :param normalized: Boolean, determines if to use the normalized page views dictionary.
+        :param snap: IndexSnapshot object, defaults to the current snapshot.
         :return: List of matching page views.
         """
+        snap = snapshot if snap is None else snap
         if normalized:
-            res = [page_views_norm[doc_id] for doc_id in doc_ids]
+            res = snap.doc_store.gather('page_views_norm', doc_ids)
         else:
-            res = [page_rank[doc_id] for doc_id in doc_ids]
-        return res
+            res = snap.doc_store.gather('page_rank', doc_ids)
+        return res.tolist()
+
+    @staticmethod
+    def cache_stats():
+        """
+        Handles the `cache_stats` request from the frontend.
+        :return: Dictionary of the posting list cache, the result cache, the block cache, the stem memo, the
+                 champion tier and the segment counters.
+        """
+        snap = snapshot
+        return {'postings': posting_cache.stats(), 'results': result_cache.stats(), 'blocks': block_store.stats(),
+                'stems': STEMMED.stats(),
+                'champions': {folder: champion_tier.stats() for folder, champion_tier in snap.champion_tiers.items()},
+                'segments': snap.stats()}
 
     @staticmethod
     def search_title(query):
@@ -69,23 +275,24 @@ class SearchHandler:
         :param query: String - the query to be searched.
         :return: List of (doc_id, doc_title) of the title result.
         """
-        res_dict = defaultdict(int)
-        query_tokens = [token.group() for token in RE_WORD.finditer(query.lower())]  # Tokenize the query
-        dist_query_list = []
-        for word in query_tokens:
-            if word not in dist_query_list:
-                dist_query_list.append(word)  # get a distinct token query
-        for token in query_tokens:
-            if token not in title_inverted_index.posting_locs:
-                continue
-            pl = BucketIndexLoader.load_posting_lists_for_token(token, title_inverted_index,  # load posting list
-                                                                "title_inverted_index_with_stemming")
-            for doc_id, _ in pl:
-                if doc_id in doc_titles:
-                    res_dict[doc_id] += 1
-        res = [doc_id for doc_id, val in res_dict.items() if val > 0]
-        res = sorted(res, reverse=True, key=lambda x: res_dict[x])
-        res = [(doc_id, doc_titles[doc_id]) for doc_id in res]
+        with stage('tokenize'):
+            query_tokens = WORD.analyze(query)
+        return result_cache.get_or_compute(('search_title', tuple(query_tokens)),
+                                           lambda: SearchHandler._search_title(query_tokens, snapshot))
+
+    @staticmethod
+    def _search_title(query_tokens, snap=None):
+        """
+        Runs a title search, without the result cache.
+        :param query_tokens: List of tokens.
+        :param snap: IndexSnapshot object, defaults to the current snapshot.
+        :return: List of (doc_id, doc_title) of the title result.
+        """
+        snap = snapshot if snap is None else snap
+        with stage('score'):
+            doc_ids = snap.title_ranker.rank(query_tokens)
+        with stage('titles'):
+            res = snap.doc_titles.materialize(doc_ids)
         return res
 
     @staticmethod
@@ -95,18 +302,24 @@ class SearchHandler:
         :param query: String - the query to be searched.
         :return: List of (doc_id, doc_title) of the anchor result.
         """
-        res_dict = defaultdict(int)
-        query_tokens = [token.group() for token in RE_WORD.finditer(query.lower())]
-        for token in query_tokens:
-            if token not in title_inverted_index.posting_locs:
-                continue
-            pl = BucketIndexLoader.load_posting_lists_for_token(token, anchor_inverted_index, "anchor_inverted_index")
-            for doc_id, _ in pl:
-                if doc_id in doc_titles:
-                    res_dict[doc_id] += 1
-        res = [doc_id for doc_id, val in res_dict.items() if val > 0]
-        res = sorted(res, reverse=True, key=lambda x: res_dict[x])
-        res = [(doc_id, doc_titles[doc_id]) for doc_id in res]
+        with stage('tokenize'):
+            query_tokens = WORD.analyze(query)
+        return result_cache.get_or_compute(('search_anchor', tuple(query_tokens)),
+                                           lambda: SearchHandler._search_anchor(query_tokens, snapshot))
+
+    @staticmethod
+    def _search_anchor(query_tokens, snap=None):
+        """
+        Runs an anchor search, without the result cache.
+        :param query_tokens: List of tokens.
+        :param snap: IndexSnapshot object, defaults to the current snapshot.
+        :return: List of (doc_id, doc_title) of the anchor result.
+        """
+        snap = snapshot if snap is None else snap
+        with stage('score'):
+            doc_ids = snap.anchor_ranker.rank(query_tokens)
+        with stage('titles'):
+            res = snap.doc_titles.materialize(doc_ids)
         return res
 
     @staticmethod
@@ -116,60 +329,161 @@ class SearchHandler:
         :param query: String - the query to be searched.
         :return: List of (doc_id, doc_title) of the body result.
         """
-        query_tokens = QueryProcessing.tokenize_ass3(query)
-        Q = Calculator.get_tfidf_for_query(query_tokens, text_inverted_index)
-        D = SearchHandler.get_candidate_docs_with_scores(query_tokens, text_inverted_index)
-        sims = Calculator.dict_cosine_similarity(D, Q, doc_norms)
-        top_100 = ResultProcessor.get_top_n(sims)
-        res = [(tup[0], doc_titles[tup[0]]) for tup in top_100]
-        return res
+        with stage('tokenize'):
+            query_tokens = ASS3.analyze(query)
+        return result_cache.get_or_compute(('search_body', tuple(query_tokens)),
+                                           lambda: SearchHandler._search_body(query_tokens, snapshot))
 
     @staticmethod
-    def get_candidate_docs_with_scores(query, index):
+    def _search_body(query_tokens, snap=None):
         """
-        Returns a dictionary of doc_id: tfidf_score, of relevant documents for the query.
-        :param query: List of tokens.
-        :param index: InvertedIndex object.
-        :param DL: Dictionary - doc_id: doc_len.
-        :return: dictionary of doc_id: tfidf_score
-        """
-        res = {}
-        for token in np.unique(query):
-            if token in index.df.keys():
-                pl = BucketIndexLoader.load_posting_lists_for_token(token, index, "text_inverted_index")
-                for doc_id, tf in pl:
-                    res[doc_id] = {}
-                    normalized_tfidf = (tf / DL.get(doc_id, 1 / epsilon)) * (
-                        np.log10((len(DL) / index.df.get(token, 1 / epsilon))))
-                    res[doc_id][token] = normalized_tfidf
+        Runs a body search, without the result cache.
+        :param query_tokens: List of tokens.
+        :param snap: IndexSnapshot object, defaults to the current snapshot.
+        :return: List of (doc_id, doc_title) of the body result.
+        """
+        snap = snapshot if snap is None else snap
+        with stage('score'):
+            top_100 = snap.body_tfidf_scorer.search(query_tokens)
+        with stage('titles'):
+            res = snap.doc_titles.materialize([doc_id for doc_id, _ in top_100])
         return res
 
     @staticmethod
-    def search(query):
+    def bm25_search(scorer, tokenized_query, k1, b, retrieval='exhaustive', snap=None):
+        """
+        Runs a BM25 scorer with the requested retrieval mode.
+        :param scorer: BM25Scorer object.
+        :param tokenized_query: List of tokens.
+        :param k1: BM25 k1 parameter.
+        :param b: BM25 b parameter.
+        :param retrieval: 'exhaustive' scores every candidate, 'maxscore' uses dynamic pruning with the same result,
+                          'impact' uses the quantized impact index of the folder, if it was built for k1 and b, and
+                          'champion' the champion tier of the folder, which falls back to the full posting lists when
+                          its score bound is not met. Both fall back to 'exhaustive' when they were not built, or
+                          when the snapshot has delta segments.
+        :param snap: IndexSnapshot object of the scorer, defaults to the current snapshot.
+        :return: Sorted list of (doc_id, score).
+        """
+        snap = snapshot if snap is None else snap
+        with stage('score'):
+            if retrieval == 'impact':
+                impact_index = snap.impact_indices.get(scorer.folder_name)
+                if impact_index is not None and impact_index.matches(k1, b):
+                    return impact_index.search(tokenized_query)
+                retrieval = 'exhaustive'
+            if retrieval == 'champion':
+                champion_tier = snap.champion_tiers.get(scorer.folder_name)
+                if champion_tier is not None and champion_tier.matches(k1, b):
+                    res = champion_tier.search(scorer, tokenized_query)
+                    if res is not None:
+                        return res
+                retrieval = 'exhaustive'
+            if retrieval == 'maxscore':
+                return scorer.search_top_k(tokenized_query, k1, b)
+            if retrieval == 'exhaustive':
+                return scorer.search(tokenized_query, k1, b)
+        raise ValueError(f"unknown retrieval mode {retrieval}")
+
+    @staticmethod
+    def run_legs(legs, timeout=None, allow_partial=False):
+        """
+        Runs independent sub-searches (legs) concurrently on the leg executor, or one after the other if it is disabled.
+        Every leg runs in a copy of the caller's context, so its stages are added to the trace of the request.
+        :param legs: Dictionary - leg name: function with no arguments.
+        :param timeout: Seconds to wait for each leg, None to wait for all of them.
+        :param allow_partial: If True, a leg that times out or fails contributes an empty result instead of raising.
+        :return: tuple of (Dictionary - leg name: result, Boolean - True if every leg finished).
+        """
+        results, complete = {}, True
+        if leg_executor is None:
+            futures = None
+        else:
+            futures = {name: leg_executor.submit(contextvars.copy_context().run, leg) for name, leg in legs.items()}
+        deadline = None if timeout is None else monotonic() + timeout
+        for name, leg in legs.items():
+            try:
+                if futures is None:
+                    results[name] = leg()
+                else:
+                    remaining = None if deadline is None else max(0.0, deadline - monotonic())
+                    results[name] = futures[name].result(timeout=remaining)
+            except Exception:  # including concurrent.futures.TimeoutError
+                if not allow_partial:
+                    raise
+                if futures is not None:
+                    futures[name].cancel()
+                results[name], complete = [], False
+        return results, complete
+
+    @staticmethod
+    def search(query, retrieval=None, timeout=None, allow_partial=None):
         """
         Handles the `search` request from the frontend. Using optimized combination of BM25 models and other parameters.
         :param query: List of tokens.
+        :param retrieval: One of RETRIEVAL_MODES, defaults to DEFAULT_RETRIEVAL.
+        :param timeout: Seconds to wait for each sub-search, defaults to SEARCH_LEG_TIMEOUT.
+        :param allow_partial: Return partial results when a sub-search times out, defaults to SEARCH_ALLOW_PARTIAL.
         :return: List of (doc_id, doc_title) of the best results.
         """
-        tokenized_query = QueryProcessing.tokenize_with_stem(query)
-        body_bm25 = BM25(text_inverted_index, DL, k1=5, b=0.2,
-                         folder_name="text_inverted_index")
-        body_res = body_bm25.search(tokenized_query)
-        body_res = body_bm25.normalize_score(body_res)
-        title_bm25 = BM25(title_inverted_index, DL, k1=2, b=0.05,
-                          folder_name="title_inverted_index_with_stemming")
-        title_res = title_bm25.search(tokenized_query)
-        title_res = title_bm25.normalize_score(title_res)
-        page_rank_res = SearchHandler.search_page_rank(
-            set([doc_id for doc_id, _ in body_res] + [doc_id for doc_id, _ in title_res]), normalized=True)
-        page_rank_res = [(body_res[i][0], page_rank_res[i]) for i in range(len(body_res))]
-        page_views_res = SearchHandler.search_page_view(
-            set([doc_id for doc_id, _ in body_res] + [doc_id for doc_id, _ in title_res]), normalized=True)
-        page_views_res = [(body_res[i][0], page_views_res[i]) for i in range(len(body_res))]
-        ws = [0.6, 0.3, 0.15, 0.15]
-        N = min([10 * len(tokenized_query), 30])
-        res = SearchHandler.multi_merge_results([body_res, title_res, page_rank_res, page_views_res], ws)[:N]
-        res = [(tup[0], doc_titles[tup[0]]) for tup in res]
+        retrieval = DEFAULT_RETRIEVAL if retrieval is None else retrieval
+        timeout = SEARCH_LEG_TIMEOUT if timeout is None else timeout
+        allow_partial = SEARCH_ALLOW_PARTIAL if allow_partial is None else allow_partial
+        with stage('tokenize'):
+            tokenized_query = STEMMED.analyze(query)
+        return result_cache.get_or_compute(('search', tuple(tokenized_query), retrieval),
+                                           lambda: SearchHandler._search(tokenized_query, retrieval, timeout,
+                                                                         allow_partial, snapshot))
+
+    @staticmethod
+    def _search(tokenized_query, retrieval, timeout=None, allow_partial=False, snap=None):
+        """
+        Runs the main search, without the result cache. The body and title legs run concurrently.
+        :param tokenized_query: List of tokens.
+        :param retrieval: One of RETRIEVAL_MODES.
+        :param timeout: Seconds to wait for each leg.
+        :param allow_partial: Return partial results when a leg times out.
+        :param snap: IndexSnapshot object, defaults to the current snapshot.
+        :return: List of (doc_id, doc_title) of the best results, wrapped in NoStore if it is partial.
+        """
+        snap = snapshot if snap is None else snap
+        legs, complete = SearchHandler.run_legs({
+            'body': lambda: BM25.normalize_score(
+                SearchHandler.bm25_search(snap.body_scorer, tokenized_query,
+                                          *SEARCH_BM25_PARAMS["text_inverted_index"], retrieval=retrieval, snap=snap)),
+            'title': lambda: BM25.normalize_score(
+                SearchHandler.bm25_search(snap.title_scorer, tokenized_query,
+                                          *SEARCH_BM25_PARAMS["title_inverted_index_with_stemming"],
+                                          retrieval=retrieval, snap=snap)),
+        }, timeout, allow_partial)
+        res = SearchHandler.merge_legs(tokenized_query, legs['body'], legs['title'], [0.6, 0.3, 0.15, 0.15], snap)
+        return res if complete else NoStore(res)
+
+    @staticmethod
+    def merge_legs(tokenized_query, body_res, title_res, weights, snap=None):
+        """
+        Merges the normalized body and title results with the page rank and page views of the body results.
+        :param tokenized_query: List of tokens.
+        :param body_res: Normalized list of (doc_id, score) of the body.
+        :param title_res: Normalized list of (doc_id, score) of the title.
+        :param weights: List of the body, title, page rank and page views weights.
+        :param snap: IndexSnapshot object of the results, defaults to the current snapshot.
+        :return: List of (doc_id, doc_title) of the best results.
+        """
+        snap = snapshot if snap is None else snap
+        with stage('merge'):
+            page_rank_res = SearchHandler.search_page_rank(
+                set([doc_id for doc_id, _ in body_res] + [doc_id for doc_id, _ in title_res]), normalized=True,
+                snap=snap)
+            page_rank_res = [(body_res[i][0], page_rank_res[i]) for i in range(len(body_res))]
+            page_views_res = SearchHandler.search_page_view(
+                set([doc_id for doc_id, _ in body_res] + [doc_id for doc_id, _ in title_res]), normalized=True,
+                snap=snap)
+            page_views_res = [(body_res[i][0], page_views_res[i]) for i in range(len(body_res))]
+            N = min([10 * len(tokenized_query), 30])
+            res = SearchHandler.multi_merge_results([body_res, title_res, page_rank_res, page_views_res], weights)[:N]
+        with stage('titles'):
+            res = snap.doc_titles.materialize([doc_id for doc_id, _ in res])
         return res
 
     @staticmethod
@@ -181,14 +495,7 @@ class SearchHandler:
         :param N: Maximum number of results.
         :return: List of the merged results, with maximum length of N.
         """
-        merged_scores = defaultdict(int)
-        for tuples_list, weight in zip(scores, weights):
-            for doc_id, score in tuples_list:
-                merged_scores[doc_id] += score * weight
-
-        merged_list = [(k, v) for k, v in sorted(merged_scores.items(), key=lambda item: item[1], reverse=True)]
-
-        return merged_list[:N]
+        return ResultProcessor.multi_merge_results(scores, weights, N)
 
     @staticmethod
     def search_config(query, config):
@@ -198,23 +505,149 @@ class SearchHandler:
         :param config: Dictionary, specifying the configuration.
         :return: List of merged results of the given configuration.
         """
-        tokenized_query = QueryProcessing.tokenize_with_stem(query)
-        body_bm25 = BM25(text_inverted_index, DL, k1=config['body_k'], b=config['body_b'],
-                         folder_name="text_inverted_index")
-        body_res = body_bm25.search(tokenized_query)
-        body_res = body_bm25.normalize_score(body_res)
-        title_bm25 = BM25(title_inverted_index, DL, k1=config['title_k'], b=config['title_b'],
-                          folder_name="title_inverted_index_with_stemming")
-        title_res = title_bm25.search(tokenized_query)
-        title_res = title_bm25.normalize_score(title_res)
-        page_rank_res = SearchHandler.search_page_rank(set([doc_id for doc_id, _ in body_res] +
-                                                           [doc_id for doc_id, _ in title_res]), normalized=True)
-        page_rank_res = [(body_res[i][0], page_rank_res[i]) for i in range(len(body_res))]
-        page_views_res = SearchHandler.search_page_view(
-            set([doc_id for doc_id, _ in body_res] + [doc_id for doc_id, _ in title_res]), normalized=True)
-        page_views_res = [(body_res[i][0], page_views_res[i]) for i in range(len(body_res))]
-        ws = [config['body_w'], config['title_w'], config['page_rank_w'], config['page_views_w']]
-        N = min([10 * len(tokenized_query), 30])
-        res = SearchHandler.multi_merge_results([body_res, title_res, page_rank_res, page_views_res], ws)[:N]
-        res = [(tup[0], doc_titles[tup[0]]) for tup in res]
-        return res
+        with stage('tokenize'):
+            tokenized_query = STEMMED.analyze(query)
+        return result_cache.get_or_compute(('search_config', tuple(tokenized_query), tuple(sorted(config.items()))),
+                                           lambda: SearchHandler._search_config(tokenized_query, config,
+                                                                                SEARCH_LEG_TIMEOUT,
+                                                                                SEARCH_ALLOW_PARTIAL, snapshot))
+
+    @staticmethod
+    def _search_config(tokenized_query, config, timeout=None, allow_partial=False, snap=None):
+        """
+        Runs a search with a given configuration, without the result cache. The body and title legs run concurrently.
+        :param tokenized_query: List of tokens.
+        :param config: Dictionary, specifying the configuration.
+        :param timeout: Seconds to wait for each leg.
+        :param allow_partial: Return partial results when a leg times out.
+        :param snap: IndexSnapshot object, defaults to the current snapshot.
+        :return: List of merged results of the given configuration, wrapped in NoStore if it is partial.
+        """
+        snap = snapshot if snap is None else snap
+        legs, complete = SearchHandler.run_legs({
+            'body': lambda: BM25.normalize_score(
+                snap.body_scorer.search(tokenized_query, config['body_k'], config['body_b'])),
+            'title': lambda: BM25.normalize_score(
+                snap.title_scorer.search(tokenized_query, config['title_k'], config['title_b'])),
+        }, timeout, allow_partial)
+        res = SearchHandler.merge_legs(tokenized_query, legs['body'], legs['title'],
+                                       [config['body_w'], config['title_w'], config['page_rank_w'],
+                                        config['page_views_w']], snap)
+        return res if complete else NoStore(res)
+
+
+def reload_indices():
+    """
+    Reloads the three inverted indices from their local .pkl files (downloading missing ones), the delta segments,
+    the impact indices and the champion tiers into a new snapshot, and drops every cached posting list and result
+    built from the previous indices.
+    """
+    with _update_lock:
+        base_indices = bucket_loader.load_all_indices()
+        generation, segments = segment_store.read()
+        new_snapshot = IndexSnapshot(base_indices, snapshot.base_doc_store, snapshot.base_doc_titles, segments,
+                                     generation)
+        posting_store.invalidate()
+        posting_cache.clear()
+        install_snapshot(new_snapshot)
+
+
+def refresh_segments():
+    """
+    Installs the delta segments if they changed, for example by `python segments.py add` in another process. The
+    base indices and their cached posting lists are kept.
+    :return: True if a new snapshot was installed.
+    """
+    with _update_lock:
+        generation, segments = segment_store.read()
+        if generation == snapshot.generation:
+            return False
+        install_snapshot(snapshot.with_segments(segments, generation))
+        return True
+
+
+def update_documents(docs, deleted=()):
+    """
+    Adds or replaces documents and deletes others, in a new delta segment which is installed at once.
+    :param docs: Iterable of (doc_id, title, text, anchors) tuples, anchors being a list of (linked doc_id,
+                 anchor text).
+    :param deleted: Iterable of doc_ids to delete.
+    :return: the generation of the new snapshot.
+    """
+    with _update_lock:
+        base_df, n_docs = snapshot.base_indices[0].df, len(snapshot.DL)
+        generation, segments = segment_store.add(lambda name: DeltaSegment.build(name, docs, deleted, base_df, n_docs))
+        install_snapshot(snapshot.with_segments(segments, generation))
+    return generation
+
+
+def compact_segments():
+    """
+    Merges the delta segments chosen by the merge policy, and installs the merged segments. The results don't
+    change, but fewer segments are searched.
+    :return: number of merges.
+    """
+    with _update_lock:
+        merges = segment_store.compact()
+        if merges:
+            generation, segments = segment_store.read()
+            install_snapshot(snapshot.with_segments(segments, generation))
+    return merges
+
+
+def _merge_segments_loop(interval):
+    """
+    Background thread of the segments - installs the segments written by other processes and merges them.
+    :param interval: seconds between two checks.
+    """
+    while True:
+        sleep(interval)
+        try:
+            refresh_segments()
+            compact_segments()
+        except Exception as e:
+            print(f"segment merge failed: {e!r}")
+
+
+_merger = None
+
+
+def start_segment_merger(interval=SEGMENT_MERGE_INTERVAL):
+    """
+    Starts the background thread of the segments in this process, unless it is running.
+    :param interval: seconds between two checks, None doesn't start the thread.
+    """
+    global _merger
+    if interval and _merger is None:
+        _merger = threading.Thread(target=_merge_segments_loop, args=(interval,), name="segment-merger", daemon=True)
+        _merger.start()
+
+
+def _after_fork():
+    """
+    Resets the update lock in a forked process, where the parent's thread holding it doesn't exist. The merger thread
+    isn't copied by the fork.
+    """
+    global _update_lock, _merger
+    _update_lock = threading.Lock()
+    _merger = None
+
+
+os.register_at_fork(after_in_child=_after_fork)
+if os.environ.get(PREFORK_ENV) != '1':
+    start_segment_merger()
+
+
+def configure_search_legs(workers=SEARCH_LEG_WORKERS, timeout=SEARCH_LEG_TIMEOUT, allow_partial=SEARCH_ALLOW_PARTIAL):
+    """
+    Changes how the body and title legs of `search` and `search_config` are executed.
+    :param workers: Size of the leg executor, 0 runs the legs one after the other.
+    :param timeout: Seconds to wait for each leg, None to wait for every leg.
+    :param allow_partial: Return the merged result of the legs that finished instead of failing.
+    """
+    global leg_executor, SEARCH_LEG_WORKERS, SEARCH_LEG_TIMEOUT, SEARCH_ALLOW_PARTIAL
+    old_executor = leg_executor
+    leg_executor = ThreadPoolExecutor(workers, thread_name_prefix="search-leg") if workers else None
+    SEARCH_LEG_WORKERS, SEARCH_LEG_TIMEOUT, SEARCH_ALLOW_PARTIAL = workers, timeout, allow_partial
+    if old_executor is not None:
+        old_executor.shutdown(wait=False)
@@ -0,0 +1,182 @@
+import argparse
+import json
+import sys
+from BM25 import BM25
+from analyzer import STEMMED
+from instrumentation import stage
+import backend
+
+CONFIG_KEYS = ('body_k', 'body_b', 'body_w', 'title_k', 'title_b', 'title_w', 'page_rank_w', 'page_views_w')
+BATCH_QUERY_CHUNK = 64  # queries whose postings are held in memory together
+MAP_K = 40
+MAX_BATCH_PAIRS = 10 ** 4  # (query, configuration) pairs of a /search_batch request
+MAX_K = 100  # largest k of a /search_batch request
+
+
+def validate_configs(configs):
+    """
+    Checks that every configuration has all the `search_config` parameters, as numbers.
+    :param configs: List of configuration dictionaries.
+    :return: List of the configurations with float values.
+    """
+    res = []
+    for i, config in enumerate(configs):
+        missing = [key for key in CONFIG_KEYS if key not in config]
+        if missing:
+            raise ValueError(f"config {i} is missing {missing}")
+        res.append({key: float(config[key]) for key in CONFIG_KEYS})
+    return res
+
+
+def parse_request(payload):
+    """
+    Checks the JSON payload of a /search_batch request, and its size.
+    :param payload: the decoded JSON payload, None if the body is not JSON.
+    :return: tuple of (List of queries, List of configurations with float values, evaluate flag, k).
+    """
+    if not isinstance(payload, dict):
+        raise ValueError("the payload must be a JSON object")
+    queries, configs = payload.get('queries', []), payload.get('configs', [])
+    if not isinstance(queries, list) or not all(isinstance(query, str) for query in queries):
+        raise ValueError("queries must be a list of strings")
+    if not isinstance(configs, list) or not all(isinstance(config, dict) for config in configs):
+        raise ValueError("configs must be a list of objects")
+    if len(queries) * len(configs) > MAX_BATCH_PAIRS:
+        raise ValueError(f"{len(queries)} queries x {len(configs)} configs is over {MAX_BATCH_PAIRS} searches")
+    k = payload.get('k', MAP_K)
+    if not isinstance(k, int) or isinstance(k, bool) or not 1 <= k <= MAX_K:
+        raise ValueError(f"k must be an integer between 1 and {MAX_K}")
+    return queries, validate_configs(configs), bool(payload.get('evaluate')), k
+
+
+def average_precision(relevant, predicted, k=MAP_K):
+    """
+    Calculates the average precision at k of a ranked list - the mean of the precision at the rank of every relevant
+    document in the first k results.
+    :param relevant: Iterable of the relevant doc_ids.
+    :param predicted: Ranked list of doc_ids.
+    :param k: Number of results evaluated.
+    :return: float.
+    """
+    relevant = frozenset(relevant)
+    precisions = []
+    for i, doc_id in enumerate(predicted[:k]):
+        if doc_id in relevant:
+            precisions.append((len(precisions) + 1) / (i + 1))
+    return sum(precisions) / len(precisions) if precisions else 0.0
+
+
+def load_qrels(path='queries_train.json'):
+    """
+    Loads the relevant documents of the training queries.
+    :param path: path of a json file of query: list of relevant doc_ids.
+    :return: Dictionary - query: list of relevant doc_ids.
+    """
+    with open(path) as f:
+        return json.load(f)
+
+
+def _load_chunk_postings(tokenized_queries):
+    """
+    Loads the body and title postings of every distinct token of a chunk of queries once.
+    :param tokenized_queries: List of token lists.
+    :return: tuple of (body postings, title postings) dictionaries - token: (doc_ids, tfs).
+    """
+    tokens = []
+    for tokenized_query in tokenized_queries:
+        tokens.extend(tokenized_query)
+    return backend.body_scorer.load_postings(tokens), backend.title_scorer.load_postings(tokens)
+
+
+def _leg_results(scorer, tokenized_query, params, postings, N):
+    """
+    Scores a leg of a query for every distinct (k1, b) pair in one pass, keeping only the top N of every pair.
+    :return: Dictionary - (k1, b): normalized list of (doc_id, score).
+    """
+    postings = {token: postings[token] for token in tokenized_query if token in postings}
+    res = {}
+    with stage('score'):
+        for pairs, candidates, scores in scorer.score_variants(tokenized_query, params, postings):
+            for pair, row in zip(pairs, scores):
+                res[pair] = BM25.normalize_score(scorer.top_n(candidates, row, N))
+    return res
+
+
+def search_batch(queries, configs, N=100):
+    """
+    Runs every query with every configuration, like `search_config` but without a request per pair.
+    The postings of every distinct token are loaded once per chunk of queries, and each distinct (k1, b) pair of the
+    body and the title is scored once per query, with all the pairs in one vectorized pass.
+    :param queries: List of query strings.
+    :param configs: List of configuration dictionaries with the `search_config` parameters.
+    :param N: Number of BM25 results per leg before merging.
+    :return: generator of dictionaries - query, config index and the results as a list of (doc_id, doc_title).
+    """
+    configs = validate_configs(configs)
+    body_params = list(dict.fromkeys((config['body_k'], config['body_b']) for config in configs))
+    title_params = list(dict.fromkeys((config['title_k'], config['title_b']) for config in configs))
+    for start in range(0, len(queries), BATCH_QUERY_CHUNK):
+        chunk = queries[start:start + BATCH_QUERY_CHUNK]
+        with stage('tokenize'):
+            tokenized_queries = [STEMMED.analyze(query) for query in chunk]
+        body_postings, title_postings = _load_chunk_postings(tokenized_queries)
+        for query, tokenized_query in zip(chunk, tokenized_queries):
+            body = _leg_results(backend.body_scorer, tokenized_query, body_params, body_postings, N)
+            title = _leg_results(backend.title_scorer, tokenized_query, title_params, title_postings, N)
+            for i, config in enumerate(configs):
+                res = backend.SearchHandler.merge_legs(tokenized_query, body[(config['body_k'], config['body_b'])],
+                                                       title[(config['title_k'], config['title_b'])],
+                                                       [config['body_w'], config['title_w'], config['page_rank_w'],
+                                                        config['page_views_w']])
+                yield {'query': query, 'config': i, 'results': res}
+
+
+def evaluate_batch(queries, configs, qrels=None, k=MAP_K, N=100):
+    """
+    Runs `search_batch` and adds the average precision at k of every result, followed by the MAP at k of every
+    configuration over the queries that have relevance judgements.
+    :param queries: List of query strings.
+    :param configs: List of configuration dictionaries.
+    :param qrels: Dictionary - query: list of relevant doc_ids, None to skip the evaluation.
+    :param k: Number of results evaluated.
+    :param N: Number of BM25 results per leg before merging.
+    :return: generator of the `search_batch` dictionaries, then one summary dictionary per configuration.
+    """
+    totals = [[0.0, 0] for _ in configs]
+    for line in search_batch(queries, configs, N):
+        if qrels is not None and line['query'] in qrels:
+            ap = average_precision(qrels[line['query']], [doc_id for doc_id, _ in line['results']], k)
+            line['ap'] = ap
+            totals[line['config']][0] += ap
+            totals[line['config']][1] += 1
+        yield line
+    if qrels is not None:
+        for i, (config, (total, n)) in enumerate(zip(configs, totals)):
+            yield {'config': i, 'params': config, f'map@{k}': total / n if n else None, 'queries': n}
+
+
+def to_ndjson(lines):
+    """
+    Serializes dictionaries as newline delimited JSON.
+    :param lines: Iterable of dictionaries.
+    :return: generator of strings, one JSON object per line.
+    """
+    for line in lines:
+        yield json.dumps(line) + '\n'
+
+
+if __name__ == '__main__':
+    # python batch.py --configs configs.json [--queries queries_train.json] [--evaluate] - writes NDJSON to stdout.
+    parser = argparse.ArgumentParser(description='Runs many queries with many search_config configurations.')
+    parser.add_argument('--queries', default='queries_train.json', help='json list of queries, or query: relevant')
+    parser.add_argument('--configs', required=True, help='json list of configurations')
+    parser.add_argument('--evaluate', action='store_true', help='add AP and MAP against the queries file')
+    parser.add_argument('--k', type=int, default=MAP_K)
+    args = parser.parse_args()
+    with open(args.queries) as f:
+        loaded = json.load(f)
+    with open(args.configs) as f:
+        batch_configs = json.load(f)
+    batch_qrels = loaded if args.evaluate and isinstance(loaded, dict) else None
+    for ndjson_line in to_ndjson(evaluate_batch(list(loaded), batch_configs, batch_qrels, args.k)):
+        sys.stdout.write(ndjson_line)
@@ -0,0 +1,402 @@
+"""
+Benchmark and load-replay suite.
+
+    python benchmark.py replay --queries queries_train.json --target inprocess --concurrency 4 --output run.json
+    python benchmark.py replay --queries queries_train.json --target http://localhost:8080 --mode open --rate 20
+    python benchmark.py micro --output micro.json
+    python benchmark.py compare baseline.json run.json --threshold 0.1
+
+`--local-bucket DIR` serves the bucket from a local directory (see local_bucket.py), so the in-process and flask
+targets run offline.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter, sleep, time
+import numpy as np
+from local_bucket import LOCAL_BUCKET_ENV
+from instrumentation import metrics, trace
+from cache import result_cache
+
+ENDPOINTS = ('search', 'search_body', 'search_title', 'search_anchor')
+
+
+def load_queries(path):
+    """
+    Loads a query log.
+    :param path: .json file of query: relevant doc_ids (like queries_train.json), or .jsonl file with a `query` field
+                 and an optional `endpoint` field on every line.
+    :return: List of (endpoint or None, query).
+    """
+    if path.endswith('.jsonl'):
+        queries = []
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    queries.append((record.get('endpoint'), record['query']))
+        return queries
+    with open(path) as f:
+        return [(None, query) for query in json.load(f)]
+
+
+def peak_rss_mb():
+    """
+    :return: peak resident set size of this process in MB.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if platform.system() == 'Darwin' else peak / 2 ** 10
+
+
+class InProcessTarget:
+    """ Calls SearchHandler directly. Importing the backend loads all the indices. """
+
+    def __init__(self):
+        from backend import SearchHandler
+        self.handler = SearchHandler
+
+    def call(self, endpoint, query):
+        with trace(f'/{endpoint}'):
+            return getattr(self.handler, endpoint)(query)
+
+
+class FlaskTarget:
+    """ Calls the Flask app through its test client, including routing and JSON serialization. """
+
+    def __init__(self):
+        from search_frontend import app
+        self.client = app.test_client()
+
+    def call(self, endpoint, query):
+        response = self.client.get(f'/{endpoint}', query_string={'query': query})
+        if response.status_code != 200:
+            raise RuntimeError(f'{endpoint} returned {response.status_code}')
+        return response.get_json()
+
+
+class HttpTarget:
+    """ Calls a running server over HTTP. """
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+
+    def call(self, endpoint, query):
+        url = f'{self.base_url}/{endpoint}?{urllib.parse.urlencode({"query": query})}'
+        with urllib.request.urlopen(url, timeout=60) as response:
+            return json.loads(response.read())
+
+
+def make_target(name):
+    """
+    :param name: 'inprocess', 'flask' or a base URL.
+    :return: target object with a call(endpoint, query) method.
+    """
+    if name == 'inprocess':
+        return InProcessTarget()
+    if name == 'flask':
+        return FlaskTarget()
+    return HttpTarget(name)
+
+
+def build_schedule(queries, endpoints, n_requests, seed=0):
+    """
+    Builds the list of requests to replay, cycling over the query log.
+    :param queries: List of (endpoint or None, query).
+    :param endpoints: endpoints for queries that do not name one.
+    :param n_requests: number of requests, 0 for one pass over the log per endpoint.
+    :param seed: random seed of the endpoint choice.
+    :return: List of (endpoint, query).
+    """
+    if n_requests <= 0:
+        return [(endpoint or e, query) for endpoint, query in queries for e in ([endpoint] if endpoint else endpoints)]
+    rnd = random.Random(seed)
+    return [(queries[i % len(queries)][0] or rnd.choice(endpoints), queries[i % len(queries)][1])
+            for i in range(n_requests)]
+
+
+def replay(target, schedule, concurrency=1, mode='closed', rate=10.0, seed=0):
+    """
+    Replays requests against a target.
+    In closed-loop mode `concurrency` clients send the next request as soon as the previous one returns.
+    In open-loop mode requests arrive as a Poisson process of `rate` requests per second, independently of the
+    responses, and latency is measured from the arrival time so queueing delay is included.
+    :param target: target object.
+    :param schedule: List of (endpoint, query).
+    :param concurrency: number of concurrent clients (closed) or maximum outstanding requests (open).
+    :param mode: 'closed' or 'open'.
+    :param rate: arrival rate in requests per second, for open-loop mode.
+    :param seed: random seed of the arrivals.
+    :return: tuple of (List of (endpoint, latency_seconds, ok), wall time in seconds).
+    """
+    samples = []
+    lock = threading.Lock()
+
+    def run(endpoint, query, arrival):
+        ok = True
+        try:
+            target.call(endpoint, query)
+        except Exception as e:
+            ok = False
+            print(f'{endpoint} {query!r} failed: {e}', file=sys.stderr)
+        latency = perf_counter() - arrival
+        with lock:
+            samples.append((endpoint, latency, ok))
+
+    start = perf_counter()
+    if mode == 'closed':
+        position = iter(range(len(schedule)))
+
+        def client():
+            for i in position:
+                run(*schedule[i], perf_counter())
+
+        threads = [threading.Thread(target=client) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    else:
+        rnd = random.Random(seed)
+        with ThreadPoolExecutor(concurrency) as executor:
+            arrival = perf_counter()
+            for endpoint, query in schedule:
+                arrival += rnd.expovariate(rate)
+                delay = arrival - perf_counter()
+                if delay > 0:
+                    sleep(delay)
+                executor.submit(run, endpoint, query, arrival)
+    return samples, perf_counter() - start
+
+
+def summarize(samples, wall_time):
+    """
+    Summarizes latency samples per endpoint.
+    :param samples: List of (endpoint, latency_seconds, ok).
+    :param wall_time: duration of the run in seconds.
+    :return: Dictionary - endpoint (and 'all'): statistics.
+    """
+    groups = {}
+    for endpoint, latency, ok in samples:
+        groups.setdefault(endpoint, []).append((latency, ok))
+    groups['all'] = [(latency, ok) for _, latency, ok in samples]
+    summary = {}
+    for endpoint, values in groups.items():
+        latencies = np.array([latency for latency, _ in values]) * 1000
+        summary[endpoint] = {
+            'requests': len(values),
+            'errors': sum(1 for _, ok in values if not ok),
+            'qps': len(values) / wall_time if wall_time else 0.0,
+            'mean_ms': float(latencies.mean()) if len(latencies) else 0.0,
+            'p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else 0.0,
+            'p95_ms': float(np.percentile(latencies, 95)) if len(latencies) else 0.0,
+            'p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else 0.0,
+        }
+    return summary
+
+
+def time_call(fn, repeat=20):
+    """
+    Times a function.
+    :param fn: function with no arguments.
+    :param repeat: number of calls.
+    :return: Dictionary of the best and median call time in milliseconds.
+    """
+    fn()
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        fn()
+        times.append((perf_counter() - start) * 1000)
+    return {'best_ms': min(times), 'median_ms': float(np.median(times))}
+
+
+def micro_benchmarks(n_postings=1_000_000, n_docs=5_000_000, seed=0):
+    """
+    Runs microbenchmarks of the hot paths on synthetic data, without the indices or the bucket.
+    :param n_postings: length of the synthetic posting lists.
+    :param n_docs: size of the synthetic document collection.
+    :param seed: random seed.
+    :return: Dictionary - benchmark name: timings.
+    """
+    from BM25 import BM25Scorer
+    from tfidf import TfIdfScorer
+    from impact_index import ImpactIndex, ImpactIndexWriter
+    from boolean_ranker import BooleanRanker
+    from title_store import TitleStore
+    from doc_store import DocumentStore
+    from helperClasses import Calculator, ResultProcessor
+    from loader import BucketIndexLoader
+    from multifilereader import POSTING_DTYPE
+    from posting_compression import encode_postings, decode_postings
+
+    rng = np.random.default_rng(seed)
+    doc_ids = np.sort(rng.choice(n_docs * 4, size=n_postings, replace=False)).astype(np.int64)
+    tfs = rng.integers(1, 50, size=n_postings).astype(np.int32)
+    raw = np.empty(n_postings, dtype=POSTING_DTYPE)
+    raw['doc_id'], raw['tf'] = doc_ids, tfs
+    raw = raw.tobytes()
+    encoded = encode_postings(doc_ids, tfs)
+    encoded = encoded.tobytes()
+
+    class _Index:
+        df = {'a': n_postings, 'b': n_postings // 10}
+        posting_locs = {}
+
+    store = DocumentStore.build({'DL': dict(zip(range(0, n_docs * 4, 4), rng.integers(1, 2000, size=n_docs))),
+                                 'doc_norms': dict(zip(range(0, n_docs * 4, 4), rng.random(n_docs) + 0.5))},
+                                dtypes={'DL': np.uint32, 'doc_norms': np.float64})
+    scorer = BM25Scorer(_Index(), store, folder_name='benchmark')
+    tfidf_scorer = TfIdfScorer(_Index(), store, folder_name='benchmark')
+    postings = {'a': (doc_ids, tfs), 'b': (doc_ids[::10], tfs[::10])}
+    impact_dir = tempfile.mkdtemp()
+    contributions = {token: scorer.contributions(d, t, scorer.calc_idf([token])[token], 5, 0.2)
+                     for token, (d, t) in postings.items()}
+    writer = ImpactIndexWriter('benchmark', store, 5, 0.2, max(c.max() for c in contributions.values()) / 255,
+                               directory=impact_dir)
+    for token, (d, _) in postings.items():
+        writer.add(token, d, contributions[token])
+    writer.close()
+    impacts = ImpactIndex('benchmark', store, directory=impact_dir)
+    titles = TitleStore(store, np.empty(0, dtype=np.uint8), np.zeros(len(store.ids) + 1, dtype=np.int64),
+                        np.ones(len(store.ids), dtype=bool))
+    ranker = BooleanRanker(_Index(), store, titles, folder_name='benchmark')
+
+    n_small = 20000
+    D = {doc_id: {'a': 0.1, 'b': 0.2} for doc_id in doc_ids[:n_small].tolist()}
+    Q = {'a': 0.5, 'b': 0.7}
+    norms = {doc_id: 1.0 for doc_id in D}
+    lists = [[(doc_id, float(score)) for doc_id, score in zip(doc_ids[:100].tolist(), rng.random(100))]
+             for _ in range(4)]
+
+    results = {
+        'decode_raw_postings': dict(time_call(lambda: BucketIndexLoader.decode_posting_arrays(raw, n_postings)),
+                                    postings=n_postings),
+        'decode_varint_postings': dict(time_call(lambda: decode_postings(encoded)), postings=n_postings),
+        'bm25_score': dict(time_call(lambda: scorer.score(['a', 'b'], 5, 0.2, postings)), postings=n_postings * 1.1),
+        'bm25_search': dict(time_call(lambda: scorer.top_n(*scorer.score(['a', 'b'], 5, 0.2, postings))),
+                            postings=n_postings * 1.1),
+        'impact_search': dict(time_call(lambda: impacts.search(['a', 'b'])), postings=n_postings * 1.1),
+        'boolean_rank': dict(time_call(lambda: ranker.rank(['a', 'b'], postings)), postings=n_postings * 1.1),
+        'tfidf_score': dict(time_call(lambda: tfidf_scorer.score(['a', 'b'], postings)), postings=n_postings * 1.1),
+        'cosine_similarity': dict(time_call(lambda: Calculator.dict_cosine_similarity(D, Q, norms), repeat=5),
+                                  documents=n_small),
+        'multi_merge_results': dict(time_call(lambda: ResultProcessor.multi_merge_results(lists, [.6, .3, .15, .15]),
+                                              repeat=200), lists=len(lists)),
+    }
+    shutil.rmtree(impact_dir, ignore_errors=True)
+    return results
+
+
+def compare(baseline, current, threshold=0.1):
+    """
+    Compares two benchmark result files.
+    :param baseline: Dictionary loaded from a baseline result file.
+    :param current: Dictionary loaded from a newer result file.
+    :param threshold: relative slowdown reported as a regression.
+    :return: List of regression descriptions.
+    """
+    regressions = []
+    for section, lower_is_better in (('replay', ('p50_ms', 'p95_ms', 'p99_ms')), ('micro', ('median_ms',))):
+        for name, stats in baseline.get(section, {}).items():
+            new_stats = current.get(section, {}).get(name)
+            if new_stats is None:
+                continue
+            for metric in lower_is_better:
+                old, new = stats.get(metric), new_stats.get(metric)
+                if old and new is not None and new > old * (1 + threshold):
+                    regressions.append(f'{section}.{name}.{metric}: {old:.2f} -> {new:.2f} (+{new / old - 1:.0%})')
+            if section == 'replay':
+                old, new = stats.get('qps'), new_stats.get('qps')
+                if old and new is not None and new < old * (1 - threshold):
+                    regressions.append(f'{section}.{name}.qps: {old:.2f} -> {new:.2f} ({new / old - 1:.0%})')
+    return regressions
+
+
+def _write(result, path):
+    text = json.dumps(result, indent=2)
+    if path:
+        with open(path, 'w') as f:
+            f.write(text)
+    print(text)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    replay_parser = commands.add_parser('replay', help='replay a query log against a target')
+    replay_parser.add_argument('--queries', default='queries_train.json')
+    replay_parser.add_argument('--target', default='inprocess', help="'inprocess', 'flask' or a base URL")
+    replay_parser.add_argument('--endpoints', default=','.join(ENDPOINTS))
+    replay_parser.add_argument('--requests', type=int, default=0, help='0 replays the log once per endpoint')
+    replay_parser.add_argument('--concurrency', type=int, default=1)
+    replay_parser.add_argument('--mode', choices=('closed', 'open'), default='closed')
+    replay_parser.add_argument('--rate', type=float, default=10.0, help='arrivals per second in open-loop mode')
+    replay_parser.add_argument('--warmup', type=int, default=0, help='requests sent before measuring')
+    replay_parser.add_argument('--no-result-cache', action='store_true',
+                               help='disable the result cache of the inprocess and flask targets, to measure cold paths')
+    replay_parser.add_argument('--seed', type=int, default=0)
+    replay_parser.add_argument('--local-bucket', help='directory standing in for the GCS bucket')
+    replay_parser.add_argument('--output')
+    micro_parser = commands.add_parser('micro', help='run microbenchmarks on synthetic data')
+    micro_parser.add_argument('--postings', type=int, default=1_000_000)
+    micro_parser.add_argument('--output')
+    compare_parser = commands.add_parser('compare', help='compare two result files')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    if args.command == 'compare':
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        regressions = compare(baseline, current, args.threshold)
+        print('\n'.join(regressions) if regressions else 'no regressions')
+        return 1 if regressions else 0
+
+    result = {'created': time(), 'python': platform.python_version(), 'argv': sys.argv[1:]}
+    if args.command == 'micro':
+        result['micro'] = micro_benchmarks(args.postings)
+    else:
+        if args.local_bucket:
+            os.environ[LOCAL_BUCKET_ENV] = args.local_bucket
+        target = make_target(args.target)
+        in_process = args.target in ('inprocess', 'flask')
+        if in_process and args.no_result_cache:
+            result_cache.max_entries = 0
+        schedule = build_schedule(load_queries(args.queries), args.endpoints.split(','), args.requests, args.seed)
+        if args.warmup:
+            replay(target, schedule[:args.warmup], args.concurrency)
+            metrics.reset()
+        if in_process:
+            # The warmup replays the head of the schedule, whose results must not be served from the cache.
+            result_cache.invalidate()
+            cache_before = result_cache.stats()
+        samples, wall_time = replay(target, schedule, args.concurrency, args.mode, args.rate, args.seed)
+        result['replay'] = summarize(samples, wall_time)
+        if in_process:
+            cache_after = result_cache.stats()
+            result['result_cache'] = {name: cache_after[name] - cache_before[name]
+                                      for name in ('hits', 'misses', 'coalesced')}
+        result['stages'] = metrics.stage_summary()  # empty for HTTP targets, the server has its own /metrics
+        result['config'] = {'target': args.target, 'concurrency': args.concurrency, 'mode': args.mode,
+                            'rate': args.rate, 'requests': len(schedule),
+                            'result_cache': not args.no_result_cache}
+    result['peak_rss_mb'] = peak_rss_mb()
+    _write(result, args.output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,378 @@
+import fcntl
+import os
+import sys
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+from google.cloud import storage
+from multifilereader import BLOCK_SIZE
+from inverted_index_gcp import TUPLE_SIZE
+from posting_store import posting_store
+from local_bucket import LocalClient, local_bucket_dir
+from instrumentation import count
+
+BUCKET_NAME = "project_bucket_316533942"
+BLOCK_BYTES = 2 ** 18  # bytes of a cached block, the unit of the ranged reads
+BLOCK_CACHE_DIR = "block_cache"
+BLOCK_CACHE_BYTES = 2 * 2 ** 30  # disk quota of the cached blocks
+PREFETCH_WORKERS = 4
+PREFETCH_FRACTION = 0.5  # share of the disk quota the prefetch may fill
+HTTP_POOL_SIZE = 32  # connections of the shared storage client
+STALE_PART_SECONDS = 3600  # age of a partial download that is no longer in progress
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def shared_client():
+    """
+    Returns the storage client shared by the whole process, creating it on the first call. Its HTTP session keeps a
+    pool of HTTP_POOL_SIZE connections, so concurrent ranged reads reuse connections.
+    :return: google.cloud.storage.Client, or LocalClient when a local bucket directory is set.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            local_dir = local_bucket_dir()
+            if local_dir:
+                _client = LocalClient(local_dir)
+            else:
+                _client = storage.Client()
+                session = getattr(_client, '_http', None)
+                if session is not None and hasattr(session, 'mount'):
+                    from requests.adapters import HTTPAdapter
+                    session.mount('https://', HTTPAdapter(pool_connections=HTTP_POOL_SIZE,
+                                                          pool_maxsize=HTTP_POOL_SIZE))
+        return _client
+
+
+def _after_fork():
+    """
+    Drops the shared client in a forked process, so it doesn't share the parent's HTTP connections, and resets its
+    lock, which a thread of the parent may hold.
+    """
+    global _client, _client_lock
+    _client = None
+    _client_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+class _Fetch:
+    """ A block download in progress, which concurrent readers of the block wait for. """
+
+    __slots__ = ('event', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.error = None
+
+
+class BlockStore:
+    """
+    Local block cache of the posting (.bin) files in the bucket.
+    Posting lists are read with ranged reads of the BLOCK_BYTES blocks that hold them, instead of downloading whole
+    files. Blocks are kept in `cache_dir` up to `max_bytes`, and the least recently used blocks are removed above it.
+    Cached blocks are read through the memory-mapped posting store. Concurrent readers of a block share one download.
+    Processes may share the cache directory (the workers of serve.py): the quota is kept for the whole directory, with
+    the usage in a `.usage` file updated under a lock file, and the eviction orders the blocks by their modification
+    time, which is touched on every hit. A block removed by another process is downloaded again.
+    """
+
+    def __init__(self, bucket_name=BUCKET_NAME, cache_dir=BLOCK_CACHE_DIR, max_bytes=BLOCK_CACHE_BYTES,
+                 block_bytes=BLOCK_BYTES, client=None):
+        self.bucket_name = bucket_name
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.block_bytes = block_bytes
+        self._client = client
+        self._bucket = None
+        self._blocks = OrderedDict()  # block file name: size, least recently used first
+        self._fetching = {}
+        self._lock = threading.Lock()
+        self._disk_lock = threading.Lock()
+        self._prefetch = None
+        self.n_bytes = 0  # bytes of the whole cache directory, as of the last update of the usage
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.downloaded_bytes = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self._scan()
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    @property
+    def bucket(self):
+        if self._bucket is None:
+            self._bucket = (self._client or shared_client()).bucket(self.bucket_name)
+        return self._bucket
+
+    def _scan(self):
+        """
+        Indexes the blocks already in the cache directory and keeps them within the quota.
+        """
+        with self._disk_locked():
+            self._write_usage(self._evict(self.max_bytes))
+
+    @contextmanager
+    def _disk_locked(self):
+        """
+        Holds the lock of the cache directory, which serializes the usage updates and the eviction between the
+        threads and the processes sharing the directory.
+        """
+        with self._disk_lock:
+            with open(os.path.join(self.cache_dir, '.lock'), 'a') as f:
+                fcntl.lockf(f, fcntl.LOCK_EX)
+                yield  # closing the file releases the lock
+
+    def _read_usage(self):
+        """
+        :return: bytes of the blocks in the cache directory, or None if the usage file is missing.
+        """
+        try:
+            with open(os.path.join(self.cache_dir, '.usage')) as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return None
+
+    def _write_usage(self, usage):
+        with open(os.path.join(self.cache_dir, '.usage'), 'w') as f:
+            f.write(str(usage))
+
+    def _add_usage(self, n_bytes):
+        """
+        Adds downloaded bytes to the usage of the cache directory, and evicts blocks when it is above the quota.
+        """
+        with self._disk_locked():
+            usage = self._read_usage()
+            if usage is None or usage + n_bytes > self.max_bytes:
+                usage = self._evict(self.max_bytes)
+            else:
+                usage += n_bytes
+            self._write_usage(usage)
+        with self._lock:
+            self.n_bytes = usage
+
+    def _forget(self, name):
+        """
+        Drops a block that was removed by another process from the index.
+        """
+        with self._lock:
+            size = self._blocks.pop(name, None)
+            if size is not None:
+                self.n_bytes -= size
+        posting_store.invalidate(os.path.join(self.cache_dir, name))
+
+    @staticmethod
+    def block_name(folder_name, f_name, block):
+        return f"{folder_name}_{f_name}.{block}"
+
+    def blocks_of(self, locs, n_bytes, folder_name):
+        """
+        Lists the blocks holding a posting list.
+        :param locs: List of (file_name, offset) tuples, as stored in InvertedIndex.posting_locs.
+        :param n_bytes: Number of bytes of the posting list.
+        :param folder_name: folder name
+        :return: List of (file_name, offset, n_read, first block, last block) per location.
+        """
+        res = []
+        for f_name, offset in locs:
+            if n_bytes <= 0:
+                break
+            n_read = min(n_bytes, BLOCK_SIZE - offset)
+            res.append((f_name, offset, n_read, offset // self.block_bytes, (offset + n_read - 1) // self.block_bytes))
+            n_bytes -= n_read
+        return res
+
+    def read(self, locs, n_bytes, folder_name):
+        """
+        Reads n_bytes of a posting list, spread over the given locations, downloading the missing blocks.
+        :param locs: List of (file_name, offset) tuples.
+        :param n_bytes: Number of bytes to read.
+        :param folder_name: folder name
+        :return: memoryview of the posting list bytes.
+        """
+        chunks = []
+        for f_name, offset, n_read, first, last in self.blocks_of(locs, n_bytes, folder_name):
+            for block in range(first, last + 1):
+                start = max(offset, block * self.block_bytes)
+                end = min(offset + n_read, (block + 1) * self.block_bytes)
+                try:
+                    path = self.fetch(folder_name, f_name, block)
+                    chunk = posting_store.read_range(path, start - block * self.block_bytes, end - start)
+                except FileNotFoundError:  # evicted by another thread or process in between
+                    self._forget(self.block_name(folder_name, f_name, block))
+                    path = self.fetch(folder_name, f_name, block)
+                    chunk = posting_store.read_range(path, start - block * self.block_bytes, end - start)
+                chunks.append(chunk)
+        if len(chunks) == 1:
+            return chunks[0]
+        return memoryview(b''.join(chunks))
+
+    def fetch(self, folder_name, f_name, block):
+        """
+        Makes sure a block is cached, downloading it if it is missing.
+        :return: path of the cached block.
+        """
+        name = self.block_name(folder_name, f_name, block)
+        path = os.path.join(self.cache_dir, name)
+        with self._lock:
+            cached = name in self._blocks
+            if cached:
+                self._blocks.move_to_end(name)
+                self.hits += 1
+        if cached:
+            try:
+                os.utime(path)  # the modification time orders the blocks of every process for the eviction
+            except FileNotFoundError:  # evicted by another process
+                self._forget(name)
+                return self.fetch(folder_name, f_name, block)
+            count('blocks_cache')
+            return path
+        with self._lock:
+            fetch = self._fetching.get(name)
+            leader = fetch is None
+            if leader:
+                fetch = self._fetching[name] = _Fetch()
+                self.misses += 1
+        if not leader:
+            fetch.event.wait()
+            if fetch.error is not None:
+                raise fetch.error
+            return path
+        try:
+            start = block * self.block_bytes
+            blob = self.bucket.blob(f"postings_gcp/{folder_name}/{f_name}")
+            data = blob.download_as_bytes(start=start, end=start + self.block_bytes - 1)
+            count('blocks_bucket')
+            tmp_path = f"{path}.{threading.get_ident()}.part"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            with self._lock:
+                self._blocks[name] = len(data)
+                self.downloaded_bytes += len(data)
+            self._add_usage(len(data))
+        except BaseException as e:
+            fetch.error = e
+            raise
+        finally:
+            with self._lock:
+                self._fetching.pop(name, None)
+            fetch.event.set()
+        return path
+
+    def _evict(self, max_bytes):
+        """
+        Indexes the blocks in the cache directory, least recently used first, removes the least recently used blocks
+        above `max_bytes` and the abandoned partial downloads. Must be called while holding the disk lock.
+        :return: bytes of the remaining blocks.
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.startswith('.'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                st = os.stat(path)
+                if name.endswith('.part'):
+                    if time() - st.st_mtime > STALE_PART_SECONDS:
+                        os.remove(path)
+                    continue
+            except FileNotFoundError:  # removed by another process
+                continue
+            entries.append((st.st_mtime_ns, name, st.st_size))
+        entries.sort()
+        usage = sum(size for _, _, size in entries)
+        blocks = OrderedDict()
+        evictions = 0
+        for _, name, size in entries:
+            if usage <= max_bytes:
+                blocks[name] = size
+                continue
+            usage -= size
+            evictions += 1
+            path = os.path.join(self.cache_dir, name)
+            posting_store.invalidate(path)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        with self._lock:
+            self._blocks = blocks
+            self.n_bytes = usage
+            self.evictions += evictions
+        return usage
+
+    def prefetch(self, indices, fraction=PREFETCH_FRACTION, workers=PREFETCH_WORKERS):
+        """
+        Downloads the blocks of the most frequent terms (by df) of the given indices in the background, until they
+        fill `fraction` of the quota. Files which were downloaded whole are skipped. Does nothing if a prefetch is
+        already running.
+        :param indices: List of (InvertedIndex object, folder name).
+        :param fraction: share of the quota to fill.
+        :param workers: concurrent downloads.
+        :return: the prefetch thread, or None if a prefetch is already running.
+        """
+        if self._prefetch is not None and self._prefetch.is_alive():
+            return None
+        self._prefetch = threading.Thread(target=self._run_prefetch, args=(indices, fraction, workers),
+                                          name="block-prefetch", daemon=True)
+        self._prefetch.start()
+        return self._prefetch
+
+    def _run_prefetch(self, indices, fraction, workers):
+        budget = int(self.max_bytes * fraction) // self.block_bytes
+        terms = sorted(((df, token, index, folder_name) for index, folder_name in indices
+                        for token, df in index.df.items() if token in index.posting_locs),
+                       key=lambda term: term[0], reverse=True)
+        blocks = {}
+        for df, token, index, folder_name in terms:
+            if len(blocks) >= budget:
+                break
+            for f_name, _, _, first, last in self.blocks_of(index.posting_locs[token], df * TUPLE_SIZE, folder_name):
+                if not os.path.exists(f"{folder_name}_{f_name}"):
+                    for block in range(first, last + 1):
+                        blocks[(folder_name, f_name, block)] = None
+        try:
+            with ThreadPoolExecutor(workers, thread_name_prefix="block-prefetch") as executor:
+                for future in [executor.submit(self.fetch, *key) for key in blocks]:
+                    future.result()
+        except Exception as e:
+            print(f"block prefetch stopped: {e!r}", file=sys.stderr)
+            return
+        print(f"prefetched {len(blocks)} blocks")
+
+    def _after_fork(self):
+        """
+        Resets the locks, the downloads in progress and the bucket of a forked process, and indexes the blocks again.
+        """
+        self._lock = threading.Lock()
+        self._disk_lock = threading.Lock()
+        self._fetching = {}
+        self._prefetch = None
+        self._bucket = None
+        self._scan()
+
+    def clear(self):
+        """
+        Removes every cached block.
+        """
+        with self._disk_locked():
+            self._write_usage(self._evict(0))
+
+    def stats(self):
+        """
+        :return: dictionary of the block cache counters.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'blocks': len(self._blocks), 'bytes': self.n_bytes, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'downloaded_bytes': self.downloaded_bytes, 'hit_rate': self.hits / lookups if lookups else 0.0}
+
+
+block_store = BlockStore()
@@ -0,0 +1,70 @@
+import threading
+import numpy as np
+from loader import BucketIndexLoader
+from inverted_index_gcp import InvertedIndex
+from instrumentation import count
+
+MAX_QUERY_TERMS = 2 ** 16 - 1  # distinct terms a uint16 match count can hold
+
+_local = threading.local()
+
+
+class BooleanRanker:
+    """
+    Ranks all the documents that match a query by the number of distinct query terms they contain, used by
+    `search_title` and `search_anchor`.
+    Matches are counted in a per-thread dense count array indexed by dense id, and only documents with a title are
+    kept, by the presence mask of the TitleStore. Documents with the same count keep the order in which they were first
+    matched, and the full result is ordered by a stable counting (radix) sort of the counts.
+    """
+
+    def __init__(self, index: InvertedIndex, doc_store, title_store, folder_name):
+        self.index = index
+        self.doc_store = doc_store
+        self.title_store = title_store
+        self.folder_name = folder_name
+
+    def _counts(self):
+        """
+        Returns the count array of the current thread, shared by the rankers of the same document store. It is all
+        zero between queries.
+        :return: numpy array of uint16 counts.
+        """
+        n_docs = len(self.doc_store.ids)
+        counts = getattr(_local, 'counts', None)
+        if counts is None or len(counts) != n_docs:
+            counts = _local.counts = np.zeros(n_docs, dtype=np.uint16)
+        return counts
+
+    def rank(self, query_tokens, postings=None):
+        """
+        Ranks the documents matching the query.
+        :param query_tokens: List of tokens, repeated tokens count once.
+        :param postings: Optional dictionary of already loaded postings - token: (doc_ids, tfs).
+        :return: numpy array of doc_ids, ordered by decreasing number of matched terms.
+        """
+        if postings is None:
+            tokens = [token for token in dict.fromkeys(query_tokens) if token in self.index.posting_locs]
+        else:
+            tokens = [token for token in dict.fromkeys(query_tokens) if token in postings]
+        tokens = tokens[:MAX_QUERY_TERMS]
+        counts = self._counts()
+        matched = []
+        try:
+            for token in tokens:
+                if postings is None:
+                    doc_ids, _ = BucketIndexLoader.load_posting_arrays_for_token(token, self.index, self.folder_name)
+                else:
+                    doc_ids, _ = postings[token]
+                pos, found = self.doc_store.dense_ids(doc_ids)
+                pos = pos[found & self.title_store.mask[pos]]
+                matched.append(pos[counts[pos] == 0])  # first matched by this term
+                counts[pos] += 1  # doc_ids of a term are distinct
+            candidates = np.concatenate(matched) if matched else np.empty(0, dtype=np.int64)
+            count('candidates', len(candidates))
+            # A stable sort of 16 bit keys is a radix sort in numpy.
+            order = np.argsort(np.uint16(len(tokens)) - counts[candidates], kind='stable')
+            return self.doc_store.ids[candidates[order]]
+        finally:
+            for pos in matched:
+                counts[pos] = 0
@@ -0,0 +1,263 @@
+import os
+import threading
+from collections import OrderedDict
+from time import perf_counter, monotonic
+from instrumentation import count
+
+POSTING_CACHE_BYTES = 512 * 2 ** 20
+EVICTION_SAMPLE = 16
+RESULT_CACHE_ENTRIES = 10000
+RESULT_CACHE_TTL = 600.0
+
+
+class PostingListCache:
+    """
+    Thread-safe cache of decoded posting lists, keyed by (folder_name, token).
+    The cache is bounded by the total size of the cached arrays. By default the least recently used list is evicted.
+    In cost-aware mode the eviction victim is chosen among the EVICTION_SAMPLE least recently used lists, by the
+    GreedyDual-Size priority (load cost per byte), so long lists which are expensive to rebuild stay longer.
+    """
+
+    def __init__(self, max_bytes=POSTING_CACHE_BYTES, cost_aware=False):
+        self.max_bytes = max_bytes
+        self.cost_aware = cost_aware
+        self._entries = OrderedDict()  # key: [value, n_bytes, cost, priority]
+        self._lock = threading.Lock()
+        self._inflation = 0.0
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+        Returning a cached value and marking it as recently used.
+        :param key: (folder_name, token)
+        :return: the cached value, or None if it is not cached.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            count('lists_cache')
+            entry[3] = self._inflation + entry[2] / max(entry[1], 1)
+            return entry[0]
+
+    def contains(self, key):
+        """
+        Checking if a value is cached, without counting a lookup or marking it as recently used.
+        :param key: (folder_name, token)
+        :return: Boolean.
+        """
+        with self._lock:
+            return key in self._entries
+
+    def put(self, key, value, cost=0.0):
+        """
+        Caching a tuple of numpy arrays. The arrays are made read-only, since they are shared between requests.
+        :param key: (folder_name, token)
+        :param value: tuple of numpy arrays.
+        :param cost: the time it took to build the value, used in cost-aware mode.
+        """
+        n_bytes = sum(arr.nbytes for arr in value)
+        if n_bytes > self.max_bytes:
+            return
+        for arr in value:
+            arr.setflags(write=False)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.n_bytes -= old[1]
+            while self._entries and self.n_bytes + n_bytes > self.max_bytes:
+                self._evict_one()
+            self._entries[key] = [value, n_bytes, cost, self._inflation + cost / max(n_bytes, 1)]
+            self.n_bytes += n_bytes
+
+    def get_or_load(self, key, load):
+        """
+        Returning a cached value, or building it with `load` and caching it.
+        The lock is not held while loading, so a slow load does not block other requests.
+        :param key: (folder_name, token)
+        :param load: function with no arguments, returning a tuple of numpy arrays.
+        :return: the value.
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+        start = perf_counter()
+        value = load()
+        self.put(key, value, perf_counter() - start)
+        return value
+
+    def clear(self, folder_name=None):
+        """
+        Removing all the cached lists, or only those of one index folder.
+        :param folder_name: folder name, or None for all folders.
+        """
+        with self._lock:
+            if folder_name is None:
+                self._entries.clear()
+                self.n_bytes = 0
+                return
+            for key in [key for key in self._entries if key[0] == folder_name]:
+                self.n_bytes -= self._entries.pop(key)[1]
+
+    def stats(self):
+        """
+        Returning the cache counters.
+        :return: dictionary of the cache counters.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self._entries), 'bytes': self.n_bytes, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'hit_rate': self.hits / lookups if lookups else 0.0}
+
+    def _after_fork(self):
+        """
+        Resets the lock in a forked process, where the parent's thread holding it doesn't exist.
+        """
+        self._lock = threading.Lock()
+
+    def _evict_one(self):
+        """
+        Evicting a single entry, must be called while holding the lock.
+        """
+        if self.cost_aware:
+            sample = []
+            for key in self._entries:
+                sample.append(key)
+                if len(sample) == EVICTION_SAMPLE:
+                    break
+            victim = min(sample, key=lambda k: self._entries[k][3])
+            self._inflation = self._entries[victim][3]
+        else:
+            victim = next(iter(self._entries))
+        self.n_bytes -= self._entries.pop(victim)[1]
+        self.evictions += 1
+
+
+class NoStore:
+    """ Wraps a result that should be returned to the waiting callers but not cached, like a partial result. """
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+
+class _Flight:
+    """ A computation in progress, which identical concurrent requests wait for. """
+
+    __slots__ = ('event', 'value', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class QueryResultCache:
+    """
+    Thread-safe cache of final query results, keyed by (endpoint, normalized tokens, parameters).
+    Entries expire after `ttl` seconds and the least recently used entry is evicted above `max_entries`.
+    Concurrent identical requests are coalesced - the first one computes the result and the others wait for it.
+    `invalidate` drops all the entries at once, and results computed before it are not stored.
+    """
+
+    def __init__(self, max_entries=RESULT_CACHE_ENTRIES, ttl=RESULT_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key: (expires_at, value)
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def get_or_compute(self, key, compute):
+        """
+        Returning the cached result of a key, or computing it once for all the concurrent callers.
+        :param key: hashable key.
+        :param compute: function with no arguments, returning the result, or the result wrapped in NoStore.
+        :return: the result.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > monotonic():
+                    self.hits += 1
+                    self._entries.move_to_end(key)
+                    return entry[1]
+                del self._entries[key]
+            flight = self._in_flight.get(key)
+            leader = flight is None
+            if leader:
+                self.misses += 1
+                flight = _Flight()
+                self._in_flight[key] = flight
+                generation = self.generation
+            else:
+                self.coalesced += 1
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+        store = True
+        try:
+            flight.value = compute()
+            if isinstance(flight.value, NoStore):
+                flight.value, store = flight.value.value, False
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+                if store and flight.error is None and generation == self.generation:
+                    self._entries[key] = (monotonic() + self.ttl, flight.value)
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+                        self.evictions += 1
+            flight.event.set()
+        return flight.value
+
+    def invalidate(self):
+        """
+        Dropping all the cached results, for example after an index was reloaded.
+        """
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def _after_fork(self):
+        """
+        Resets the lock in a forked process, where the parent's thread holding it doesn't exist, and forgets the
+        computations in progress, whose threads don't exist either.
+        """
+        self._lock = threading.Lock()
+        self._in_flight = {}
+
+    def stats(self):
+        """
+        Returning the cache counters.
+        :return: dictionary of the cache counters.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses + self.coalesced
+            return {'entries': len(self._entries), 'max_entries': self.max_entries, 'ttl': self.ttl,
+                    'hits': self.hits, 'misses': self.misses, 'coalesced': self.coalesced,
+                    'evictions': self.evictions, 'generation': self.generation,
+                    'hit_rate': (self.hits + self.coalesced) / lookups if lookups else 0.0}
+
+
+posting_cache = PostingListCache()
+result_cache = QueryResultCache()
+os.register_at_fork(after_in_child=posting_cache._after_fork)
+os.register_at_fork(after_in_child=result_cache._after_fork)
@@ -0,0 +1,276 @@
+import argparse
+import json
+import os
+import pickle
+import shutil
+from collections import Counter
+import numpy as np
+from loader import BucketIndexLoader
+from instrumentation import count
+
+CHAMPION_FORMAT = 1
+CHAMPION_R = 2000  # postings kept per term
+CHAMPION_ORDERS = ('bm25', 'tf')
+CHECK_DEPTH = 30  # results of `search` after merging, the depth at which the score bound is checked
+
+
+class ChampionTierWriter:
+    """
+    Writes the champion tier of an index folder into the `{folder_name}_champions` folder: `doc_ids.bin` and
+    `tfs.bin` with the champion postings of all the terms, each list sorted by doc_id, and `lexicon.pkl`.
+    """
+
+    def __init__(self, folder_name, k1, b, r, order, directory='.'):
+        if order not in CHAMPION_ORDERS:
+            raise ValueError(f"champions are selected by one of {CHAMPION_ORDERS}, not {order}")
+        self.header = {'format': CHAMPION_FORMAT, 'k1': k1, 'b': b, 'r': r, 'order': order}
+        self.lexicon = {}
+        self.path = ChampionTier.path(folder_name, directory)
+        self._tmp_path = self.path + '.part'
+        shutil.rmtree(self._tmp_path, ignore_errors=True)
+        os.makedirs(self._tmp_path)
+        self._ids_file = open(os.path.join(self._tmp_path, 'doc_ids.bin'), 'wb')
+        self._tfs_file = open(os.path.join(self._tmp_path, 'tfs.bin'), 'wb')
+        self._offset = 0
+
+    def add(self, token, doc_ids, tfs, keys, contributions):
+        """
+        Adds the champions of a token - its r postings with the highest keys.
+        :param token: String.
+        :param doc_ids: numpy array of the doc_ids of the full posting list.
+        :param tfs: numpy array of matching term frequencies.
+        :param keys: numpy array of the selection keys of the postings (BM25 contribution or tf / doc_len).
+        :param contributions: numpy array of the BM25 contributions of the postings.
+        """
+        r = self.header['r']
+        if len(doc_ids) > r:
+            top = np.argpartition(-keys, r - 1)[:r]
+            rest = np.ones(len(doc_ids), dtype=bool)
+            rest[top] = False
+            bound = float(contributions[rest].max())
+        else:
+            top, bound = np.arange(len(doc_ids)), 0.0
+        top = top[np.argsort(doc_ids[top], kind='stable')]
+        self._ids_file.write(np.asarray(doc_ids[top], dtype=np.uint32).tobytes())
+        self._tfs_file.write(np.asarray(tfs[top], dtype=np.uint16).tobytes())
+        self.lexicon[token] = (self._offset, len(top), bound)
+        self._offset += len(top)
+
+    def close(self):
+        """
+        Writes the tier and moves the folder to its final name, replacing a previous tier.
+        """
+        self._ids_file.close()
+        self._tfs_file.close()
+        with open(os.path.join(self._tmp_path, 'lexicon.pkl'), 'wb') as f:
+            pickle.dump(dict(self.header, lexicon=self.lexicon), f)
+        old_path = self.path + '.old'
+        shutil.rmtree(old_path, ignore_errors=True)
+        if os.path.exists(self.path):
+            os.replace(self.path, old_path)
+        os.replace(self._tmp_path, self.path)
+        shutil.rmtree(old_path, ignore_errors=True)
+
+
+class ChampionTier:
+    """
+    Second tier of an index folder, with the top r postings of every term (its champions) for fixed BM25 parameters,
+    written by `build_champion_tier`.
+    Queries are scored by BM25Scorer over the champion postings. Every term keeps the largest BM25 contribution of
+    its postings that were left out, so a document scores at most its champion score plus the bounds of the query
+    terms it is not a champion of. The tier answers when the CHECK_DEPTH-th best score is above the upper bound of
+    every document outside the top CHECK_DEPTH, and when the scores of the top CHECK_DEPTH are exact (they are
+    champions of every query term with a bound). It falls back to the full posting lists otherwise, or when the
+    candidates are too few.
+    """
+
+    def __init__(self, folder_name, directory='.'):
+        self.folder_name = folder_name
+        folder = self.path(folder_name, directory)
+        with open(os.path.join(folder, 'lexicon.pkl'), 'rb') as f:
+            saved = pickle.load(f)
+        if saved['format'] != CHAMPION_FORMAT:
+            raise ValueError(f"unsupported champion tier format {saved['format']} for {folder_name}")
+        self.k1, self.b, self.r, self.order = saved['k1'], saved['b'], saved['r'], saved['order']
+        self.lexicon = saved['lexicon']
+        if sum(n for _, n, _ in self.lexicon.values()):
+            self.doc_ids = np.memmap(os.path.join(folder, 'doc_ids.bin'), dtype=np.uint32, mode='r')
+            self.tfs = np.memmap(os.path.join(folder, 'tfs.bin'), dtype=np.uint16, mode='r')
+        else:
+            self.doc_ids = np.empty(0, dtype=np.uint32)
+            self.tfs = np.empty(0, dtype=np.uint16)
+        self.answered = 0
+        self.fallbacks = 0
+
+    @staticmethod
+    def path(folder_name, directory='.'):
+        """
+        :return: path of the champion tier folder of an index folder.
+        """
+        return os.path.join(directory, f'{folder_name}_champions')
+
+    @staticmethod
+    def exists(folder_name, directory='.'):
+        """
+        Checks if a champion tier was built for a folder.
+        :param folder_name: folder name.
+        :param directory: directory of the champion tier folder.
+        :return: Boolean.
+        """
+        return os.path.exists(os.path.join(ChampionTier.path(folder_name, directory), 'lexicon.pkl'))
+
+    def matches(self, k1, b):
+        """
+        :return: True if the tier was built with these BM25 parameters.
+        """
+        return self.k1 == k1 and self.b == b
+
+    def postings(self, scorer, tokenized_query):
+        """
+        Gathers the champion postings of the query tokens which appear in the index.
+        :param scorer: BM25Scorer object of the folder.
+        :param tokenized_query: List of tokens.
+        :return: tuple of (Dictionary - token: (doc_ids, tfs), Dictionary - token: bound on the contribution of the
+                 token to the score of a document which is not one of its champions), or None if a token of the index
+                 has no champions (it was added after the tier was built).
+        """
+        postings, bounds = {}, {}
+        counts = Counter(tokenized_query)
+        for token in scorer.calc_idf(counts):
+            entry = self.lexicon.get(token)
+            if entry is None:
+                return None
+            offset, n, term_bound = entry
+            postings[token] = (self.doc_ids[offset:offset + n].astype(np.int64),
+                               self.tfs[offset:offset + n].astype(np.int32))
+            bounds[token] = counts[token] * term_bound
+        return postings, bounds
+
+    def search(self, scorer, tokenized_query, N=100, depth=CHECK_DEPTH):
+        """
+        Searches the champion postings.
+        :param scorer: BM25Scorer object of the folder, for the global statistics (N, avgdl, df).
+        :param tokenized_query: List of tokens.
+        :param N: Maximum length of the result.
+        :param depth: rank at which the score bound is checked.
+        :return: Sorted list of (doc_id, score), or None when the full posting lists are needed.
+        """
+        gathered = self.postings(scorer, tokenized_query)
+        if gathered is None:
+            return self._fall_back()
+        postings, bounds = gathered
+        candidates, scores = scorer.score(tokenized_query, self.k1, self.b, postings=postings)
+        res = scorer.top_n(candidates, scores, N)
+        bound = sum(bounds.values())
+        if bound > 0:
+            depth = min(depth, N)
+            if len(res) < depth:
+                return self._fall_back()
+            # The score a candidate may be missing - the bounds of the terms it is not a champion of.
+            slack = np.zeros(len(candidates), dtype=np.float64)
+            for token, term_bound in bounds.items():
+                if term_bound > 0:
+                    slack[~np.isin(candidates, postings[token][0], assume_unique=True)] += term_bound
+            top = np.isin(candidates, [doc_id for doc_id, _ in res[:depth]])
+            outside = scores[~top] + slack[~top]
+            if np.any(slack[top] > 0) or res[depth - 1][1] <= max(bound, outside.max(initial=0.0)):
+                return self._fall_back()
+        self.answered += 1
+        return res
+
+    def _fall_back(self):
+        self.fallbacks += 1
+        count('champion_fallbacks')
+        return None
+
+    def stats(self):
+        """
+        :return: dictionary of the tier counters.
+        """
+        queries = self.answered + self.fallbacks
+        return {'r': self.r, 'order': self.order, 'answered': self.answered, 'fallbacks': self.fallbacks,
+                'fallback_rate': self.fallbacks / queries if queries else 0.0}
+
+
+def build_champion_tier(index, folder_name, scorer, k1, b, r=CHAMPION_R, order='bm25', directory='.'):
+    """
+    Builds the champion tier of an index folder offline, from its full posting lists.
+    :param index: InvertedIndex object of the folder.
+    :param folder_name: folder name.
+    :param scorer: BM25Scorer object of the folder.
+    :param k1: BM25 k1 parameter.
+    :param b: BM25 b parameter.
+    :param r: champions per term.
+    :param order: 'bm25' keeps the postings with the highest BM25 contribution, 'tf' those with the highest
+                  tf / doc_len.
+    :param directory: directory to write the tier folder to.
+    """
+    writer = ChampionTierWriter(folder_name, k1, b, r, order, directory)
+    for token, idf in scorer.calc_idf(index.df.keys()).items():
+        doc_ids, tfs = BucketIndexLoader.read_posting_arrays(token, index, folder_name)
+        contributions = scorer.contributions(doc_ids, tfs, idf, k1, b)
+        if order == 'bm25':
+            keys = contributions
+        else:
+            pos, found = scorer.doc_store.dense_ids(doc_ids)
+            keys = tfs / np.maximum(np.where(found, scorer.doc_lens[pos], 1.0), 1.0)
+        writer.add(token, doc_ids, tfs, keys, contributions)
+    writer.close()
+
+
+def recall_report(queries, scorer, tier, analyzer, k=CHECK_DEPTH, N=100):
+    """
+    Measures the champion tier against the full index.
+    :param queries: List of query strings.
+    :param scorer: BM25Scorer object of the folder.
+    :param tier: ChampionTier object.
+    :param analyzer: Analyzer of the queries.
+    :param k: depth of the recall.
+    :param N: results per query.
+    :return: Dictionary - the mean recall at k of the champion results against the exhaustive results, over all the
+             queries (`recall_champions_only`, as if the tier never fell back) and with the fallback (`recall`), and
+             the fallback rate.
+    """
+    recalls, served, fallbacks = [], [], 0
+    for query in queries:
+        tokens = analyzer.analyze(query)
+        exact = {doc_id for doc_id, _ in scorer.search(tokens, tier.k1, tier.b, N)[:k]}
+        res = tier.search(scorer, tokens, N, k)
+        gathered = tier.postings(scorer, tokens)
+        candidates, scores = scorer.score(tokens, tier.k1, tier.b, postings=gathered[0] if gathered else {})
+        champions = {doc_id for doc_id, _ in scorer.top_n(candidates, scores, N)[:k]}
+        recall = len(exact & champions) / len(exact) if exact else 1.0
+        recalls.append(recall)
+        if res is None:
+            fallbacks += 1
+            served.append(1.0)
+        else:
+            served.append(recall)
+    n = len(queries)
+    return {'folder': tier.folder_name, 'r': tier.r, 'order': tier.order, 'queries': n, 'k': k,
+            'recall_champions_only': float(np.mean(recalls)) if n else 1.0,
+            'recall': float(np.mean(served)) if n else 1.0, 'fallback_rate': fallbacks / n if n else 0.0}
+
+
+if __name__ == '__main__':
+    # python champion.py build [r] [--order bm25|tf] - builds the champion tiers of the folders of the main search.
+    # python champion.py report [--queries queries_train.json] - reports the recall of the tiers against the full index.
+    parser = argparse.ArgumentParser(description="Champion tiers of the folders of the main search.")
+    parser.add_argument('command', choices=('build', 'report'))
+    parser.add_argument('r', type=int, nargs='?', default=CHAMPION_R)
+    parser.add_argument('--order', choices=CHAMPION_ORDERS, default='bm25')
+    parser.add_argument('--queries', default='queries_train.json')
+    parser.add_argument('--k', type=int, default=CHECK_DEPTH)
+    args = parser.parse_args()
+    import backend
+    from analyzer import STEMMED
+    scorers = {scorer.folder_name: scorer for scorer in (backend.body_scorer, backend.title_scorer)}
+    if args.command == 'build':
+        for folder, (folder_k1, folder_b) in backend.SEARCH_BM25_PARAMS.items():
+            build_champion_tier(scorers[folder].index, folder, scorers[folder], folder_k1, folder_b, args.r, args.order)
+            print(f"built the champion tier of {folder}")
+    else:
+        with open(args.queries) as f:
+            report_queries = list(json.load(f))
+        for folder in backend.SEARCH_BM25_PARAMS:
+            print(json.dumps(recall_report(report_queries, scorers[folder], ChampionTier(folder), STEMMED, args.k)))
@@ -0,0 +1,194 @@
+import json
+import os
+from collections.abc import Mapping
+import numpy as np
+import pandas as pd
+
+DOC_STORE_FORMAT = 1
+
+
+class AttributeView(Mapping):
+    """
+    Read-only dictionary-like view of a single DocumentStore attribute, for code that expects a dictionary
+    (for example `BM25` and `Calculator`). Only documents that have the attribute are keys of the view.
+    """
+
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+        self.array = store.attributes[name]
+        self.mask = store.masks.get(name)
+        self._len = len(self.array) if self.mask is None else int(np.count_nonzero(self.mask))
+
+    def __getitem__(self, doc_id):
+        pos = self.store.dense_id(doc_id)
+        if pos < 0 or (self.mask is not None and not self.mask[pos]):
+            raise KeyError(doc_id)
+        return self.array[pos].item()
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        ids = self.store.ids if self.mask is None else self.store.ids[self.mask]
+        return iter(ids.tolist())
+
+    def values(self):
+        """
+        Returns the values of the documents which have the attribute.
+        :return: numpy array.
+        """
+        return self.array if self.mask is None else self.array[self.mask]
+
+
+class DocumentStore:
+    """
+    Compact store of per-document attributes (length, norm, page rank, page views...).
+    Wiki ids are mapped to dense ids - their position in the sorted `ids` array, and every attribute is a typed numpy
+    array indexed by dense id. Attributes that do not cover all the documents have a boolean mask of presence.
+    The store is saved as .npy files, which are memory-mapped when loaded.
+    """
+
+    def __init__(self, ids, attributes, masks=None):
+        self.ids = ids
+        self.attributes = attributes
+        self.masks = masks or {}
+
+    @staticmethod
+    def build(sources, dtypes=None, extra_ids=()):
+        """
+        Building a store from dictionaries or pd.Series objects.
+        :param sources: Dictionary - attribute name: dictionary or pd.Series of doc_id: value.
+        :param dtypes: Dictionary - attribute name: numpy dtype. The default is float64.
+        :param extra_ids: Iterable of doc_ids that should get a dense id without having any attribute.
+        :return: DocumentStore object.
+        """
+        dtypes = dtypes or {}
+        columns = {name: DocumentStore._to_arrays(source) for name, source in sources.items()}
+        all_ids = [keys for keys, _ in columns.values()]
+        all_ids.append(np.fromiter(extra_ids, dtype=np.int64))
+        ids = np.unique(np.concatenate(all_ids))
+        attributes, masks = {}, {}
+        for name, (keys, values) in columns.items():
+            pos = np.searchsorted(ids, keys)
+            arr = np.zeros(len(ids), dtype=dtypes.get(name, np.float64))
+            arr[pos] = values
+            attributes[name] = arr
+            if len(np.unique(keys)) != len(ids):
+                mask = np.zeros(len(ids), dtype=bool)
+                mask[pos] = True
+                masks[name] = mask
+        return DocumentStore(ids, attributes, masks)
+
+    @staticmethod
+    def _to_arrays(source):
+        """
+        Converting a dictionary or a pd.Series to (keys, values) numpy arrays.
+        :param source: dictionary or pd.Series of doc_id: value.
+        :return: tuple of (keys, values) numpy arrays.
+        """
+        if isinstance(source, pd.Series):
+            return source.index.to_numpy(dtype=np.int64), source.to_numpy()
+        return (np.fromiter(source.keys(), dtype=np.int64, count=len(source)),
+                np.array(list(source.values())))
+
+    def add_attribute(self, name, values, mask=None):
+        """
+        Adding an attribute that is already aligned with the dense ids.
+        :param name: attribute name.
+        :param values: numpy array of the same length as `ids`.
+        :param mask: Optional boolean presence mask.
+        """
+        self.attributes[name] = values
+        if mask is not None:
+            self.masks[name] = mask
+
+    def dense_id(self, doc_id):
+        """
+        Mapping a single wiki id to its dense id.
+        :param doc_id: wiki id.
+        :return: dense id, or -1 if the document is not in the store.
+        """
+        pos = int(np.searchsorted(self.ids, doc_id))
+        if pos < len(self.ids) and self.ids[pos] == doc_id:
+            return pos
+        return -1
+
+    def dense_ids(self, doc_ids):
+        """
+        Mapping a batch of wiki ids to dense ids.
+        :param doc_ids: Iterable or numpy array of wiki ids.
+        :return: tuple of (dense ids, found mask). Dense ids of documents that are not in the store are 0.
+        """
+        if not isinstance(doc_ids, np.ndarray):
+            doc_ids = np.fromiter(doc_ids, dtype=np.int64)
+        pos = np.searchsorted(self.ids, doc_ids)
+        pos[pos == len(self.ids)] = 0
+        found = self.ids[pos] == doc_ids
+        pos[~found] = 0
+        return pos, found
+
+    def gather(self, name, doc_ids, default=0):
+        """
+        Returning the values of an attribute for a batch of wiki ids.
+        :param name: attribute name.
+        :param doc_ids: Iterable or numpy array of wiki ids.
+        :param default: value for documents that do not have the attribute.
+        :return: numpy array aligned with doc_ids.
+        """
+        pos, found = self.dense_ids(doc_ids)
+        mask = self.masks.get(name)
+        if mask is not None:
+            found &= mask[pos]
+        return np.where(found, self.attributes[name][pos], default)
+
+    def view(self, name):
+        """
+        Returning a dictionary-like view of an attribute.
+        :param name: attribute name.
+        :return: AttributeView object.
+        """
+        return AttributeView(self, name)
+
+    def save(self, folder):
+        """
+        Saving the store as .npy files in a folder.
+        :param folder: folder path, created if needed.
+        """
+        os.makedirs(folder, exist_ok=True)
+        np.save(os.path.join(folder, 'ids.npy'), self.ids)
+        for name, values in self.attributes.items():
+            np.save(os.path.join(folder, f'{name}.npy'), values)
+        for name, mask in self.masks.items():
+            np.save(os.path.join(folder, f'{name}.mask.npy'), mask)
+        meta = {'format': DOC_STORE_FORMAT, 'attributes': sorted(self.attributes), 'masks': sorted(self.masks)}
+        with open(os.path.join(folder, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+    @staticmethod
+    def load(folder, mmap_mode='r'):
+        """
+        Loading a store saved with `save`.
+        :param folder: folder path.
+        :param mmap_mode: numpy memory-map mode, None to read the arrays into memory.
+        :return: DocumentStore object.
+        """
+        with open(os.path.join(folder, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['format'] != DOC_STORE_FORMAT:
+            raise ValueError(f"unsupported document store format {meta['format']} in {folder}")
+        ids = np.load(os.path.join(folder, 'ids.npy'), mmap_mode=mmap_mode)
+        attributes = {name: np.load(os.path.join(folder, f'{name}.npy'), mmap_mode=mmap_mode)
+                      for name in meta['attributes']}
+        masks = {name: np.load(os.path.join(folder, f'{name}.mask.npy'), mmap_mode=mmap_mode)
+                 for name in meta['masks']}
+        return DocumentStore(ids, attributes, masks)
+
+    @staticmethod
+    def exists(folder):
+        """
+        Checks if a store was saved in a folder.
+        :param folder: folder path.
+        :return: Boolean.
+        """
+        return os.path.exists(os.path.join(folder, 'meta.json'))
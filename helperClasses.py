@@ -1,14 +1,29 @@
 from collections import Counter, defaultdict
 import pandas as pd
-from nltk.corpus import stopwords
-from nltk.stem.snowball import SnowballStemmer
 import numpy as np
 from inverted_index_gcp import InvertedIndex
+from analyzer import Analyzer, ASS3, STEMMED
 # import gensim.downloader as api
 from sklearn.preprocessing import MinMaxScaler
 epsilon = .0000001
 
 
+def sorted_unique(values):
+    """
+    Returns the sorted distinct values of an array. Same as np.unique, which is much slower on large integer arrays in
+    some numpy versions.
+    :param values: 1-d numpy array.
+    :return: sorted numpy array of the distinct values.
+    """
+    values = np.sort(values)
+    if len(values) == 0:
+        return values
+    keep = np.empty(len(values), dtype=bool)
+    keep[0] = True
+    np.not_equal(values[1:], values[:-1], out=keep[1:])
+    return values[keep]
+
+
 class QueryProcessing:
 
     @staticmethod
@@ -18,14 +33,7 @@ class QueryProcessing:
         :param query: String, query to be searched.
         :return: List of individual tokens.
         """
-        english_stopwords = frozenset(stopwords.words('english'))
-        toked_q = query.lower().split()
-        new_query = []
-        for token in toked_q:
-            if token in english_stopwords:
-                continue
-            new_query.append(token)
-        return new_query
+        return ASS3.analyze(query)
 
     @staticmethod
     def tokenize_with_stem(query):
@@ -34,17 +42,7 @@ class QueryProcessing:
         :param query: String, query to be searched.
         :return: List of individual tokens.
         """
-        english_stopwords = frozenset(stopwords.words('english'))
-        snowball_stemmer = SnowballStemmer(language='english')
-        toked_q = query.lower().split()
-        new_query = []
-        for token in toked_q:
-            if token in english_stopwords:
-                continue
-            if token.endswith('?') or token.endswith('!'):
-                token = token[:-1]
-            new_query.append(snowball_stemmer.stem(token))
-        return new_query
+        return STEMMED.analyze(query)
 
     @staticmethod
     def normalize_pageviews(page_views: dict):
@@ -54,10 +52,19 @@ class QueryProcessing:
         :return: dictionary - doc_id: normalized_page_view
         """
         views = pd.Series(page_views)
-        norm_views = pd.Series(MinMaxScaler().fit_transform(np.array(views).reshape(-1, 1))[:, 0])
+        norm_views = pd.Series(QueryProcessing.normalize_array(np.array(views)))
         norm_views.index = views.index
         return norm_views.to_dict(defaultdict(int))
 
+    @staticmethod
+    def normalize_array(values):
+        """
+        Normalizes an array of values to [0, 1] using MinMaxScaler.
+        :param values: numpy array.
+        :return: numpy array of the normalized values.
+        """
+        return MinMaxScaler().fit_transform(np.asarray(values).reshape(-1, 1))[:, 0]
+
 
 class Calculator:
     @staticmethod
@@ -70,12 +77,11 @@ class Calculator:
         """
         Q = {}
         counter = Counter(query)
-        for token in np.unique(query):
-            if token in index.df.keys():  # avoid terms that do not appear in the index.
-                tf = counter.get(token, 0) / len(query)  # term frequency divided by the length of the query
-                df = index.df.get(token, 0)
-                idf = np.log10((len(index.df)) / (df + epsilon))  # smoothing
-                Q[token] = tf * idf
+        entries = Analyzer.resolve(query, index)  # avoid terms that do not appear in the index.
+        for token in sorted(entries):
+            tf = counter[token] / len(query)  # term frequency divided by the length of the query
+            idf = np.log10((len(index.df)) / (entries[token] + epsilon))  # smoothing
+            Q[token] = tf * idf
         return Q
 
     @staticmethod
@@ -102,12 +108,13 @@ class Calculator:
         :return: dictionary of cosine similarity between the document and the query.
         """
         sims = {}
+        q_norm = np.linalg.norm(list(Q.values()))
         for doc_id in D.keys():
             dot = 0
             for token in Q.keys():
                 if token in D[doc_id]:
                     dot += Q[token] * D[doc_id][token]
-            sims[doc_id] = dot / (doc_norms[doc_id] * np.linalg.norm(list(Q.values())))
+            sims[doc_id] = dot / (doc_norms[doc_id] * q_norm)
         return sims
 
 
@@ -122,3 +129,21 @@ class ResultProcessor:
         """
         return sorted([(doc_id, np.round(score, 5)) for doc_id, score in sim_dict.items()], key=lambda x: x[1],
                       reverse=True)[:N]
+
+    @staticmethod
+    def multi_merge_results(scores, weights, N=100):
+        """
+        Merging the results of multiple sources to one list.
+        :param scores: List of lists, each contains (doc_id, score) tuples.
+        :param weights: List of matching weights.
+        :param N: Maximum number of results.
+        :return: List of the merged results, with maximum length of N.
+        """
+        merged_scores = defaultdict(int)
+        for tuples_list, weight in zip(scores, weights):
+            for doc_id, score in tuples_list:
+                merged_scores[doc_id] += score * weight
+
+        merged_list = [(k, v) for k, v in sorted(merged_scores.items(), key=lambda item: item[1], reverse=True)]
+
+        return merged_list[:N]
@@ -0,0 +1,271 @@
+import os
+import pickle
+import sys
+import threading
+import zlib
+from collections import Counter
+import numpy as np
+from BM25 import BM25Scorer
+from loader import BucketIndexLoader
+from instrumentation import count
+
+IMPACT_FORMAT = 1
+IMPACT_BITS = 16
+IMPACT_DTYPES = {8: np.uint8, 16: np.uint16}
+
+_local = threading.local()
+
+
+def ids_checksum(ids):
+    """
+    :param ids: numpy array of the wiki ids of a DocumentStore.
+    :return: checksum of the ids, which identifies the dense id mapping an impact index was built with.
+    """
+    return zlib.crc32(np.ascontiguousarray(ids, dtype=np.int64).tobytes())
+
+
+def quantize(contributions, scale, bits=IMPACT_BITS):
+    """
+    Quantizes BM25 contributions linearly to integers in [1, 2 ** bits - 1]. Every posting keeps an impact of at
+    least 1, so the matching documents are the same as with exact scores.
+    :param contributions: numpy array of BM25 contributions.
+    :param scale: contribution of one impact unit.
+    :param bits: 8 or 16.
+    :return: numpy array of impacts.
+    """
+    top = 2 ** bits - 1
+    return np.clip(np.rint(contributions / scale), 1, top).astype(IMPACT_DTYPES[bits])
+
+
+class ImpactIndexWriter:
+    """
+    Writes the impact index of an index folder for fixed BM25 parameters, into the `{folder_name}_impacts` folder:
+    `doc_ids.bin` with the dense ids (DocumentStore positions) of all the postings, `impacts.bin` with their quantized
+    BM25 contributions, and `lexicon.pkl`. Every posting list is sorted by decreasing impact.
+    """
+
+    def __init__(self, folder_name, doc_store, k1, b, scale, bits=IMPACT_BITS, directory='.'):
+        if bits not in IMPACT_DTYPES:
+            raise ValueError(f"impacts are stored in 8 or 16 bits, not {bits}")
+        self.folder_name = folder_name
+        self.doc_store = doc_store
+        self.header = {'format': IMPACT_FORMAT, 'k1': k1, 'b': b, 'bits': bits, 'scale': scale,
+                       'n_docs': len(doc_store.ids), 'ids_checksum': ids_checksum(doc_store.ids)}
+        self.lexicon = {}
+        self.path = ImpactIndex.path(folder_name, directory)
+        self._tmp_path = self.path + '.part'
+        os.makedirs(self._tmp_path, exist_ok=True)
+        self._ids_file = open(os.path.join(self._tmp_path, 'doc_ids.bin'), 'wb')
+        self._impacts_file = open(os.path.join(self._tmp_path, 'impacts.bin'), 'wb')
+        self._offset = 0
+
+    def add(self, token, doc_ids, contributions):
+        """
+        Adds the posting list of a token. Postings of documents which are not in the document store are dropped,
+        since they have no dense id (and no title to return).
+        :param token: String.
+        :param doc_ids: numpy array of doc_ids.
+        :param contributions: numpy array of matching BM25 contributions.
+        """
+        dense, found = self.doc_store.dense_ids(doc_ids)
+        dense, impacts = dense[found], quantize(contributions[found], self.header['scale'], self.header['bits'])
+        order = np.lexsort((dense, -impacts.astype(np.int64)))
+        dense, impacts = dense[order].astype(np.uint32), impacts[order]
+        # levels[j] - number of postings with an impact of at least 2 ** j.
+        levels = len(impacts) - np.searchsorted(impacts[::-1], 2 ** np.arange(self.header['bits'] + 1), side='left')
+        self._ids_file.write(dense.tobytes())
+        self._impacts_file.write(impacts.tobytes())
+        self.lexicon[token] = (self._offset, len(dense), levels.astype(np.int64))
+        self._offset += len(dense)
+
+    def close(self):
+        """
+        Writes the lexicon and moves the folder to its final name, replacing a previous impact index.
+        """
+        self._ids_file.close()
+        self._impacts_file.close()
+        with open(os.path.join(self._tmp_path, 'lexicon.pkl'), 'wb') as f:
+            pickle.dump(dict(self.header, lexicon=self.lexicon), f)
+        old_path = self.path + '.old'
+        if os.path.exists(self.path):
+            os.replace(self.path, old_path)
+        os.replace(self._tmp_path, self.path)
+        if os.path.exists(old_path):
+            for name in os.listdir(old_path):
+                os.remove(os.path.join(old_path, name))
+            os.rmdir(old_path)
+
+
+class ImpactIndex:
+    """
+    Impact-ordered BM25 index of a folder for fixed (k1, b), written by `build_impact_index`.
+    Queries accumulate integer impacts into per-thread dense accumulators, level by level (impacts of at least
+    2 ** j, from the highest level down), and stop once the remaining impacts cannot change the top N. The scores
+    of the top N are then completed from the rest of the lists, so the result is the exact top N of the quantized
+    scores.
+    """
+
+    def __init__(self, folder_name, doc_store, directory='.'):
+        self.folder_name = folder_name
+        self.doc_store = doc_store
+        folder = self.path(folder_name, directory)
+        with open(os.path.join(folder, 'lexicon.pkl'), 'rb') as f:
+            saved = pickle.load(f)
+        if saved['format'] != IMPACT_FORMAT:
+            raise ValueError(f"unsupported impact index format {saved['format']} for {folder_name}")
+        if saved['n_docs'] != len(doc_store.ids) or saved['ids_checksum'] != ids_checksum(doc_store.ids):
+            raise ValueError(f"the impact index of {folder_name} was built with a different document store")
+        self.k1, self.b, self.bits, self.scale = saved['k1'], saved['b'], saved['bits'], saved['scale']
+        self.lexicon = saved['lexicon']
+        n_postings = sum(n for _, n, _ in self.lexicon.values())
+        if n_postings:
+            self.doc_ids = np.memmap(os.path.join(folder, 'doc_ids.bin'), dtype=np.uint32, mode='r')
+            self.impacts = np.memmap(os.path.join(folder, 'impacts.bin'), dtype=IMPACT_DTYPES[self.bits], mode='r')
+        else:
+            self.doc_ids = np.empty(0, dtype=np.uint32)
+            self.impacts = np.empty(0, dtype=IMPACT_DTYPES[self.bits])
+
+    @staticmethod
+    def path(folder_name, directory='.'):
+        """
+        :return: path of the impact index folder of an index folder.
+        """
+        return os.path.join(directory, f'{folder_name}_impacts')
+
+    @staticmethod
+    def exists(folder_name, directory='.'):
+        """
+        Checks if an impact index was built for a folder.
+        :param folder_name: folder name.
+        :param directory: directory of the impact index folder.
+        :return: Boolean.
+        """
+        return os.path.exists(os.path.join(ImpactIndex.path(folder_name, directory), 'lexicon.pkl'))
+
+    def matches(self, k1, b):
+        """
+        :return: True if the index was built with these BM25 parameters.
+        """
+        return self.k1 == k1 and self.b == b
+
+    def _buffers(self):
+        """
+        Returns the accumulators of the current thread, shared by the impact indices of the same document store.
+        They are all zero between queries.
+        :return: tuple of (scores, seen mask, top mask) dense arrays.
+        """
+        n_docs = len(self.doc_store.ids)
+        buffers = getattr(_local, 'buffers', None)
+        if buffers is None or len(buffers[0]) != n_docs:
+            buffers = _local.buffers = (np.zeros(n_docs, dtype=np.int32), np.zeros(n_docs, dtype=bool),
+                                        np.zeros(n_docs, dtype=bool))
+        return buffers
+
+    def search(self, tokenized_query, N=100):
+        """
+        Searches for the best N matches. Repeated query tokens count again, like in BM25Scorer.
+        :param tokenized_query: List of tokens.
+        :param N: Maximum length of the result.
+        :return: Sorted list of (doc_id, score), with the scores dequantized to BM25 units.
+        """
+        terms = []
+        for token, weight in Counter(tokenized_query).items():
+            entry = self.lexicon.get(token)
+            if entry is not None and entry[1]:
+                offset, n, levels = entry
+                terms.append((self.doc_ids[offset:offset + n], self.impacts[offset:offset + n], levels, weight))
+        if not terms or N <= 0:
+            return []
+        acc, seen, top_mask = self._buffers()
+        candidates = np.empty(0, dtype=np.int64)
+        top = None
+        done = [0] * len(terms)
+        try:
+            for level in range(self.bits, -1, -1):
+                for t, (doc_ids, impacts, levels, weight) in enumerate(terms):
+                    end = int(levels[level])
+                    if end <= done[t]:
+                        continue
+                    ids = doc_ids[done[t]:end].astype(np.int64)
+                    acc[ids] += impacts[done[t]:end].astype(np.int32) * weight  # doc_ids of a term are distinct
+                    new = ids[~seen[ids]]
+                    seen[new] = True
+                    candidates = np.concatenate([candidates, new])
+                    done[t] = end
+                top = self._final_top(terms, done, candidates, acc, N)
+                if top is not None:  # always set after level 0, when every posting was accumulated
+                    break
+            top_mask[top] = True
+            for t, (doc_ids, impacts, _, weight) in enumerate(terms):
+                if done[t] < len(doc_ids):
+                    ids = doc_ids[done[t]:].astype(np.int64)
+                    hit = top_mask[ids]
+                    acc[ids[hit]] += impacts[done[t]:][hit].astype(np.int32) * weight
+            scores = acc[top]
+            order = np.lexsort((top, -scores))
+            count('postings', sum(done))
+            count('candidates', len(candidates))
+            return list(zip(self.doc_store.ids[top[order]].tolist(), (scores[order] * self.scale).tolist()))
+        finally:
+            acc[candidates] = 0
+            seen[candidates] = False
+            if top is not None:
+                top_mask[top] = False
+
+    @staticmethod
+    def _final_top(terms, done, candidates, acc, N):
+        """
+        Checks if the top N can still change, after some levels were accumulated.
+        :return: dense ids of the top N, or None if the remaining impacts can still change them.
+        """
+        remaining = sum(int(impacts[done[t]]) * weight if done[t] < len(impacts) else 0
+                        for t, (_, impacts, _, weight) in enumerate(terms))
+        if len(candidates) < N:
+            return candidates if remaining == 0 else None
+        scores = acc[candidates]
+        kth = np.partition(scores, len(scores) - N)[len(scores) - N]
+        above = np.flatnonzero(scores > kth)
+        tied = np.flatnonzero(scores == kth)
+        tied = tied[np.argsort(candidates[tied], kind='stable')]  # ties are broken by doc_id, like the final sort
+        top = np.concatenate([above, tied[:N - len(above)]])
+        if len(tied) > N - len(above):
+            best_rest = kth
+        else:
+            best_rest = scores[scores < kth].max(initial=0)
+        if remaining == 0 or (kth > remaining and kth > best_rest + remaining):
+            return candidates[top]
+        return None
+
+
+def build_impact_index(index, folder_name, doc_store, k1, b, bits=IMPACT_BITS, directory='.'):
+    """
+    Builds the impact index of an index folder offline. The quantization scale is shared by all the terms, so impacts
+    of different terms can be added. It is set by the largest contribution in the index.
+    :param index: InvertedIndex object of the folder.
+    :param folder_name: folder name.
+    :param doc_store: DocumentStore object, with the 'DL' attribute.
+    :param k1: BM25 k1 parameter.
+    :param b: BM25 b parameter.
+    :param bits: 8 or 16 bits per impact.
+    :param directory: directory to write the impact index folder to.
+    """
+    scorer = BM25Scorer(index, doc_store, folder_name)
+    max_impacts = scorer.build_max_impacts(k1, b)
+    scale = max(max_impacts.values(), default=1.0) / (2 ** bits - 1) or 1.0
+    writer = ImpactIndexWriter(folder_name, doc_store, k1, b, scale, bits, directory)
+    for token in index.df.keys():
+        doc_ids, tfs = BucketIndexLoader.load_posting_arrays_for_token(token, index, folder_name)
+        writer.add(token, doc_ids, scorer.contributions(doc_ids, tfs, scorer.calc_idf([token])[token], k1, b))
+    writer.close()
+
+
+if __name__ == '__main__':
+    # python impact_index.py <folder_name> <k1> <b> [bits] - builds the impact index of a folder, using the local
+    # {folder_name}.pkl index and the document store of the startup snapshot.
+    from doc_store import DocumentStore
+    from startup import SNAPSHOT_DIR
+    folder = sys.argv[1]
+    with open(f'{folder}.pkl', 'rb') as f:
+        folder_index = pickle.load(f)
+    build_impact_index(folder_index, folder, DocumentStore.load(os.path.join(SNAPSHOT_DIR, 'doc_store')),
+                       float(sys.argv[2]), float(sys.argv[3]), int(sys.argv[4]) if len(sys.argv) > 4 else IMPACT_BITS)
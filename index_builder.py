@@ -0,0 +1,453 @@
+"""
+Offline index builder, producing the bucket layout the backend loads, from a JSONL corpus or a Wikipedia XML dump.
+
+    python index_builder.py <corpus> <out_dir> [--workers N] [--chunk-mb M]
+
+The corpus is streamed in chunks of about `--chunk-mb` MB of text, which are tokenized by a pool of processes. Every
+chunk becomes one sorted run per index folder on disk, so a worker holds the postings of one chunk at a time. The runs
+are then k-way merged, with the term buckets of every folder split between the processes, into `{bucket}_{n:03}.bin`
+files and an `index.pkl` per folder, like the assignment 3 pipeline. The merge also sums the document norms of the
+body index. `<out_dir>` can be used as `IR_LOCAL_BUCKET_DIR` or uploaded to the bucket as is:
+
+    postings_gcp/<folder_name>/*.bin, postings_gcp/<folder_name>/index.pkl
+    doc_len/doc_len.pkl, doc_norms/doc_norms.pkl, titles/doc_titles.pkl
+
+JSONL lines are {"id", "title", "text", "anchor_text": [{"id", "text"}, ...]}, the anchor text of a link being indexed
+under the linked document. Wikipedia dumps (.xml or .xml.bz2) are read for the body and title indices only, since
+their links name titles rather than ids. Page rank and page views are not computed.
+"""
+import argparse
+import bz2
+import gzip
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import heapq
+import xml.etree.ElementTree as ElementTree
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import multiprocessing
+import numpy as np
+from analyzer import Analyzer, RE_WORD
+from inverted_index_gcp import InvertedIndex
+from multifilereader import BLOCK_SIZE, POSTING_DTYPE
+
+BUILD_WORKERS = os.cpu_count() or 1
+CHUNK_BYTES = 2 ** 26  # text of the documents of one chunk, which bounds the memory of a worker
+NUM_BUCKETS = 124  # term buckets of a folder, as in assignment 3
+MAX_TF = 2 ** 16 - 1  # largest tf of the posting format
+# folder name: the analyzer of its documents.
+FOLDER_ANALYZERS = {
+    "text_inverted_index": Analyzer('body', pattern=RE_WORD),
+    "title_inverted_index_with_stemming": Analyzer('title', pattern=RE_WORD, stem=True),
+    "anchor_inverted_index": Analyzer('anchor', pattern=RE_WORD),
+}
+BODY_FOLDER, TITLE_FOLDER, ANCHOR_FOLDER = FOLDER_ANALYZERS
+
+
+def _hash(s):
+    return hashlib.blake2b(bytes(s, encoding='utf8'), digest_size=5).hexdigest()
+
+
+def token_bucket(token):
+    """
+    :param token: String.
+    :return: the bucket of a token, the same in every process.
+    """
+    return int(_hash(token), 16) % NUM_BUCKETS
+
+
+def _open(path):
+    if path.endswith('.bz2'):
+        return bz2.open(path, 'rb')
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def read_jsonl_chunks(path, chunk_bytes=CHUNK_BYTES):
+    """
+    Streams a JSONL corpus as chunks of raw lines, which are parsed by the workers.
+    :param path: path of the corpus, optionally compressed (.gz, .bz2).
+    :param chunk_bytes: bytes of a chunk.
+    :return: generator of ('jsonl', list of lines).
+    """
+    with _open(path) as f:
+        lines, n_bytes = [], 0
+        for line in f:
+            if line.strip():
+                lines.append(line)
+                n_bytes += len(line)
+            if n_bytes >= chunk_bytes:
+                yield 'jsonl', lines
+                lines, n_bytes = [], 0
+        if lines:
+            yield 'jsonl', lines
+
+
+def read_dump_chunks(path, chunk_bytes=CHUNK_BYTES):
+    """
+    Streams the articles of a Wikipedia XML dump (namespace 0, without redirects) as chunks.
+    :param path: path of the dump, optionally compressed (.bz2).
+    :param chunk_bytes: bytes of article text of a chunk.
+    :return: generator of ('docs', list of (doc_id, title, text, anchors)).
+    """
+    with _open(path) as f:
+        docs, n_bytes, root = [], 0, None
+        for event, elem in ElementTree.iterparse(f, events=('start', 'end')):
+            if root is None:
+                root = elem
+            if event != 'end' or elem.tag.rsplit('}', 1)[-1] != 'page':
+                continue
+            fields = {child.tag.rsplit('}', 1)[-1]: child for child in elem}
+            if fields.get('ns') is not None and fields['ns'].text == '0' and 'redirect' not in fields:
+                text = next((node.text for node in fields['revision'].iter() if node.tag.endswith('text')), '') or ''
+                docs.append((int(fields['id'].text), fields['title'].text or '', text, ()))
+                n_bytes += len(text)
+            root.clear()  # drop the parsed pages
+            if n_bytes >= chunk_bytes:
+                yield 'docs', docs
+                docs, n_bytes = [], 0
+        if docs:
+            yield 'docs', docs
+
+
+def parse_jsonl(lines):
+    """
+    Parses JSONL lines of the corpus.
+    :param lines: List of lines.
+    :return: List of (doc_id, title, text, anchors) tuples, anchors being a list of (linked doc_id, anchor text).
+    """
+    docs = []
+    for line in lines:
+        doc = json.loads(line)
+        anchors = [(int(link['id']), link['text']) for link in doc.get('anchor_text') or ()]
+        docs.append((int(doc['id']), doc.get('title') or '', doc.get('text') or '', anchors))
+    return docs
+
+
+class RunWriter:
+    """
+    Collects the postings of one chunk for an index folder, and writes them as a run sorted by (bucket, term, doc_id):
+    the terms in a UTF-8 blob with offsets, their posting counts, the first term of every bucket, and the doc_ids
+    and tfs as .npy files.
+    """
+
+    def __init__(self):
+        self.terms = {}  # term: term number
+        self.term_ids = []
+        self.doc_ids = []
+        self.tfs = []
+
+    def add(self, doc_id, tokens):
+        """
+        Adds the tokens of a document.
+        :param doc_id: wiki id.
+        :param tokens: List of tokens.
+        """
+        counts = Counter(tokens)
+        terms = self.terms
+        self.term_ids.extend([terms.setdefault(token, len(terms)) for token in counts])
+        self.doc_ids.extend([doc_id] * len(counts))
+        self.tfs.extend(counts.values())
+
+    def write(self, folder):
+        """
+        Writes the run to a folder.
+        :param folder: folder path, created if needed.
+        """
+        os.makedirs(folder, exist_ok=True)
+        terms = list(self.terms)
+        keys = [(token_bucket(term), term.encode('utf-8', 'surrogatepass')) for term in terms]
+        term_order = sorted(range(len(terms)), key=keys.__getitem__)
+        rank = np.empty(len(terms), dtype=np.int64)
+        rank[term_order] = np.arange(len(terms))
+        term_ids = rank[np.array(self.term_ids, dtype=np.int64)]
+        doc_ids = np.array(self.doc_ids, dtype=np.int64)
+        order = np.lexsort((doc_ids, term_ids))
+        encoded = [keys[i][1] for i in term_order]
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum([len(term) for term in encoded], out=offsets[1:])
+        buckets = np.array([keys[i][0] for i in term_order], dtype=np.int64)
+        np.save(os.path.join(folder, 'terms.npy'), np.frombuffer(b''.join(encoded), dtype=np.uint8))
+        np.save(os.path.join(folder, 'offsets.npy'), offsets)
+        np.save(os.path.join(folder, 'counts.npy'), np.bincount(term_ids, minlength=len(terms)))
+        np.save(os.path.join(folder, 'bucket_starts.npy'), np.searchsorted(buckets, np.arange(NUM_BUCKETS + 1)))
+        np.save(os.path.join(folder, 'doc_ids.npy'), doc_ids[order])
+        np.save(os.path.join(folder, 'tfs.npy'), np.array(self.tfs, dtype=np.int64)[order])
+
+
+class Run:
+    """ A run written by RunWriter, memory-mapped for the merge. """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.terms = self._load('terms')
+        self.offsets = self._load('offsets')
+        self.starts = np.concatenate([[0], np.cumsum(self._load('counts'))])
+        self.bucket_starts = self._load('bucket_starts')
+        self.doc_ids = self._load('doc_ids')
+        self.tfs = self._load('tfs')
+
+    def _load(self, name):
+        return np.load(os.path.join(self.folder, f'{name}.npy'), mmap_mode='r')
+
+    def bucket_terms(self, bucket, run_number):
+        """
+        :return: generator of (term bytes, run number, term number) of the terms of a bucket, in term order.
+        """
+        blob, offsets = memoryview(np.asarray(self.terms)), memoryview(np.asarray(self.offsets))
+        for i in range(int(self.bucket_starts[bucket]), int(self.bucket_starts[bucket + 1])):
+            yield blob[offsets[i]:offsets[i + 1]].tobytes(), run_number, i
+
+    def postings(self, i):
+        """
+        :return: tuple of (doc_ids, tfs) of term number i.
+        """
+        return self.doc_ids[self.starts[i]:self.starts[i + 1]], self.tfs[self.starts[i]:self.starts[i + 1]]
+
+
+class BinWriter:
+    """
+    Writes posting lists into `{name}_{n:03}.bin` files of up to BLOCK_SIZE bytes, a list continuing at the start of
+    the next file when it does not fit, as MultiFileReader reads them.
+    """
+
+    def __init__(self, folder, name):
+        self.folder = folder
+        self.name = name
+        self.n_files = 0
+        self._f = None
+        self._pos = 0
+
+    def write(self, b):
+        """
+        :param b: bytes of a posting list.
+        :return: List of (file_name, offset) tuples of the list.
+        """
+        locs = []
+        while len(b):
+            if self._f is None or self._pos == BLOCK_SIZE:
+                self._next_file()
+            n_write = min(len(b), BLOCK_SIZE - self._pos)
+            locs.append((self._file_name, self._pos))
+            self._f.write(b[:n_write])
+            self._pos += n_write
+            b = b[n_write:]
+        return locs
+
+    def _next_file(self):
+        self.close()
+        self._file_name = f'{self.name}_{self.n_files:03}.bin'
+        self._f = open(os.path.join(self.folder, self._file_name), 'wb')
+        self._pos = 0
+        self.n_files += 1
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+
+def _map_chunk(kind, payload, run_dir, run_number):
+    """
+    Tokenizes a chunk of documents and writes a run per index folder.
+    :return: tuple of (doc_ids, body lengths, titles) of the documents of the chunk.
+    """
+    docs = parse_jsonl(payload) if kind == 'jsonl' else payload
+    runs = {folder: RunWriter() for folder in FOLDER_ANALYZERS}
+    body, title, anchor = (FOLDER_ANALYZERS[folder] for folder in (BODY_FOLDER, TITLE_FOLDER, ANCHOR_FOLDER))
+    doc_ids, lengths, titles = [], [], []
+    for doc_id, doc_title, text, anchors in docs:
+        tokens = body.analyze(text)
+        runs[BODY_FOLDER].add(doc_id, tokens)
+        runs[TITLE_FOLDER].add(doc_id, title.analyze(doc_title))
+        for target_id, anchor_text in anchors:
+            runs[ANCHOR_FOLDER].add(target_id, anchor.analyze(anchor_text))
+        doc_ids.append(doc_id)
+        lengths.append(len(tokens))
+        titles.append(doc_title)
+    for folder, run in runs.items():
+        run.write(os.path.join(run_dir, folder, f'{run_number:06}'))
+    return doc_ids, lengths, titles
+
+
+def merge_postings(parts):
+    """
+    Merges the postings of a term from several runs, adding the tfs of a document found more than once (anchor text
+    of links to the same document from several documents).
+    :param parts: List of (doc_ids, tfs) sorted by doc_id.
+    :return: tuple of (doc_ids, tfs).
+    """
+    if len(parts) == 1:
+        doc_ids, tfs = np.asarray(parts[0][0]), np.asarray(parts[0][1])
+    else:
+        doc_ids = np.concatenate([doc_ids for doc_ids, _ in parts])
+        tfs = np.concatenate([tfs for _, tfs in parts])
+        order = np.argsort(doc_ids, kind='stable')
+        doc_ids, tfs = doc_ids[order], tfs[order]
+    first = np.flatnonzero(np.diff(doc_ids, prepend=-1))
+    if len(first) == len(doc_ids):
+        return doc_ids, tfs
+    return doc_ids[first], np.add.reduceat(tfs, first)
+
+
+class BucketMerger:
+    """
+    Merges the runs of an index folder, one term bucket at a time, into .bin files. When the lengths of the body
+    documents are given, the squared document norms are summed over the merged postings, with the weight of a term in
+    a document being tf / doc_len * log10(N / df).
+    """
+
+    def __init__(self, run_folder, out_dir, doc_stats_path=None):
+        """
+        :param run_folder: folder of the runs of the index folder.
+        :param out_dir: directory of the .bin files of the index folder.
+        :param doc_stats_path: Optional .npz file of the sorted body doc_ids and their lengths.
+        """
+        self.runs = [Run(os.path.join(run_folder, name)) for name in sorted(os.listdir(run_folder))]
+        self.out_dir = out_dir
+        self.doc_ids = self.lengths = self.norms = None
+        if doc_stats_path is not None:
+            doc_stats = np.load(doc_stats_path)
+            self.doc_ids, self.lengths = doc_stats['doc_ids'], doc_stats['lengths'].astype(np.float64)
+            self.norms = np.zeros(len(self.doc_ids), dtype=np.float64)
+
+    def merge(self, bucket):
+        """
+        Merges a bucket.
+        :param bucket: bucket number.
+        :return: Dictionary - term: (df, term_total, locs).
+        """
+        terms = {}
+        writer = BinWriter(self.out_dir, str(bucket))
+        current, parts = None, []
+        for term, j, i in heapq.merge(*[run.bucket_terms(bucket, j) for j, run in enumerate(self.runs)]):
+            if term != current and parts:
+                terms[current.decode('utf-8', 'surrogatepass')] = self._write_term(writer, parts)
+                parts = []
+            current = term
+            parts.append(self.runs[j].postings(i))
+        if parts:
+            terms[current.decode('utf-8', 'surrogatepass')] = self._write_term(writer, parts)
+        writer.close()
+        return terms
+
+    def _write_term(self, writer, parts):
+        doc_ids, tfs = merge_postings(parts)
+        postings = np.empty(len(doc_ids), dtype=POSTING_DTYPE)
+        postings['doc_id'] = doc_ids
+        postings['tf'] = np.minimum(tfs, MAX_TF)
+        locs = writer.write(postings.tobytes())
+        if self.norms is not None:
+            pos = np.searchsorted(self.doc_ids, doc_ids)
+            idf = np.log10(len(self.doc_ids) / len(doc_ids))
+            self.norms[pos] += (tfs / self.lengths[pos] * idf) ** 2
+        return len(doc_ids), int(tfs.sum()), locs
+
+
+def _merge_buckets(folder, buckets, run_dir, out_dir, doc_stats_path=None):
+    """
+    Merges some buckets of an index folder, in a worker.
+    :return: tuple of (folder, Dictionary - term: (df, term_total, locs), squared norms or None).
+    """
+    merger = BucketMerger(os.path.join(run_dir, folder), out_dir, doc_stats_path)
+    terms = {}
+    for bucket in buckets:
+        terms.update(merger.merge(bucket))
+    return folder, terms, merger.norms
+
+
+def _executor(workers):
+    # fork shares the imported modules with the workers, where it is available.
+    methods = multiprocessing.get_all_start_methods()
+    return ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork' if 'fork' in methods else None))
+
+
+def _dump(obj, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        pickle.dump(obj, f)
+
+
+def _collect(result, doc_ids, lengths, titles):
+    chunk_doc_ids, chunk_lengths, chunk_titles = result
+    doc_ids.extend(chunk_doc_ids)
+    lengths.extend(chunk_lengths)
+    titles.extend(chunk_titles)
+
+
+def build_index(chunks, out_dir, workers=BUILD_WORKERS):
+    """
+    Builds the indices and document statistics of a corpus.
+    :param chunks: generator of chunks, from `read_jsonl_chunks` or `read_dump_chunks`.
+    :param out_dir: output directory, in the bucket layout.
+    :param workers: number of processes.
+    :return: Dictionary of the build counters.
+    """
+    run_dir = os.path.join(out_dir, 'runs.part')
+    shutil.rmtree(run_dir, ignore_errors=True)
+    doc_ids, lengths, titles = [], [], []
+    with _executor(workers) as executor:
+        # Tokenize, with at most two chunks per worker in flight so the corpus is streamed.
+        pending, n_runs = set(), 0
+        for kind, payload in chunks:
+            if len(pending) >= 2 * workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    _collect(future.result(), doc_ids, lengths, titles)
+            pending.add(executor.submit(_map_chunk, kind, payload, run_dir, n_runs))
+            n_runs += 1
+        for future in pending:
+            _collect(future.result(), doc_ids, lengths, titles)
+        print(f"tokenized {len(doc_ids)} documents into {n_runs} runs")
+        doc_ids = np.array(doc_ids, dtype=np.int64)
+        order = np.argsort(doc_ids, kind='stable')
+        doc_stats_path = os.path.join(run_dir, 'doc_stats.npz')
+        np.savez(doc_stats_path, doc_ids=doc_ids[order], lengths=np.array(lengths, dtype=np.int64)[order])
+        # Merge, with the buckets of every folder split between the workers.
+        futures = []
+        for folder in FOLDER_ANALYZERS:
+            folder_dir = os.path.join(out_dir, 'postings_gcp', folder)
+            shutil.rmtree(folder_dir, ignore_errors=True)
+            os.makedirs(folder_dir)
+            for buckets in np.array_split(np.arange(NUM_BUCKETS), workers):
+                if n_runs and len(buckets):
+                    futures.append(executor.submit(_merge_buckets, folder, buckets.tolist(), run_dir, folder_dir,
+                                                   doc_stats_path if folder == BODY_FOLDER else None))
+        indices = {folder: InvertedIndex() for folder in FOLDER_ANALYZERS}
+        norms = np.zeros(len(doc_ids), dtype=np.float64)
+        for future in futures:
+            folder, terms, folder_norms = future.result()
+            index = indices[folder]
+            for term, (df, term_total, locs) in terms.items():
+                index.df[term] = df
+                index.term_total[term] = term_total
+                index.posting_locs[term] = locs
+            if folder_norms is not None:
+                norms += folder_norms
+    for folder, index in indices.items():
+        _dump(index, os.path.join(out_dir, 'postings_gcp', folder, 'index.pkl'))
+    sorted_ids = doc_ids[order].tolist()
+    _dump(dict(zip(sorted_ids, np.array(lengths, dtype=np.int64)[order].tolist())),
+          os.path.join(out_dir, 'doc_len', 'doc_len.pkl'))
+    _dump(dict(zip(sorted_ids, np.sqrt(norms).tolist())), os.path.join(out_dir, 'doc_norms', 'doc_norms.pkl'))
+    _dump(dict(zip(doc_ids.tolist(), titles)), os.path.join(out_dir, 'titles', 'doc_titles.pkl'))
+    shutil.rmtree(run_dir, ignore_errors=True)
+    stats = {'documents': len(doc_ids), 'runs': n_runs,
+             'terms': {folder: len(index.df) for folder, index in indices.items()}}
+    print(f"built {stats}")
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Builds the indices of a corpus in the bucket layout.")
+    parser.add_argument('corpus', help="JSONL corpus (.jsonl, .gz, .bz2) or Wikipedia XML dump (.xml, .xml.bz2)")
+    parser.add_argument('out_dir', help="output directory")
+    parser.add_argument('--workers', type=int, default=BUILD_WORKERS)
+    parser.add_argument('--chunk-mb', type=float, default=CHUNK_BYTES / 2 ** 20, help="MB of text per chunk")
+    args = parser.parse_args()
+    reader = read_dump_chunks if '.xml' in os.path.basename(args.corpus) else read_jsonl_chunks
+    build_index(reader(args.corpus, int(args.chunk_mb * 2 ** 20)), args.out_dir, args.workers)
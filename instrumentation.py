@@ -0,0 +1,437 @@
+import contextvars
+import os
+import sys
+import threading
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from time import perf_counter
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (1, 10, 100, 1000, 10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7)
+SLOW_TRACE_SECONDS = None  # requests slower than this are printed with their trace, None disables it
+PROFILER_INTERVAL = 0.01
+PROFILER_DEPTH = 64
+PROFILER_INTERVAL_RANGE = (0.001, 1.0)  # seconds, the sampling intervals accepted by the /profiler endpoint
+PROFILER_ENDPOINT_ENV = "IR_PROFILER_ENDPOINT"  # set to 1 to serve /profiler
+UNMATCHED_ENDPOINT = "unmatched"  # endpoint label of the requests which match no route
+
+_current_trace = contextvars.ContextVar('trace', default=None)
+_local = threading.local()
+
+
+class Trace:
+    """
+    Stage timings and counters of a single request.
+    Stage times are exclusive - the time of a nested stage is not counted in the stage around it. Stages of legs that
+    run concurrently are all counted, so their sum can be larger than the request duration.
+    """
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.stages = defaultdict(float)
+        self.counters = defaultdict(int)
+        self.duration = None
+        self._start = perf_counter()
+        self._lock = threading.Lock()
+
+    def add_time(self, stage_name, seconds):
+        with self._lock:
+            self.stages[stage_name] += seconds
+
+    def add_count(self, name, n):
+        with self._lock:
+            self.counters[name] += n
+
+    def finish(self):
+        self.duration = perf_counter() - self._start
+        return self.duration
+
+    def to_dict(self):
+        """
+        :return: Dictionary of the endpoint, duration, stage timings and counters.
+        """
+        with self._lock:
+            return {'endpoint': self.endpoint, 'duration': self.duration, 'stages': dict(self.stages),
+                    'counters': dict(self.counters)}
+
+
+def current_trace():
+    """
+    :return: the Trace of the running request, or None when the request is not traced.
+    """
+    return _current_trace.get()
+
+
+def start_trace(endpoint):
+    """
+    Starts tracing a request in the current context.
+    Work submitted to other threads is traced when it runs in a copy of the context (`contextvars.copy_context`).
+    :param endpoint: endpoint name, used as a metric label.
+    :return: token to pass to `finish_trace`.
+    """
+    return _current_trace.set(Trace(endpoint))
+
+
+def finish_trace(token, error=None):
+    """
+    Ends the trace of the current context and adds it to the metrics.
+    :param token: token returned by `start_trace`.
+    :param error: the exception the request failed with, if any.
+    :return: the finished Trace.
+    """
+    trace = _current_trace.get()
+    _current_trace.reset(token)
+    trace.finish()
+    metrics.record_trace(trace, error)
+    if SLOW_TRACE_SECONDS is not None and trace.duration >= SLOW_TRACE_SECONDS:
+        print(f"slow request {trace.to_dict()}")
+    return trace
+
+
+@contextmanager
+def trace(endpoint):
+    """
+    Traces the requests made inside the block, used as `with trace("/search"):`.
+    :param endpoint: endpoint name, used as a metric label.
+    """
+    token = start_trace(endpoint)
+    error = None
+    try:
+        yield current_trace()
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        finish_trace(token, error)
+
+
+@contextmanager
+def stage(name):
+    """
+    Times a stage of the current request, used as `with stage("score"):`. Does nothing outside of a trace.
+    :param name: stage name.
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    stack = getattr(_local, 'stages', None)
+    if stack is None:
+        stack = _local.stages = []
+    now = perf_counter()
+    if stack:
+        parent = stack[-1]
+        trace.add_time(parent[0], now - parent[1])
+    entry = [name, now]
+    stack.append(entry)
+    try:
+        yield
+    finally:
+        now = perf_counter()
+        stack.pop()
+        trace.add_time(name, now - entry[1])
+        if stack:
+            stack[-1][1] = now
+
+
+def count(name, n=1):
+    """
+    Adds to a counter of the current request, like the number of postings touched. Does nothing outside of a trace.
+    :param name: counter name.
+    :param n: amount to add.
+    """
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_count(name, n)
+
+
+class Histogram:
+    """ Cumulative-bucket histogram, like a Prometheus histogram. """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """
+        Estimates a quantile by linear interpolation inside its bucket.
+        :param q: quantile in [0, 1].
+        :return: estimated value, or None if nothing was observed.
+        """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                low = self.buckets[i - 1] if i else 0.0
+                return low + (self.buckets[i] - low) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+
+class MetricsRegistry:
+    """
+    Thread-safe histograms and counters, keyed by metric name and labels.
+    Rendered in the Prometheus text format by `render`, or as a dictionary by `snapshot`.
+    """
+
+    def __init__(self):
+        self._histograms = {}  # (name, labels): Histogram
+        self._counters = defaultdict(float)  # (name, labels): value
+        self._lock = threading.Lock()
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        """
+        Adds a value to a histogram.
+        :param name: metric name.
+        :param value: observed value.
+        :param buckets: bucket upper bounds, used when the histogram is created.
+        :param labels: metric labels.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def inc(self, name, n=1, **labels):
+        """
+        Adds to a counter.
+        :param name: metric name.
+        :param n: amount to add.
+        :param labels: metric labels.
+        """
+        with self._lock:
+            self._counters[(name, tuple(sorted(labels.items())))] += n
+
+    def record_trace(self, trace, error=None):
+        """
+        Adds a finished request trace to the request, stage and counter histograms.
+        :param trace: finished Trace object.
+        :param error: the exception the request failed with, if any.
+        """
+        endpoint = trace.endpoint
+        self.inc('ir_requests_total', endpoint=endpoint, status='error' if error is not None else 'ok')
+        self.observe('ir_request_seconds', trace.duration, endpoint=endpoint)
+        snapshot = trace.to_dict()
+        for stage_name, seconds in snapshot['stages'].items():
+            self.observe('ir_stage_seconds', seconds, endpoint=endpoint, stage=stage_name)
+        for name, n in snapshot['counters'].items():
+            self.observe('ir_request_items', n, COUNT_BUCKETS, endpoint=endpoint, item=name)
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{k}="{str(v)}"' for k, v in pairs) + '}'
+
+    def render(self, gauges=None):
+        """
+        Renders the metrics in the Prometheus text exposition format.
+        :param gauges: Optional dictionary - metric name: value, of gauges to add, like the cache counters.
+        :return: String.
+        """
+        lines = []
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} counter')
+            lines.append(f'{name}{self._labels(labels)} {value:g}')
+        for (name, labels), histogram in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} histogram')
+            cumulative = 0
+            for bound, n in zip(list(histogram.buckets) + ['+Inf'], histogram.counts):
+                cumulative += n
+                lines.append(f'{name}_bucket{self._labels(labels, [("le", bound)])} {cumulative}')
+            lines.append(f'{name}_sum{self._labels(labels)} {histogram.sum:g}')
+            lines.append(f'{name}_count{self._labels(labels)} {histogram.count}')
+        for name, value in sorted((gauges or {}).items()):
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {value:g}')
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """
+        :return: Dictionary of the counters, and of the count, mean and estimated p50/p95/p99 of every histogram.
+        """
+        with self._lock:
+            histograms = list(self._histograms.items())
+            counters = list(self._counters.items())
+        res = {'counters': [dict(labels, name=name, value=value) for (name, labels), value in counters],
+               'histograms': []}
+        for (name, labels), histogram in histograms:
+            res['histograms'].append(dict(labels, name=name, count=histogram.count,
+                                          mean=histogram.sum / histogram.count if histogram.count else None,
+                                          p50=histogram.quantile(0.5), p95=histogram.quantile(0.95),
+                                          p99=histogram.quantile(0.99)))
+        return res
+
+    def stage_summary(self):
+        """
+        :return: Dictionary - endpoint: stage name: (count, mean seconds, estimated p95 seconds).
+        """
+        res = defaultdict(dict)
+        with self._lock:
+            for (name, labels), histogram in self._histograms.items():
+                if name == 'ir_stage_seconds' and histogram.count:
+                    labels = dict(labels)
+                    res[labels['endpoint']][labels['stage']] = {'count': histogram.count,
+                                                                'mean': histogram.sum / histogram.count,
+                                                                'p95': histogram.quantile(0.95)}
+        return dict(res)
+
+    def _after_fork(self):
+        """
+        Resets the lock in a forked process, where the parent's thread holding it doesn't exist.
+        """
+        self._lock = threading.Lock()
+
+
+def flatten_gauges(prefix, stats):
+    """
+    Flattens nested counter dictionaries (like `SearchHandler.cache_stats()`) to gauge names.
+    :param prefix: name prefix.
+    :param stats: Dictionary of numbers or nested dictionaries.
+    :return: Dictionary - gauge name: value.
+    """
+    res = {}
+    for key, value in stats.items():
+        name = f'{prefix}_{key}'
+        if isinstance(value, dict):
+            res.update(flatten_gauges(name, value))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            res[name] = value
+    return res
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler which can be started and stopped at runtime.
+    A background thread samples the stacks of all the other threads every `interval` seconds, and counts each
+    distinct stack. The result can be rendered in the folded format of flame graph tools.
+    """
+
+    def __init__(self):
+        self.stacks = Counter()
+        self.samples = 0
+        self.interval = PROFILER_INTERVAL
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval=PROFILER_INTERVAL, max_depth=PROFILER_DEPTH):
+        """
+        Starts sampling, keeping the samples collected so far.
+        :param interval: seconds between samples.
+        :param max_depth: number of innermost frames kept of every stack.
+        :return: False if the profiler was already running.
+        """
+        with self._lock:
+            if self.running:
+                return False
+            self.interval = interval
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, args=(interval, max_depth), name="sampling-profiler",
+                                            daemon=True)
+            self._thread.start()
+            return True
+
+    def stop(self):
+        """
+        Stops sampling.
+        :return: False if the profiler was not running.
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is None:
+            return False
+        self._stop.set()
+        thread.join()
+        return True
+
+    def reset(self):
+        with self._lock:
+            self.stacks.clear()
+            self.samples = 0
+
+    def _run(self, interval, max_depth):
+        own = threading.get_ident()
+        while not self._stop.wait(interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            stacks = [self._stack(names.get(ident, str(ident)), frame, max_depth)
+                      for ident, frame in sys._current_frames().items() if ident != own]
+            with self._lock:
+                self.stacks.update(stacks)
+                self.samples += 1
+
+    @staticmethod
+    def _stack(thread_name, frame, max_depth):
+        functions = []
+        while frame is not None and len(functions) < max_depth:
+            code = frame.f_code
+            functions.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+            frame = frame.f_back
+        functions.append(thread_name)
+        return ';'.join(reversed(functions))
+
+    def report(self, limit=50):
+        """
+        :param limit: number of stacks and functions to return.
+        :return: Dictionary of the profiler state, the most sampled stacks, and the most sampled innermost functions.
+        """
+        with self._lock:
+            stacks = self.stacks.most_common(limit)
+            leaves = Counter()
+            for stack, n in self.stacks.items():
+                leaves[stack.rsplit(';', 1)[-1]] += n
+            return {'running': self.running, 'interval': self.interval, 'samples': self.samples,
+                    'stacks': stacks, 'functions': leaves.most_common(limit)}
+
+    def folded(self):
+        """
+        :return: String - the samples in the folded stack format ("frame;frame;frame count" per line).
+        """
+        with self._lock:
+            return ''.join(f'{stack} {n}\n' for stack, n in self.stacks.most_common())
+
+    def _after_fork(self):
+        """
+        Resets the lock and the sampling thread in a forked process, where the parent's threads don't exist.
+        """
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+
+metrics = MetricsRegistry()
+profiler = SamplingProfiler()
+os.register_at_fork(after_in_child=metrics._after_fork)
+os.register_at_fork(after_in_child=profiler._after_fork)
@@ -0,0 +1,295 @@
+import json
+import os
+import pickle
+import shutil
+import sys
+from collections.abc import ItemsView, Mapping
+import numpy as np
+
+LEXICON_FORMAT = 1
+LEXICON_DIR = "lexicon"
+PREFIX_BYTES = 8  # bytes of a term kept in the sorted prefix keys
+
+
+def _encode(term):
+    return term.encode('utf-8', 'surrogatepass')
+
+
+def _prefix_keys(encoded):
+    """
+    Returns the first PREFIX_BYTES bytes of every term, zero padded, as big-endian integers. Their order is the byte
+    order of the terms, up to ties between terms with the same prefix.
+    :param encoded: List of UTF-8 encoded terms.
+    :return: numpy uint64 array.
+    """
+    keys = b''.join([term[:PREFIX_BYTES].ljust(PREFIX_BYTES, b'\0') for term in encoded])
+    return np.frombuffer(keys, dtype='>u8').astype(np.uint64)
+
+
+def source_id(path):
+    """
+    Identifies the version of a local index file, by the bucket generation it was downloaded from, or by its size
+    and modification time.
+    :param path: path of the .pkl file.
+    :return: String.
+    """
+    from startup import local_generation
+    generation = local_generation(path)
+    if generation is not None:
+        return f"generation:{generation}"
+    st = os.stat(path)
+    return f"stat:{st.st_size}:{st.st_mtime_ns}"
+
+
+class _ItemsView(ItemsView):
+    def __iter__(self):
+        return self._mapping.iter_items()
+
+
+class LexiconView(Mapping):
+    """
+    Read-only dictionary-like view of one column of a Lexicon, standing in for the `df` and `posting_locs`
+    dictionaries of an InvertedIndex. Iteration is in term order.
+    """
+
+    def __init__(self, lexicon, value, present):
+        self.lexicon = lexicon
+        self._value = value
+        self._present = np.asarray(present)
+        self._len = int(np.count_nonzero(present))
+
+    def __getitem__(self, term):
+        pos = self.lexicon.find(term)
+        if pos < 0 or not self._present[pos]:
+            raise KeyError(term)
+        return self._value(pos)
+
+    def __contains__(self, term):
+        pos = self.lexicon.find(term)
+        return pos >= 0 and bool(self._present[pos])
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return (self.lexicon.term(pos) for pos in np.flatnonzero(self._present).tolist())
+
+    def items(self):
+        return _ItemsView(self)
+
+    def iter_items(self):
+        """
+        Iterates the (term, value) pairs by position, without looking every term up.
+        """
+        return ((self.lexicon.term(pos), self._value(pos)) for pos in np.flatnonzero(self._present).tolist())
+
+
+class Lexicon:
+    """
+    Compact, memory-mappable replacement of the `df` and `posting_locs` dictionaries of a pickled InvertedIndex.
+    The terms are kept sorted in one UTF-8 blob with an offsets array, and the term at position i has its df at
+    df[i] and its posting locations at loc_files/loc_offsets[loc_starts[i]:loc_starts[i + 1]]. A term is found by a
+    binary search of the first bytes of the terms (`prefixes`), then of the terms sharing its prefix.
+    `df` and `posting_locs` are read-only dictionaries, so BM25, Calculator and BucketIndexLoader use a Lexicon like an
+    InvertedIndex. The `term_total` counts are not kept. Other per-term arrays can be saved with the lexicon, and are
+    loaded into `extra`.
+    """
+
+    def __init__(self, blob, offsets, prefixes, df, has_df, loc_starts, loc_files, loc_offsets, has_locs, file_names):
+        self.blob = blob
+        self.offsets = offsets
+        self.prefixes = prefixes
+        self._df = df
+        self.loc_starts = loc_starts
+        self.loc_files = loc_files
+        self.loc_offsets = loc_offsets
+        self.has_df = has_df
+        self.has_locs = has_locs
+        self.file_names = file_names
+        # Plain views of the arrays for the lookups, which are much faster to index than numpy memmaps.
+        self._blob = memoryview(np.asarray(blob))
+        self._offsets = memoryview(np.asarray(offsets))
+        self._prefixes = np.asarray(prefixes)
+        self._loc_starts = memoryview(np.asarray(loc_starts))
+        self._loc_files = np.asarray(loc_files)
+        self._loc_offsets = np.asarray(loc_offsets)
+        df_values = memoryview(np.asarray(df))
+        self.df = LexiconView(self, df_values.__getitem__, has_df)
+        self.posting_locs = LexiconView(self, self.locs, has_locs)
+        self.extra = {}
+
+    @staticmethod
+    def build(index):
+        """
+        Building a lexicon from an InvertedIndex.
+        :param index: InvertedIndex object, or any object with `df` and `posting_locs` dictionaries.
+        :return: Lexicon object.
+        """
+        terms = sorted(set(index.df.keys()) | set(index.posting_locs.keys()), key=_encode)
+        encoded = [_encode(term) for term in terms]
+        n_terms = len(terms)
+        offsets = np.zeros(n_terms + 1, dtype=np.int64)
+        np.cumsum([len(term) for term in encoded], out=offsets[1:])
+        blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        df = np.fromiter((index.df.get(term, 0) for term in terms), dtype=np.int64, count=n_terms)
+        has_df = np.fromiter((term in index.df for term in terms), dtype=bool, count=n_terms)
+        has_locs = np.fromiter((term in index.posting_locs for term in terms), dtype=bool, count=n_terms)
+        file_ids = {}
+        loc_counts = np.zeros(n_terms, dtype=np.int64)
+        loc_files, loc_offsets = [], []
+        for i, term in enumerate(terms):
+            locs = index.posting_locs[term] if has_locs[i] else ()
+            loc_counts[i] = len(locs)
+            for f_name, offset in locs:
+                loc_files.append(file_ids.setdefault(f_name, len(file_ids)))
+                loc_offsets.append(offset)
+        loc_starts = np.zeros(n_terms + 1, dtype=np.int64)
+        np.cumsum(loc_counts, out=loc_starts[1:])
+        return Lexicon(blob, offsets, _prefix_keys(encoded), df, has_df, loc_starts,
+                       np.array(loc_files, dtype=np.uint32), np.array(loc_offsets, dtype=np.int64), has_locs,
+                       list(file_ids))
+
+    def save(self, folder, source=None, extra=None):
+        """
+        Saving the lexicon as .npy files in a folder, replacing the previous content of the folder atomically.
+        :param folder: folder path.
+        :param source: Optional identifier of the index file the lexicon was built from, see `source_id`.
+        :param extra: Optional dictionary - name: numpy array aligned with the term positions, loaded into `extra`.
+        """
+        tmp_dir = f"{folder}.part"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        extra = extra or {}
+        arrays = {'terms': self.blob, 'offsets': self.offsets, 'prefixes': self.prefixes, 'df': self._df,
+                  'has_df': self.has_df, 'loc_starts': self.loc_starts, 'loc_files': self.loc_files,
+                  'loc_offsets': self.loc_offsets, 'has_locs': self.has_locs, **extra}
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_dir, f'{name}.npy'), array)
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump({'format': LEXICON_FORMAT, 'source': source, 'file_names': self.file_names,
+                       'sizes': {name: len(array) for name, array in arrays.items()}, 'extra': list(extra)}, f)
+        old_dir = f"{folder}.old"
+        shutil.rmtree(old_dir, ignore_errors=True)
+        if os.path.exists(folder):
+            os.replace(folder, old_dir)
+        os.replace(tmp_dir, folder)
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+    @staticmethod
+    def load(folder, mmap_mode='r'):
+        """
+        Loading a lexicon saved with `save`.
+        :param folder: folder path.
+        :param mmap_mode: numpy memory-map mode, None to read the arrays into memory.
+        :return: Lexicon object.
+        """
+        meta = Lexicon.meta(folder)
+        if meta is None or meta['format'] != LEXICON_FORMAT:
+            raise ValueError(f"no lexicon of format {LEXICON_FORMAT} in {folder}")
+        # An empty array can't be memory-mapped.
+        arrays = {name: np.load(os.path.join(folder, f'{name}.npy'), mmap_mode=mmap_mode if size else None)
+                  for name, size in meta['sizes'].items()}
+        lexicon = Lexicon(arrays['terms'], arrays['offsets'], arrays['prefixes'], arrays['df'], arrays['has_df'],
+                          arrays['loc_starts'], arrays['loc_files'], arrays['loc_offsets'], arrays['has_locs'],
+                          meta['file_names'])
+        lexicon.extra = {name: arrays[name] for name in meta.get('extra', ())}
+        return lexicon
+
+    @staticmethod
+    def meta(folder):
+        """
+        :param folder: folder path.
+        :return: the metadata dictionary of a saved lexicon, or None if there is none.
+        """
+        try:
+            with open(os.path.join(folder, 'meta.json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def folder(folder_name, directory='.'):
+        """
+        :return: path of the lexicon of an index folder.
+        """
+        return os.path.join(directory, LEXICON_DIR, folder_name)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def _term_bytes(self, pos):
+        return self._blob[self._offsets[pos]:self._offsets[pos + 1]].tobytes()
+
+    def term(self, pos):
+        """
+        :param pos: position of a term.
+        :return: String - the term.
+        """
+        return self._term_bytes(pos).decode('utf-8', 'surrogatepass')
+
+    def find(self, term):
+        """
+        Finds the position of a term.
+        :param term: String.
+        :return: position of the term, -1 if it is not in the lexicon.
+        """
+        if not isinstance(term, str):
+            return -1
+        key = _encode(term)
+        prefix = int.from_bytes(key[:PREFIX_BYTES].ljust(PREFIX_BYTES, b'\0'), 'big')
+        if prefix < 2 ** 64 - 1:
+            lo, hi = np.searchsorted(self._prefixes, np.array([prefix, prefix + 1], dtype=np.uint64)).tolist()
+        else:
+            lo, hi = int(np.searchsorted(self._prefixes, np.uint64(prefix))), len(self._prefixes)
+        while hi - lo > 1:  # terms sharing the prefix
+            mid = (lo + hi) // 2
+            if self._term_bytes(mid) <= key:
+                lo = mid
+            else:
+                hi = mid
+        if lo < hi and self._term_bytes(lo) == key:
+            return lo
+        return -1
+
+    def locs(self, pos):
+        """
+        :param pos: position of a term.
+        :return: List of (file_name, offset) tuples of the term's posting list.
+        """
+        start, end = self._loc_starts[pos], self._loc_starts[pos + 1]
+        return [(self.file_names[f], offset) for f, offset in zip(self._loc_files[start:end].tolist(),
+                                                                  self._loc_offsets[start:end].tolist())]
+
+
+def load_or_convert(pkl_path, folder):
+    """
+    Memory-maps the lexicon of an index, converting the pickled index first if the lexicon is missing or was built
+    from another version of the file.
+    :param pkl_path: path of the pickled InvertedIndex.
+    :param folder: folder of the lexicon.
+    :return: Lexicon object.
+    """
+    source = source_id(pkl_path)
+    meta = Lexicon.meta(folder)
+    if meta is None or meta.get('format') != LEXICON_FORMAT or meta.get('source') != source:
+        convert(pkl_path, folder, source)
+    return Lexicon.load(folder)
+
+
+def convert(pkl_path, folder, source=None):
+    """
+    Converting a pickled InvertedIndex (like index.pkl) to a lexicon.
+    :param pkl_path: path of the .pkl file.
+    :param folder: folder to save the lexicon to.
+    :param source: Optional identifier of the .pkl file, computed if not given.
+    """
+    source = source_id(pkl_path) if source is None else source
+    with open(pkl_path, 'rb') as f:
+        index = pickle.load(f)
+    Lexicon.build(index).save(folder, source)
+    print(f"converted {pkl_path} to the lexicon in {folder}")
+
+
+if __name__ == '__main__':
+    # python lexicon.py <folder_name> - converts the local {folder_name}.pkl index to its lexicon.
+    convert(f'{sys.argv[1]}.pkl', Lexicon.folder(sys.argv[1]))
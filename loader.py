@@ -4,21 +4,40 @@ import pickle
 from sklearn.preprocessing import MinMaxScaler
 import numpy as np
 import pandas as pd
-from google.cloud import storage
 from inverted_index_gcp import InvertedIndex, TUPLE_SIZE
-from multifilereader import MultiFileReader
-from contextlib import closing
+from posting_store import posting_store
+from instrumentation import stage, count
+from cache import posting_cache
+from posting_compression import CompressedPostingReader
+from block_store import block_store, shared_client
+from lexicon import Lexicon, load_or_convert
+from multifilereader import POSTING_DTYPE
+
+
+assert POSTING_DTYPE.itemsize == TUPLE_SIZE
+# Load the indices as memory-mapped lexicons, converted once from each index.pkl, instead of unpickling them.
+USE_LEXICON = True
 
 
 def _hash(s):
     return hashlib.blake2b(bytes(s, encoding='utf8'), digest_size=5).hexdigest()
 
 
+def empty_posting_arrays():
+    """
+    Creates an empty pair of posting arrays.
+    :return: tuple of (doc_ids, tfs) numpy arrays of length 0.
+    """
+    return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int32)
+
+
 class BucketIndexLoader:
+    # folder name: CompressedPostingReader, for folders that are read from the compressed posting format.
+    compressed_readers = {}
 
     def __init__(self, bucket_name):
         self.bucket_name = bucket_name
-        self.client = storage.Client()
+        self.client = shared_client()
         self.bucket = self.client.get_bucket(bucket_name)
 
     def load_all_indices(self):
@@ -36,14 +55,17 @@ class BucketIndexLoader:
 
     def load_index_from_folder(self, folder_name):
         """
-        Loading an index from the .pkl file in a given folder.
+        Loading an index from the .pkl file in a given folder. With USE_LEXICON, the index is memory-mapped from its
+        lexicon, which is converted from the .pkl file when it is missing or stale.
         :param folder_name: folder name.
-        :return: InvertedIndex object.
+        :return: InvertedIndex object, or a Lexicon with the same `df` and `posting_locs` dictionaries.
         """
         path = f"postings_gcp/{folder_name}/index.pkl"
         if not os.path.exists(f'{folder_name}.pkl'):
             blob = self.bucket.get_blob(path)
             blob.download_to_filename(f'{folder_name}.pkl')
+        if USE_LEXICON:
+            return load_or_convert(f'{folder_name}.pkl', Lexicon.folder(folder_name))
         with open(f'{folder_name}.pkl', 'rb') as f:
             return pickle.load(f)
 
@@ -80,8 +102,9 @@ class BucketIndexLoader:
         Loading the page views dictionary from the .pkl file.
         :return: page views dictionary.
         """
-        blob = self.bucket.get_blob('pv/page_views.pkl')
-        blob.download_to_filename(f'page_views.pkl')
+        if not os.path.exists("page_views.pkl"):
+            blob = self.bucket.get_blob('pv/page_views.pkl')
+            blob.download_to_filename(f'page_views.pkl')
         with open(f'page_views.pkl', 'rb') as f:
             pv = pickle.load(f)
         return pv
@@ -95,22 +118,83 @@ class BucketIndexLoader:
         :param folder_name: folder name
         :return: posting list of the token
         """
+        doc_ids, tfs = BucketIndexLoader.load_posting_arrays_for_token(token, index, folder_name)
+        return list(zip(doc_ids.tolist(), tfs.tolist()))
+
+    @staticmethod
+    def load_posting_arrays_for_token(token, index: InvertedIndex, folder_name):
+        """
+        Loading the posting list of a specific token as parallel numpy arrays.
+        Decoded lists are kept in the shared posting list cache, so the returned arrays are read-only.
+        :param token: String
+        :param index: InvertedIndex object
+        :param folder_name: folder name
+        :return: tuple of (doc_ids, tfs) numpy arrays of the token
+        """
+        if getattr(index, 'segmented', False):  # a SegmentedIndex merges the lists of its segments
+            return index.posting_arrays(token)
         if token not in index.posting_locs:
-            return []
+            return empty_posting_arrays()
+        doc_ids, tfs = posting_cache.get_or_load(
+            (folder_name, token), lambda: BucketIndexLoader.read_posting_arrays(token, index, folder_name))
+        count('postings', len(doc_ids))
+        return doc_ids, tfs
+
+    @staticmethod
+    def read_posting_arrays(token, index: InvertedIndex, folder_name):
+        """
+        Reading and decoding the posting list of a specific token, bypassing the cache.
+        :param token: String
+        :param index: InvertedIndex object
+        :param folder_name: folder name
+        :return: tuple of (doc_ids, tfs) numpy arrays of the token
+        """
+        reader = BucketIndexLoader.compressed_readers.get(folder_name)
+        if reader is not None:
+            return reader.read_arrays(token)
         locs = index.posting_locs[token]
-        for f_name, pos in locs:
-            name = f"{folder_name}_{f_name}"
-            if not os.path.exists(name):
-                loader = BucketIndexLoader("project_bucket_316533942")
-                loader.bucket.get_blob(f"postings_gcp/{folder_name}/{f_name}").download_to_filename(name)
-        with closing(MultiFileReader(folder_name)) as reader:
-            b = reader.read(locs, index.df[token] * TUPLE_SIZE)
-            posting_list = []
-            for i in range(index.df[token]):
-                doc_id = int.from_bytes(b[i * TUPLE_SIZE:i * TUPLE_SIZE + 4], 'big')
-                tf = int.from_bytes(b[i * TUPLE_SIZE + 4:(i + 1) * TUPLE_SIZE], 'big')
-                posting_list.append((doc_id, tf))
-            return posting_list
+        n_bytes = index.df[token] * TUPLE_SIZE
+        try:
+            with stage('fetch_disk'):
+                b = posting_store.read(locs, n_bytes, folder_name)
+            count('lists_disk')
+        except FileNotFoundError:  # read the blocks of the list from the block cache, or the bucket
+            with stage('fetch_bucket'):
+                b = block_store.read(locs, n_bytes, folder_name)
+            count('lists_bucket')
+        with stage('decode'):
+            return BucketIndexLoader.decode_posting_arrays(b, index.df[token])
+
+    @staticmethod
+    def use_compressed_postings(folder_name, directory='.'):
+        """
+        Selecting the compressed posting format for an index folder, which must have been converted before with
+        posting_compression.convert_folder.
+        :param folder_name: folder name
+        :param directory: directory of the compressed files.
+        """
+        BucketIndexLoader.compressed_readers[folder_name] = CompressedPostingReader(folder_name, directory)
+        posting_cache.clear(folder_name)
+
+    @staticmethod
+    def use_raw_postings(folder_name):
+        """
+        Selecting the raw .bin posting format for an index folder.
+        :param folder_name: folder name
+        """
+        BucketIndexLoader.compressed_readers.pop(folder_name, None)
+        posting_cache.clear(folder_name)
+
+    @staticmethod
+    def decode_posting_arrays(b, n_postings):
+        """
+        Decoding a raw posting list buffer without creating a Python object per posting.
+        :param b: bytes-like buffer of n_postings * TUPLE_SIZE bytes.
+        :param n_postings: number of postings in the buffer.
+        :return: tuple of (doc_ids, tfs) numpy arrays
+        """
+        postings = np.frombuffer(b, dtype=POSTING_DTYPE, count=n_postings)
+        return postings['doc_id'].astype(np.int64), postings['tf'].astype(np.int32)
 
     def load_doc_titles(self):
         """
@@ -0,0 +1,74 @@
+import os
+import shutil
+
+# When this environment variable names a directory, the loaders read the "bucket" from it instead of GCS.
+LOCAL_BUCKET_ENV = "IR_LOCAL_BUCKET_DIR"
+
+
+class LocalBlob:
+    """ A file in a LocalBucket, with the parts of the google.cloud.storage.Blob API the loaders use. """
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.path = os.path.join(bucket.root, name)
+        st = os.stat(self.path)
+        self.size = st.st_size
+        self.generation = st.st_mtime_ns
+
+    def download_to_filename(self, filename):
+        shutil.copyfile(self.path, filename)
+
+    def download_as_bytes(self, start=None, end=None):
+        """
+        Reads the blob, or the inclusive byte range [start, end] of it like GCS ranged reads.
+        """
+        with open(self.path, 'rb') as f:
+            if start is None:
+                return f.read()
+            f.seek(start)
+            return f.read(-1 if end is None else end - start + 1)
+
+
+class LocalBucket:
+    """ A local directory standing in for a GCS bucket - blob names are paths relative to the root. """
+
+    def __init__(self, root, name):
+        self.root = root
+        self.name = name
+
+    def get_blob(self, blob_name):
+        if not os.path.isfile(os.path.join(self.root, blob_name)):
+            return None
+        return LocalBlob(self, blob_name)
+
+    def blob(self, blob_name):
+        return LocalBlob(self, blob_name)
+
+
+class LocalClient:
+    """ A local directory standing in for google.cloud.storage.Client, so the engine can run offline. """
+
+    def __init__(self, root):
+        self.root = root
+
+    def get_bucket(self, bucket_name):
+        return LocalBucket(self.root, bucket_name)
+
+    def bucket(self, bucket_name):
+        return LocalBucket(self.root, bucket_name)
+
+    def list_blobs(self, bucket_name, prefix=''):
+        bucket = LocalBucket(self.root, bucket_name)
+        for dir_path, _, file_names in os.walk(self.root):
+            for file_name in sorted(file_names):
+                name = os.path.relpath(os.path.join(dir_path, file_name), self.root).replace(os.sep, '/')
+                if name.startswith(prefix):
+                    yield LocalBlob(bucket, name)
+
+
+def local_bucket_dir():
+    """
+    :return: the local bucket directory, or None when the real bucket should be used.
+    """
+    return os.environ.get(LOCAL_BUCKET_ENV) or None
@@ -1,5 +1,8 @@
+import numpy as np
 
 BLOCK_SIZE = 1999998
+# On-disk layout of a single posting: 4 bytes big-endian doc_id followed by 2 bytes big-endian tf.
+POSTING_DTYPE = np.dtype([('doc_id', '>u4'), ('tf', '>u2')])
 
 
 class MultiFileReader:
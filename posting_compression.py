@@ -0,0 +1,203 @@
+import glob
+import os
+import pickle
+import sys
+from time import time_ns
+import numpy as np
+from lexicon import Lexicon
+from posting_store import posting_store
+from instrumentation import stage, count
+
+COMPRESSED_FORMAT = 2
+COMPRESSED_SOURCE = f"compressed postings v{COMPRESSED_FORMAT}"  # source of the lexicons of the compressed format
+
+
+def encode_varints(values):
+    """
+    Encodes non-negative integers as variable-byte codes: 7 bits per byte, low bits first, the high bit of a byte is
+    set when more bytes of the same value follow.
+    :param values: numpy array of non-negative integers smaller than 2 ** 35.
+    :return: numpy uint8 array.
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    n_bytes = np.ones(len(values), dtype=np.int64)
+    for k in range(1, 5):
+        n_bytes += values >= np.uint64(1 << (7 * k))
+    starts = np.cumsum(n_bytes) - n_bytes
+    value_idx = np.repeat(np.arange(len(values)), n_bytes)
+    byte_pos = np.arange(len(value_idx)) - starts[value_idx]
+    out = ((values[value_idx] >> (7 * byte_pos).astype(np.uint64)) & np.uint64(0x7f)).astype(np.uint8)
+    out[byte_pos < n_bytes[value_idx] - 1] |= 0x80
+    return out
+
+
+def decode_varints(buf):
+    """
+    Decodes a buffer of variable-byte codes written by `encode_varints`, without a Python loop.
+    :param buf: bytes-like buffer.
+    :return: numpy uint64 array of the values.
+    """
+    b = np.frombuffer(buf, dtype=np.uint8)
+    ends = np.flatnonzero(b < 0x80)
+    if len(ends) == 0:
+        return np.empty(0, dtype=np.uint64)
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    value_idx = np.repeat(np.arange(len(ends)), ends - starts + 1)
+    shift = ((np.arange(len(value_idx)) - starts[value_idx]) * 7).astype(np.uint64)
+    parts = (b[:len(value_idx)] & 0x7f).astype(np.uint64) << shift
+    return np.add.reduceat(parts, starts)
+
+
+def encode_postings(doc_ids, tfs):
+    """
+    Encodes a posting list sorted by doc_id as interleaved (doc_id gap, tf) variable-byte codes.
+    :param doc_ids: numpy array of sorted doc_ids.
+    :param tfs: numpy array of matching term frequencies.
+    :return: encoded uint8 array.
+    """
+    doc_ids = np.asarray(doc_ids, dtype=np.int64)
+    values = np.empty(2 * len(doc_ids), dtype=np.uint64)
+    values[0::2] = np.diff(doc_ids, prepend=0)
+    values[1::2] = tfs
+    return encode_varints(values)
+
+
+def decode_postings(buf):
+    """
+    Decodes interleaved (doc_id gap, tf) variable-byte codes.
+    :param buf: bytes-like buffer of whole postings.
+    :return: tuple of (doc_ids, tfs) numpy arrays, with the same dtypes as the raw posting format.
+    """
+    values = decode_varints(buf)
+    doc_ids = np.cumsum(values[0::2].astype(np.int64))
+    return doc_ids, values[1::2].astype(np.int32)
+
+
+class CompressedPostingWriter:
+    """
+    Writes the compressed posting format of an index folder: a `{folder_name}_postings.<id>.vb` data file with all the
+    posting lists, and the `{folder_name}_postings` lexicon (see lexicon.Lexicon) with the df, the data file and
+    offset, and the byte size of every list. Every conversion writes a new data file, named in the lexicon, so
+    replacing the lexicon switches the readers to the new lists at once.
+    The writer has the `df` and `posting_locs` dictionaries of an InvertedIndex, from which the lexicon is built.
+    """
+
+    def __init__(self, folder_name, directory='.'):
+        self.folder_name = folder_name
+        self.directory = directory
+        self.data_name = f'{folder_name}_postings.{time_ns()}.vb'
+        self.df = {}
+        self.posting_locs = {}
+        self.n_bytes = {}
+        self._offset = 0
+        self._tmp_path = os.path.join(directory, self.data_name + '.part')
+        self._file = open(self._tmp_path, 'wb')
+
+    def add(self, token, doc_ids, tfs):
+        """
+        Adds the posting list of a token. Lists that are not sorted by doc_id are sorted.
+        :param token: String.
+        :param doc_ids: numpy array of doc_ids.
+        :param tfs: numpy array of matching term frequencies.
+        """
+        if len(doc_ids) > 1 and np.any(doc_ids[1:] < doc_ids[:-1]):
+            order = np.argsort(doc_ids, kind='stable')
+            doc_ids, tfs = doc_ids[order], tfs[order]
+        encoded = encode_postings(doc_ids, tfs)
+        self._file.write(encoded.tobytes())
+        self.df[token] = len(doc_ids)
+        self.posting_locs[token] = [(self.data_name, self._offset)]
+        self.n_bytes[token] = len(encoded)
+        self._offset += len(encoded)
+
+    def close(self):
+        """
+        Moves the data file to its final name, then replaces the lexicon, which switches the readers to the new data
+        file. Data files of older conversions are removed, except the one of the replaced lexicon, which running
+        readers may still use.
+        """
+        self._file.close()
+        os.replace(self._tmp_path, os.path.join(self.directory, self.data_name))
+        folder = CompressedPostingReader.lexicon_path(self.folder_name, self.directory)
+        previous = Lexicon.meta(folder) or {}
+        lexicon = Lexicon.build(self)
+        n_bytes = np.fromiter((self.n_bytes[lexicon.term(pos)] for pos in range(len(lexicon))), dtype=np.int64,
+                              count=len(lexicon))
+        lexicon.save(folder, source=COMPRESSED_SOURCE, extra={'n_bytes': n_bytes})
+        keep = {self.data_name, *previous.get('file_names', ())}
+        pattern = os.path.join(glob.escape(self.directory), f'{glob.escape(self.folder_name)}_postings.*.vb')
+        for path in glob.glob(pattern):
+            if os.path.basename(path) not in keep:
+                os.remove(path)
+
+
+class CompressedPostingReader:
+    """ Reads posting lists of an index folder written by CompressedPostingWriter. """
+
+    def __init__(self, folder_name, directory='.'):
+        self.folder_name = folder_name
+        self.directory = directory
+        folder = self.lexicon_path(folder_name, directory)
+        meta = Lexicon.meta(folder)
+        if meta is None or meta.get('source') != COMPRESSED_SOURCE:
+            raise ValueError(f"no compressed postings of format {COMPRESSED_FORMAT} for {folder_name}")
+        self.lexicon = Lexicon.load(folder)
+        self.n_bytes = self.lexicon.extra['n_bytes']
+
+    @staticmethod
+    def lexicon_path(folder_name, directory='.'):
+        """
+        :return: path of the compressed posting lexicon of a folder.
+        """
+        return os.path.join(directory, f'{folder_name}_postings')
+
+    @staticmethod
+    def exists(folder_name, directory='.'):
+        """
+        Checks if a folder was converted to the compressed format.
+        :param folder_name: folder name.
+        :param directory: directory of the compressed files.
+        :return: Boolean.
+        """
+        meta = Lexicon.meta(CompressedPostingReader.lexicon_path(folder_name, directory))
+        return meta is not None and meta.get('source') == COMPRESSED_SOURCE
+
+    def read_arrays(self, token):
+        """
+        Reads and decodes the whole posting list of a token.
+        :param token: String.
+        :return: tuple of (doc_ids, tfs) numpy arrays.
+        """
+        pos = self.lexicon.find(token)
+        if pos < 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int32)
+        (f_name, offset), = self.lexicon.locs(pos)
+        with stage('fetch_disk'):
+            buf = posting_store.read_range(os.path.join(self.directory, f_name), offset, int(self.n_bytes[pos]))
+        count('lists_disk')
+        with stage('decode'):
+            return decode_postings(buf)
+
+
+def convert_folder(index, folder_name, directory='.'):
+    """
+    Converts the raw .bin posting files of an index folder to the compressed format.
+    :param index: InvertedIndex object of the folder.
+    :param folder_name: folder name.
+    :param directory: directory to write the compressed files to.
+    """
+    from loader import BucketIndexLoader
+    writer = CompressedPostingWriter(folder_name, directory)
+    for token in index.posting_locs:
+        doc_ids, tfs = BucketIndexLoader.read_posting_arrays(token, index, folder_name)
+        writer.add(token, doc_ids, tfs)
+    writer.close()
+
+
+if __name__ == '__main__':
+    # python posting_compression.py <folder_name> - converts the folder, using the local {folder_name}.pkl index.
+    folder = sys.argv[1]
+    with open(f'{folder}.pkl', 'rb') as f:
+        convert_folder(pickle.load(f), folder)
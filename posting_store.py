@@ -0,0 +1,122 @@
+import mmap
+import os
+import threading
+from time import monotonic
+from multifilereader import BLOCK_SIZE
+
+
+class _MappedFile:
+    """ A single memory-mapped posting file and the identity of the file it was mapped from. """
+
+    __slots__ = ('view', 'identity', 'checked_at')
+
+    def __init__(self, view, identity, checked_at):
+        self.view = view
+        self.identity = identity
+        self.checked_at = checked_at
+
+
+class PostingStore:
+    """
+    Process-wide store of memory-mapped posting (.bin) files.
+    Every file is mapped once and shared by all the request threads, reads return zero-copy memoryview slices.
+    Files should be replaced atomically (write to a temporary name and os.replace it), the store notices the new
+    file within `recheck_interval` seconds and remaps it. Slices of the old mapping stay valid until released.
+    """
+
+    def __init__(self, recheck_interval=5.0):
+        self.recheck_interval = recheck_interval
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def read(self, locs, n_bytes, folder_name=None):
+        """
+        Reading n_bytes of a posting list, spread over the given locations.
+        :param locs: List of (file_name, offset) tuples, as stored in InvertedIndex.posting_locs.
+        :param n_bytes: Number of bytes to read.
+        :param folder_name: folder name, prefixed to the file names like in MultiFileReader.
+        :return: memoryview of the posting list bytes.
+        :raises FileNotFoundError: if one of the files does not exist locally.
+        """
+        chunks = []
+        for f_name, offset in locs:
+            if n_bytes <= 0:
+                break
+            if folder_name is not None:
+                f_name = f'{folder_name}_{f_name}'
+            n_read = min(n_bytes, BLOCK_SIZE - offset)
+            chunks.append(self._get_view(f_name)[offset:offset + n_read])
+            n_bytes -= n_read
+        if len(chunks) == 1:
+            return chunks[0]
+        # A posting list that crosses a file boundary has to be joined, this is the only copy made.
+        return memoryview(b''.join(chunks))
+
+    def read_range(self, path, offset, n_bytes):
+        """
+        Reading a byte range of a single file.
+        :param path: local file name.
+        :param offset: offset of the first byte.
+        :param n_bytes: Number of bytes to read.
+        :return: memoryview of the bytes.
+        :raises FileNotFoundError: if the file does not exist locally.
+        """
+        return self._get_view(path)[offset:offset + n_bytes]
+
+    def invalidate(self, path=None):
+        """
+        Dropping the mapping of a file (or of all files), so it is remapped on the next read.
+        :param path: local file name, or None for all files.
+        """
+        with self._lock:
+            if path is None:
+                self._files.clear()
+            else:
+                self._files.pop(path, None)
+
+    def _get_view(self, path):
+        """
+        Returning the memoryview of a mapped file, mapping or remapping it when needed.
+        :param path: local file name.
+        :return: memoryview over the whole file.
+        """
+        now = monotonic()
+        entry = self._files.get(path)
+        if entry is not None and now - entry.checked_at < self.recheck_interval:
+            return entry.view
+        with self._lock:
+            entry = self._files.get(path)
+            if entry is not None and now - entry.checked_at < self.recheck_interval:
+                return entry.view
+            st = os.stat(path)
+            identity = (st.st_ino, st.st_size, st.st_mtime_ns)
+            if entry is not None and entry.identity == identity:
+                entry.checked_at = now
+                return entry.view
+            # The previous mapping (if any) is not closed here - it is released once no slice references it.
+            entry = _MappedFile(self._map(path, st.st_size), identity, now)
+            self._files[path] = entry
+            return entry.view
+
+    @staticmethod
+    def _map(path, size):
+        """
+        Mapping a file read-only.
+        :param path: local file name.
+        :param size: file size in bytes.
+        :return: memoryview over the mapped file.
+        """
+        if size == 0:
+            return memoryview(b'')
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(mm)
+
+    def _after_fork(self):
+        """
+        Resets the lock in a forked process, where the parent's thread holding it doesn't exist.
+        """
+        self._lock = threading.Lock()
+
+posting_store = PostingStore()
+os.register_at_fork(after_in_child=posting_store._after_fork)
@@ -1,7 +1,12 @@
 import hashlib
+import math
+import os
 
-from flask import Flask, request, jsonify
-from backend import SearchHandler
+from flask import Flask, Response, request, jsonify, g, stream_with_context
+from backend import SearchHandler, RETRIEVAL_MODES
+import batch
+import instrumentation
+from instrumentation import metrics, profiler
 
 
 def _hash(s):
@@ -15,6 +20,24 @@ class MyFlaskApp(Flask):
 
 app = MyFlaskApp(__name__)
 app.config['JSONIFY_PRETTYPRINT_REGULAR'] = False
+UNTRACED_PATHS = ('/metrics', '/profiler')
+# The profiler endpoint is disabled unless the environment enables it, since the server listens on all interfaces.
+PROFILER_ENDPOINT = os.environ.get(instrumentation.PROFILER_ENDPOINT_ENV) == '1'
+
+
+@app.before_request
+def start_request_trace():
+    if request.path not in UNTRACED_PATHS:
+        # Label by route, so unknown paths don't create new metrics.
+        endpoint = request.url_rule.rule if request.url_rule is not None else instrumentation.UNMATCHED_ENDPOINT
+        g.trace_token = instrumentation.start_trace(endpoint)
+
+
+@app.teardown_request
+def finish_request_trace(error=None):
+    token = g.pop('trace_token', None)
+    if token is not None:
+        instrumentation.finish_trace(token, error)
 
 
 @app.route("/search_config")
@@ -35,7 +58,6 @@ def search_config():
     title_w = float(request.args.get('title_w', ''))
     page_rank_w = float(request.args.get('page_rank_w', ''))
     page_views_w = float(request.args.get('page_views_w', ''))
-    print(f"starting query: bw:{body_w}, tw:{title_w}, prw:{page_rank_w}, pvw:{page_views_w}")
     config = {'body_k': body_k, 'body_b': body_b, 'body_w': body_w, 'title_k': title_k, 'title_b': title_b,
               'title_w': title_w, 'page_rank_w': page_rank_w, 'page_views_w': page_views_w}
     res = SearchHandler.search_config(query, config)
@@ -55,20 +77,58 @@ def search():
          http://YOUR_SERVER_DOMAIN/search?query=hello+world
         where YOUR_SERVER_DOMAIN is something like XXXX-XX-XX-XX-XX.ngrok.io
         if you're using ngrok on Colab or your external IP on GCP.
+        An optional `retrieval` argument selects the BM25 retrieval mode:
+        `exhaustive`, `maxscore` (dynamic pruning, same results), `impact`
+        (precomputed quantized scores) or `champion` (the top postings of every
+        term, falling back to the full posting lists when they may miss a
+        result). The default is `impact` when the impact indices were built,
+        then `champion` when the champion tiers were, and `exhaustive`
+        otherwise.
     Returns:
     --------
         list of up to 100 search results, ordered from best to worst where each
         element is a tuple (wiki_id, title).
     """
     res = []
-    print("starting search")
     query = request.args.get('query', '')
     if len(query) == 0:
         return jsonify(res)
-    res = SearchHandler.search(query)
+    retrieval = request.args.get('retrieval')
+    if retrieval is not None and retrieval not in RETRIEVAL_MODES:
+        return jsonify(res), 400
+    res = SearchHandler.search(query, retrieval=retrieval)
     return jsonify(res)
 
 
+@app.route("/search_batch", methods=['POST'])
+def search_batch():
+    """ Runs many queries with many search_config configurations in one request.
+
+        Test this by issuing a POST request to a URL like:
+          http://YOUR_SERVER_DOMAIN/search_batch
+        with a json payload like:
+          {"queries": ["hello world", ...],
+           "configs": [{"body_k": 5, "body_b": 0.2, "body_w": 0.6, "title_k": 2, "title_b": 0.05,
+                        "title_w": 0.3, "page_rank_w": 0.15, "page_views_w": 0.15}, ...],
+           "evaluate": true, "k": 40}
+        With `evaluate`, the average precision at k of every result against
+        queries_train.json is added, followed by a MAP line per configuration.
+        A request runs at most batch.MAX_BATCH_PAIRS (query, configuration)
+        pairs, with k up to batch.MAX_K.
+    Returns:
+    --------
+        NDJSON stream, one line per (query, configuration) with its list of
+        (wiki_id, title) results.
+    """
+    try:
+        queries, configs, evaluate, k = batch.parse_request(request.get_json(silent=True))
+    except (ValueError, TypeError) as e:
+        return jsonify({'error': str(e)}), 400
+    qrels = batch.load_qrels() if evaluate else None
+    lines = batch.evaluate_batch(queries, configs, qrels, k)
+    return Response(stream_with_context(batch.to_ndjson(lines)), mimetype='application/x-ndjson')
+
+
 @app.route("/search_body")
 def search_body():
     """ Returns up to a 100 search results for the query using TFIDF AND COSINE
@@ -86,7 +146,6 @@ def search_body():
         element is a tuple (wiki_id, title).
     """
     query = request.args.get('query', '')
-    print("starting search_body")
     res = []
     if len(query) == 0:
         return jsonify(res)
@@ -117,7 +176,6 @@ def search_title():
         worst where each element is a tuple (wiki_id, title).
     """
     query = request.args.get('query', '')
-    print("starting search_title")
     if len(query) == 0:
         return jsonify([])
     # BEGIN SOLUTION
@@ -148,7 +206,6 @@ def search_anchor():
         worst where each element is a tuple (wiki_id, title).
     """
     query = request.args.get('query', '')
-    print("starting search_anchor")
     if len(query) == 0:
         return jsonify([])
     # BEGIN SOLUTION
@@ -174,7 +231,6 @@ def get_pagerank():
           list of PageRank scores that correrspond to the provided article IDs.
     """
     res = []
-    print("starting get_pagerank")
     wiki_ids = request.get_json()
     if len(wiki_ids) == 0:
         return jsonify(res)
@@ -203,7 +259,6 @@ def get_pageview():
           provided list article IDs.
     """
     res = []
-    print("starting get_pageview")
     wiki_ids = request.get_json()
     if len(wiki_ids) == 0:
         return jsonify(res)
@@ -215,6 +270,66 @@ def get_pageview():
     return jsonify(res)
 
 
+@app.route("/cache_stats")
+def cache_stats():
+    """ Returns the hit, miss and eviction counters of the posting list cache.
+    Returns:
+    --------
+        dictionary of the cache counters.
+    """
+    return jsonify(SearchHandler.cache_stats())
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    """ Returns the request, stage and posting counter histograms of the traced requests, and the cache counters,
+        in the Prometheus text format, or as JSON with `?format=json`.
+    Returns:
+    --------
+        metrics text, or dictionary of the counters and histogram summaries.
+    """
+    gauges = instrumentation.flatten_gauges('ir_cache', SearchHandler.cache_stats())
+    if request.args.get('format') == 'json':
+        return jsonify(dict(metrics.snapshot(), gauges=gauges))
+    return metrics.render(gauges), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+
+@app.route("/profiler")
+def profiler_endpoint():
+    """ Controls the sampling profiler at runtime.
+        /profiler?action=start&interval=0.01 starts sampling, /profiler?action=stop stops it,
+        /profiler?action=reset drops the samples, and /profiler returns the most sampled stacks and functions,
+        or all the stacks in the folded flame graph format with `?format=folded`.
+        Served only when the IR_PROFILER_ENDPOINT environment variable is 1. The interval is clamped to
+        PROFILER_INTERVAL_RANGE.
+    Returns:
+    --------
+        dictionary of the profiler report, or folded stacks text.
+    """
+    if not PROFILER_ENDPOINT:
+        return jsonify({'error': 'the profiler endpoint is disabled'}), 404
+    action = request.args.get('action', 'report')
+    try:
+        interval = float(request.args.get('interval', instrumentation.PROFILER_INTERVAL))
+        limit = int(request.args.get('limit', 50))
+    except ValueError:
+        return jsonify({'error': 'interval must be a number and limit a non-negative integer'}), 400
+    if math.isnan(interval) or limit < 0:
+        return jsonify({'error': 'interval must be a number and limit a non-negative integer'}), 400
+    if action == 'start':
+        min_interval, max_interval = instrumentation.PROFILER_INTERVAL_RANGE
+        profiler.start(min(max(interval, min_interval), max_interval))
+    elif action == 'stop':
+        profiler.stop()
+    elif action == 'reset':
+        profiler.reset()
+    elif action != 'report':
+        return jsonify({'error': f'unknown action {action}'}), 400
+    if request.args.get('format') == 'folded':
+        return profiler.folded(), 200, {'Content-Type': 'text/plain'}
+    return jsonify(profiler.report(limit))
+
+
 if __name__ == '__main__':
     # run the Flask RESTful API, make the server publicly available (host='0.0.0.0') on port 8080
     app.run(host='0.0.0.0', port=8080, debug=False)
@@ -0,0 +1,643 @@
+"""
+Delta segments - documents added, edited or deleted after the base indices were built.
+
+    python segments.py add <docs.jsonl> [--delete ID ...]
+    python segments.py delete ID [ID ...]
+    python segments.py merge | list | clear
+
+A delta segment holds the postings of its documents in the three index folders and the tombstones of the documents
+it deletes. Segments are immutable and listed oldest first in `segments/manifest.json`. A search sees the base
+indices and all the segments through a SegmentedIndex per folder, a newer segment overriding the older ones. The
+tiered merge policy of `select_merge` merges adjacent segments, and a new base built by index_builder.py replaces
+them all (`python segments.py clear`).
+"""
+import argparse
+import fcntl
+import json
+import math
+import os
+import pickle
+import threading
+from collections import Counter
+from collections.abc import Mapping, Set
+from contextlib import contextmanager
+import numpy as np
+from cache import PostingListCache
+from doc_store import DocumentStore
+from title_store import TitleStore
+from index_builder import FOLDER_ANALYZERS, BODY_FOLDER, TITLE_FOLDER, ANCHOR_FOLDER, merge_postings, parse_jsonl
+from loader import BucketIndexLoader, empty_posting_arrays
+
+SEGMENT_FORMAT = 1
+SEGMENTS_DIR = "segments"
+MERGE_FACTOR = 4  # adjacent segments of the same size tier that are merged into one
+MAX_SEGMENTS = 16  # segments above which the smallest adjacent ones are merged whatever their tier
+SMALLEST_TIER = 2 ** 14  # size of the segments of the first tier
+SEGMENT_CACHE_BYTES = 64 * 2 ** 20  # merged posting lists kept per index folder of a snapshot
+
+
+def _without(postings, hidden):
+    """
+    Drops the postings of hidden documents.
+    :param postings: tuple of (doc_ids, tfs).
+    :param hidden: sorted numpy array of doc_ids.
+    :return: tuple of (doc_ids, tfs), the same tuple if nothing was dropped.
+    """
+    doc_ids, tfs = postings
+    if len(hidden) == 0 or len(doc_ids) == 0:
+        return postings
+    pos = np.searchsorted(hidden, doc_ids)
+    pos[pos == len(hidden)] = 0
+    keep = hidden[pos] != doc_ids
+    if keep.all():
+        return postings
+    return doc_ids[keep], tfs[keep]
+
+
+def _combine(parts):
+    """
+    Combines the postings of a term from several segments.
+    :param parts: List of (doc_ids, tfs).
+    :return: tuple of (doc_ids, tfs) sorted by doc_id, the part itself if only one part has postings.
+    """
+    parts = [part for part in parts if len(part[0])]
+    if not parts:
+        return empty_posting_arrays()
+    if len(parts) == 1:
+        return parts[0]
+    return merge_postings(parts)
+
+
+def _add(terms, doc_id, counts):
+    """
+    Adds the token counts of a document to the collected postings of a folder.
+    :param terms: Dictionary - token: (List of doc_ids, List of tfs).
+    :param doc_id: wiki id.
+    :param counts: Counter of the tokens.
+    """
+    for token, tf in counts.items():
+        doc_ids, tfs = terms.setdefault(token, ([], []))
+        doc_ids.append(doc_id)
+        tfs.append(tf)
+
+
+def _posting_arrays(doc_ids, tfs):
+    """
+    :return: tuple of (doc_ids, tfs) numpy arrays sorted by doc_id, the tfs of a repeated doc_id added up.
+    """
+    doc_ids = np.array(doc_ids, dtype=np.int64)
+    tfs = np.array(tfs, dtype=np.int32)
+    order = np.argsort(doc_ids, kind='stable')
+    return merge_postings([(doc_ids[order], tfs[order])])
+
+
+class DeltaSegment:
+    """
+    Immutable segment of documents which were added or edited after the base indices were built, with their postings
+    in the three index folders, and the tombstones of the documents it deletes.
+    A segment overrides the older segments and the base: the body and title postings of its documents and of its
+    tombstones are hidden in the older segments. Only the tombstones hide anchor postings, since the anchor postings
+    of a document come from the links of other documents.
+    """
+
+    def __init__(self, name, doc_ids, lengths, norms, titles, postings, tombstones):
+        """
+        :param name: segment name.
+        :param doc_ids: sorted numpy array of the doc_ids of the documents.
+        :param lengths: numpy array of their body lengths.
+        :param norms: numpy array of their body tf-idf norms.
+        :param titles: List of their titles.
+        :param postings: Dictionary - folder name: {token: (doc_ids, tfs)}.
+        :param tombstones: sorted numpy array of deleted doc_ids.
+        """
+        self.name = name
+        self.doc_ids = doc_ids
+        self.lengths = lengths
+        self.norms = norms
+        self.titles = titles
+        self.postings = postings
+        self.tombstones = tombstones
+        self._replaced = np.union1d(tombstones, doc_ids)
+
+    @property
+    def size(self):
+        """
+        :return: number of postings, documents and tombstones of the segment, used by the merge policy.
+        """
+        return (sum(len(doc_ids) for folder in self.postings.values() for doc_ids, _ in folder.values()) +
+                len(self.doc_ids) + len(self.tombstones))
+
+    def hides(self, folder_name):
+        """
+        :param folder_name: folder name.
+        :return: sorted numpy array of the doc_ids whose postings of the folder are hidden in the older segments.
+        """
+        return self.tombstones if folder_name == ANCHOR_FOLDER else self._replaced
+
+    @staticmethod
+    def build(name, docs, deleted=(), doc_freq=None, n_docs=0):
+        """
+        Tokenizes documents into a segment, with the analyzers of the index builder. The body norms use the document
+        frequencies of the current indices with the segment's own, as the index builder does for the base.
+        :param name: segment name.
+        :param docs: Iterable of (doc_id, title, text, anchors) tuples, anchors being a list of (linked doc_id,
+                     anchor text). The last version of a document is kept.
+        :param deleted: Iterable of doc_ids to delete.
+        :param doc_freq: Optional dictionary - token: df, of the body index the segment is added to.
+        :param n_docs: number of documents of the indices the segment is added to.
+        :return: DeltaSegment object.
+        """
+        latest = {int(doc[0]): doc for doc in docs}
+        doc_ids = np.array(sorted(latest), dtype=np.int64)
+        body, title, anchor = (FOLDER_ANALYZERS[folder] for folder in (BODY_FOLDER, TITLE_FOLDER, ANCHOR_FOLDER))
+        collected = {folder: {} for folder in FOLDER_ANALYZERS}  # token: ([doc_ids], [tfs])
+        lengths, titles, doc_counts = [], [], []
+        for doc_id in doc_ids.tolist():
+            _, doc_title, text, anchors = latest[doc_id]
+            tokens = body.analyze(text)
+            counts = Counter(tokens)
+            _add(collected[BODY_FOLDER], doc_id, counts)
+            _add(collected[TITLE_FOLDER], doc_id, Counter(title.analyze(doc_title)))
+            for target_id, anchor_text in anchors or ():
+                _add(collected[ANCHOR_FOLDER], int(target_id), Counter(anchor.analyze(anchor_text)))
+            lengths.append(len(tokens))
+            titles.append(doc_title)
+            doc_counts.append(counts)
+        postings = {folder: {token: _posting_arrays(ids, tfs) for token, (ids, tfs) in terms.items()}
+                    for folder, terms in collected.items()}
+        doc_freq = doc_freq or {}
+        n = n_docs + len(doc_ids)
+        body_df = {token: doc_freq.get(token, 0) + len(ids) for token, (ids, _) in postings[BODY_FOLDER].items()}
+        norms = np.array([math.sqrt(sum((tf / length * math.log10(n / body_df[token])) ** 2
+                                        for token, tf in counts.items())) if length else 0.0
+                          for counts, length in zip(doc_counts, lengths)], dtype=np.float64)
+        tombstones = np.unique(np.fromiter(deleted, dtype=np.int64))
+        return DeltaSegment(name, doc_ids, np.array(lengths, dtype=np.int64), norms, titles, postings, tombstones)
+
+    @staticmethod
+    def merge(name, segments):
+        """
+        Merges adjacent segments into one segment, which replaces them at their position.
+        :param name: name of the merged segment.
+        :param segments: List of at least two DeltaSegment objects, oldest first.
+        :return: DeltaSegment object.
+        """
+        merged = segments[0]
+        for newer in segments[1:]:
+            older = merged
+            keep = np.flatnonzero(~np.isin(older.doc_ids, newer.hides(BODY_FOLDER)))
+            doc_ids = np.concatenate([older.doc_ids[keep], newer.doc_ids])
+            order = np.argsort(doc_ids, kind='stable')
+            titles = [older.titles[i] for i in keep.tolist()] + newer.titles
+            postings = {}
+            for folder in FOLDER_ANALYZERS:
+                hidden = newer.hides(folder)
+                terms = {}
+                for token, pl in older.postings[folder].items():
+                    pl = _without(pl, hidden)
+                    if len(pl[0]):
+                        terms[token] = pl
+                for token, pl in newer.postings[folder].items():
+                    terms[token] = _combine([terms[token], pl]) if token in terms else pl
+                postings[folder] = terms
+            merged = DeltaSegment(name, doc_ids[order],
+                                  np.concatenate([older.lengths[keep], newer.lengths])[order],
+                                  np.concatenate([older.norms[keep], newer.norms])[order],
+                                  [titles[i] for i in order.tolist()], postings,
+                                  np.union1d(older.tombstones, newer.tombstones))
+        return merged
+
+    def save(self, path):
+        """
+        Writes the segment to a file, which is never changed afterwards.
+        :param path: path of the .pkl file.
+        """
+        with open(f'{path}.part', 'wb') as f:
+            pickle.dump({'format': SEGMENT_FORMAT, 'name': self.name, 'doc_ids': self.doc_ids, 'lengths': self.lengths,
+                         'norms': self.norms, 'titles': self.titles, 'postings': self.postings,
+                         'tombstones': self.tombstones}, f)
+        os.replace(f'{path}.part', path)
+
+    @staticmethod
+    def load(path):
+        """
+        Reads a segment written with `save`.
+        :param path: path of the .pkl file.
+        :return: DeltaSegment object.
+        """
+        with open(path, 'rb') as f:
+            saved = pickle.load(f)
+        if saved['format'] != SEGMENT_FORMAT:
+            raise ValueError(f"unsupported segment format {saved['format']} in {path}")
+        return DeltaSegment(saved['name'], saved['doc_ids'], saved['lengths'], saved['norms'], saved['titles'],
+                            saved['postings'], saved['tombstones'])
+
+
+def select_merge(sizes, factor=MERGE_FACTOR, max_segments=MAX_SEGMENTS):
+    """
+    Tiered merge policy. Segments of up to SMALLEST_TIER are in tier 0, and every tier above holds segments `factor`
+    times larger. The newest `factor` adjacent segments of the same tier are merged, so a segment is rewritten about
+    once per tier it climbs. Above `max_segments` segments, the `factor` adjacent segments with the smallest total
+    size are merged. Only adjacent segments are merged, since a newer segment overrides the older ones.
+    :param sizes: List of the sizes of the segments, oldest first.
+    :param factor: segments merged at once.
+    :param max_segments: most segments kept without merging.
+    :return: tuple of (start, end) of the segments to merge, or None.
+    """
+    tiers = [0 if size <= SMALLEST_TIER else int(math.log(size / SMALLEST_TIER, factor)) + 1 for size in sizes]
+    for end in range(len(sizes), factor - 1, -1):
+        if len(set(tiers[end - factor:end])) == 1:
+            return end - factor, end
+    if len(sizes) > max_segments:
+        start = min(range(len(sizes) - factor + 1), key=lambda i: sum(sizes[i:i + factor]))
+        return start, start + factor
+    return None
+
+
+class SegmentStore:
+    """
+    Folder of the delta segments. `manifest.json` lists the segments oldest first, with a generation that changes on
+    every update. Segment files are never changed - a merge writes a new segment and manifest, and then removes the
+    merged files. Reads and updates are serialized between the threads of a process by a lock, and between processes
+    by a POSIX lock on a lock file, which forked processes do not inherit.
+    """
+
+    def __init__(self, directory=SEGMENTS_DIR):
+        self.directory = directory
+        self._loaded = {}  # name: DeltaSegment
+        self._lock = threading.Lock()
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    @contextmanager
+    def locked(self):
+        """
+        Holds the lock of the segments, used as `with store.locked():`.
+        """
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(os.path.join(self.directory, 'lock'), 'a') as f:
+                fcntl.lockf(f, fcntl.LOCK_EX)
+                yield  # closing the file releases the lock
+
+    def path(self, name):
+        """
+        :return: path of the file of a segment.
+        """
+        return os.path.join(self.directory, f'{name}.pkl')
+
+    def _manifest(self):
+        try:
+            with open(os.path.join(self.directory, 'manifest.json')) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return {'format': SEGMENT_FORMAT, 'generation': 0, 'next_id': 1, 'segments': []}
+        if manifest['format'] != SEGMENT_FORMAT:
+            raise ValueError(f"unsupported segment manifest format {manifest['format']} in {self.directory}")
+        return manifest
+
+    def _write_manifest(self, manifest):
+        manifest['generation'] += 1
+        path = os.path.join(self.directory, 'manifest.json')
+        with open(f'{path}.part', 'w') as f:
+            json.dump(manifest, f)
+        os.replace(f'{path}.part', path)
+
+    def _load(self, name):
+        segment = self._loaded.get(name)
+        if segment is None:
+            segment = self._loaded[name] = DeltaSegment.load(self.path(name))
+        return segment
+
+    def _segments(self, manifest):
+        """
+        Loads the segments of a manifest, forgetting the loaded segments which are no longer listed.
+        :return: tuple of (generation, List of DeltaSegment objects).
+        """
+        segments = [self._load(entry['name']) for entry in manifest['segments']]
+        self._loaded = {segment.name: segment for segment in segments}
+        return manifest['generation'], segments
+
+    def _new_name(self, manifest):
+        name = f"delta_{manifest['next_id']:06}"
+        manifest['next_id'] += 1
+        return name
+
+    def read(self):
+        """
+        Reads the current segments.
+        :return: tuple of (generation, List of DeltaSegment objects, oldest first).
+        """
+        if not os.path.exists(os.path.join(self.directory, 'manifest.json')):
+            return 0, []
+        with self.locked():
+            return self._segments(self._manifest())
+
+    def add(self, build):
+        """
+        Adds a new segment after the current ones.
+        :param build: function of the segment name, returning the DeltaSegment.
+        :return: tuple of (generation, List of DeltaSegment objects), with the new segment.
+        """
+        with self.locked():
+            manifest = self._manifest()
+            name = self._new_name(manifest)
+            segment = build(name)
+            segment.save(self.path(name))
+            self._loaded[name] = segment
+            manifest['segments'].append({'name': name, 'size': segment.size})
+            self._write_manifest(manifest)
+            return self._segments(manifest)
+
+    def compact(self, factor=MERGE_FACTOR, max_segments=MAX_SEGMENTS):
+        """
+        Merges the segments chosen by `select_merge`, until it chooses none.
+        :param factor: segments merged at once.
+        :param max_segments: most segments kept without merging.
+        :return: number of merges.
+        """
+        merges = 0
+        with self.locked():
+            manifest = self._manifest()
+            while True:
+                window = select_merge([entry['size'] for entry in manifest['segments']], factor, max_segments)
+                if window is None:
+                    return merges
+                start, end = window
+                entries = manifest['segments'][start:end]
+                name = self._new_name(manifest)
+                segment = DeltaSegment.merge(name, [self._load(entry['name']) for entry in entries])
+                segment.save(self.path(name))
+                self._loaded[name] = segment
+                manifest['segments'][start:end] = [{'name': name, 'size': segment.size}]
+                self._write_manifest(manifest)
+                for entry in entries:
+                    self._loaded.pop(entry['name'], None)
+                    os.remove(self.path(entry['name']))
+                merges += 1
+                print(f"merged {[entry['name'] for entry in entries]} into {name}")
+
+    def clear(self):
+        """
+        Removes all the segments, once the base indices were rebuilt with their documents.
+        """
+        with self.locked():
+            manifest = self._manifest()
+            names = [entry['name'] for entry in manifest['segments']]
+            manifest['segments'] = []
+            self._write_manifest(manifest)
+            self._loaded = {}
+            for name in names:
+                os.remove(self.path(name))
+
+    def _after_fork(self):
+        """
+        Resets the lock in a forked process, where the parent's thread holding it doesn't exist.
+        """
+        self._lock = threading.Lock()
+
+
+class _LiveDF(Mapping):
+    """
+    Document frequencies of a SegmentedIndex - the number of live postings of a term in all the segments. A term
+    whose postings were all deleted is not found, but is still iterated until the segments are replaced.
+    """
+
+    def __init__(self, index):
+        self.index = index
+
+    def __getitem__(self, token):
+        if token not in self.index.posting_locs:
+            raise KeyError(token)
+        n = len(self.index.posting_arrays(token)[0])
+        if n == 0:
+            raise KeyError(token)
+        return n
+
+    def __len__(self):
+        return len(self.index.posting_locs)
+
+    def __iter__(self):
+        return iter(self.index.posting_locs)
+
+
+class _Terms(Set):
+    """ Terms of a SegmentedIndex, standing in for the `posting_locs` dictionary in membership tests. """
+
+    def __init__(self, base_terms, delta_terms):
+        self.base_terms = base_terms
+        self.delta_terms = delta_terms
+
+    def __contains__(self, token):
+        return token in self.delta_terms or token in self.base_terms
+
+    def __len__(self):
+        return len(self.base_terms) + len(self.delta_terms)
+
+    def __iter__(self):
+        yield from self.base_terms
+        yield from self.delta_terms
+
+
+class SegmentedIndex:
+    """
+    An index folder made of its base index and the delta segments, which BucketIndexLoader, the scorers and the
+    rankers use like an InvertedIndex.
+    The posting list of a term is the concatenation of its lists in every segment, without the documents that a newer
+    segment overrides. `df` counts these live postings, so all the segments are scored with the same global document
+    frequencies. Merged lists are kept in a cache of the index, and the base lists of the terms that no segment
+    changes stay in the shared posting list cache only.
+    """
+    segmented = True
+
+    def __init__(self, base, folder_name, segments, cache_bytes=SEGMENT_CACHE_BYTES):
+        """
+        :param base: InvertedIndex object of the base.
+        :param folder_name: folder name.
+        :param segments: List of DeltaSegment objects, oldest first.
+        :param cache_bytes: size of the cache of merged lists.
+        """
+        self.base = base
+        self.folder_name = folder_name
+        self.segments = segments
+        # hidden[0] - base documents overridden by a segment, hidden[i] - those of segments[i - 1].
+        hidden = [np.empty(0, dtype=np.int64)]
+        for segment in reversed(segments):
+            hidden.append(np.union1d(hidden[-1], segment.hides(folder_name)))
+        self.hidden = hidden[::-1]
+        delta_terms = set()
+        for segment in segments:
+            delta_terms.update(segment.postings[folder_name])
+        base_terms = base.posting_locs
+        self.posting_locs = _Terms(base_terms, frozenset(term for term in delta_terms if term not in base_terms))
+        self.df = _LiveDF(self)
+        self.cache = PostingListCache(cache_bytes)
+        self._unchanged = set()
+
+    def posting_arrays(self, token):
+        """
+        Returns the live postings of a token in all the segments.
+        :param token: String.
+        :return: tuple of (doc_ids, tfs) numpy arrays, read-only.
+        """
+        if token in self._unchanged:
+            return BucketIndexLoader.load_posting_arrays_for_token(token, self.base, self.folder_name)
+        merged = self.cache.get((self.folder_name, token))
+        if merged is not None:
+            return merged
+        base = BucketIndexLoader.load_posting_arrays_for_token(token, self.base, self.folder_name)
+        parts = [_without(base, self.hidden[0])]
+        for segment, hidden in zip(self.segments, self.hidden[1:]):
+            postings = segment.postings[self.folder_name].get(token)
+            if postings is not None:
+                parts.append(_without(postings, hidden))
+        merged = _combine(parts)
+        if merged is base:
+            self._unchanged.add(token)
+        else:
+            self.cache.put((self.folder_name, token), merged)
+        return merged
+
+
+class OverlayDocumentStore(DocumentStore):
+    """
+    DocumentStore of the base documents followed by the live documents of the delta segments, whose dense ids come
+    after the base ones. Base documents that a segment edits or deletes are not found, and are left out of every
+    attribute mask, so the number of documents and their average length count the live documents only.
+    """
+
+    def __init__(self, base, delta_ids, attributes, masks, live):
+        """
+        :param base: DocumentStore object of the base.
+        :param delta_ids: sorted numpy array of the doc_ids of the live segment documents.
+        :param attributes: Dictionary - attribute name: numpy array over the base and segment dense ids.
+        :param masks: Dictionary - attribute name: boolean presence mask.
+        :param live: boolean numpy array over the base dense ids, False for the overridden documents.
+        """
+        super().__init__(np.concatenate([base.ids, delta_ids]), attributes, masks)
+        self.base = base
+        self.n_base = len(base.ids)
+        self.delta_ids = delta_ids
+        self.live = live
+
+    def dense_id(self, doc_id):
+        pos = int(np.searchsorted(self.delta_ids, doc_id))
+        if pos < len(self.delta_ids) and self.delta_ids[pos] == doc_id:
+            return self.n_base + pos
+        pos = self.base.dense_id(doc_id)
+        return pos if pos >= 0 and self.live[pos] else -1
+
+    def dense_ids(self, doc_ids):
+        if not isinstance(doc_ids, np.ndarray):
+            doc_ids = np.fromiter(doc_ids, dtype=np.int64)
+        pos, found = self.base.dense_ids(doc_ids)
+        found &= self.live[pos]
+        delta_pos = np.searchsorted(self.delta_ids, doc_ids)
+        delta_pos[delta_pos == len(self.delta_ids)] = 0
+        in_delta = self.delta_ids[delta_pos] == doc_ids if len(self.delta_ids) else np.zeros(len(doc_ids), dtype=bool)
+        pos[in_delta] = self.n_base + delta_pos[in_delta]
+        found |= in_delta
+        pos[~found] = 0
+        return pos, found
+
+
+class OverlayTitleStore(TitleStore):
+    """ TitleStore of an OverlayDocumentStore - the base titles, followed by the titles of the segment documents. """
+
+    def __init__(self, doc_store, base, titles, mask):
+        super().__init__(doc_store, base.blob, base.offsets, mask)
+        self.n_base = len(base.mask)
+        self.titles = titles
+
+    def _title(self, pos):
+        if pos < self.n_base:
+            return super()._title(pos)
+        return self.titles[pos - self.n_base]
+
+
+def overlay_stores(doc_store, title_store, segments):
+    """
+    Builds the document and title stores of the base with the delta segments applied. The lengths and norms of the
+    segment documents come from the segments, and edited documents keep their other attributes (page rank, page
+    views...) from the base.
+    :param doc_store: DocumentStore object of the base.
+    :param title_store: TitleStore object of the base.
+    :param segments: List of DeltaSegment objects, oldest first.
+    :return: tuple of (DocumentStore, TitleStore), the base stores if there are no segments.
+    """
+    if not segments:
+        return doc_store, title_store
+    latest = {}  # doc_id: (segment, row)
+    for segment in segments:
+        for doc_id in segment.tombstones.tolist():
+            latest.pop(doc_id, None)
+        for row, doc_id in enumerate(segment.doc_ids.tolist()):
+            latest[doc_id] = (segment, row)
+    delta_ids = np.array(sorted(latest), dtype=np.int64)
+    rows = [latest[doc_id] for doc_id in delta_ids.tolist()]
+    n_delta = len(delta_ids)
+    live = np.ones(len(doc_store.ids), dtype=bool)
+    pos, found = doc_store.dense_ids(np.unique(np.concatenate([segment.hides(BODY_FOLDER) for segment in segments])))
+    live[pos[found]] = False
+    old_pos, old_found = doc_store.dense_ids(delta_ids)
+    computed = {'DL': [segment.lengths[row] for segment, row in rows],
+                'doc_norms': [segment.norms[row] for segment, row in rows]}
+    attributes, masks = {}, {}
+    for name, values in doc_store.attributes.items():
+        base_mask = doc_store.masks.get(name)
+        if name in computed:
+            delta_values = np.array(computed[name], dtype=values.dtype)
+            delta_mask = np.ones(n_delta, dtype=bool)
+        else:
+            delta_values = np.where(old_found, values[old_pos], 0).astype(values.dtype)
+            delta_mask = old_found if base_mask is None else old_found & base_mask[old_pos]
+        attributes[name] = np.concatenate([values, delta_values])
+        masks[name] = np.concatenate([live if base_mask is None else live & base_mask, delta_mask])
+    store = OverlayDocumentStore(doc_store, delta_ids, attributes, masks, live)
+    titles = [segment.titles[row] for segment, row in rows]
+    return store, OverlayTitleStore(store, title_store, titles,
+                                    np.concatenate([live & title_store.mask, np.ones(n_delta, dtype=bool)]))
+
+
+def base_statistics():
+    """
+    Reads the body document frequencies and the number of documents of the local base indices, for the norms of the
+    segments written by the command line.
+    :return: tuple of (Dictionary - token: df, number of documents).
+    """
+    from lexicon import Lexicon
+    from startup import SNAPSHOT_DIR
+    folder = Lexicon.folder(BODY_FOLDER)
+    if Lexicon.meta(folder) is not None:
+        doc_freq = Lexicon.load(folder).df
+    else:
+        with open(f'{BODY_FOLDER}.pkl', 'rb') as f:
+            doc_freq = pickle.load(f).df
+    doc_store = DocumentStore.load(os.path.join(SNAPSHOT_DIR, 'doc_store'))
+    return doc_freq, len(doc_store.view('DL'))
+
+
+if __name__ == '__main__':
+    # Running servers install the changes with their segment merger thread, or on SIGHUP for serve.py.
+    parser = argparse.ArgumentParser(description="Delta segments of the indices.")
+    parser.add_argument('command', choices=('add', 'delete', 'merge', 'list', 'clear'))
+    parser.add_argument('args', nargs='*', help="JSONL file of the documents to add, or doc_ids to delete")
+    parser.add_argument('--delete', type=int, nargs='*', default=[], help="doc_ids to delete with the added documents")
+    args = parser.parse_args()
+    store = SegmentStore()
+    if args.command in ('add', 'delete'):
+        if args.command == 'add':
+            with open(args.args[0], 'rb') as f:
+                new_docs, deleted_ids = parse_jsonl([line for line in f if line.strip()]), args.delete
+        else:
+            new_docs, deleted_ids = [], [int(doc_id) for doc_id in args.args] + args.delete
+        base_df, base_docs = base_statistics()
+        generation, _ = store.add(lambda name: DeltaSegment.build(name, new_docs, deleted_ids, base_df, base_docs))
+        print(f"added {len(new_docs)} documents and {len(deleted_ids)} deletions, generation {generation}")
+    elif args.command == 'merge':
+        print(f"{store.compact()} merges")
+    elif args.command == 'clear':
+        store.clear()
+    generation, current = store.read()
+    print(f"generation {generation}: " + ", ".join(f"{segment.name} ({len(segment.doc_ids)} documents, "
+                                                    f"{len(segment.tombstones)} tombstones, size {segment.size})"
+                                                    for segment in current))
@@ -0,0 +1,309 @@
+"""
+Pre-forking production server.
+
+    python serve.py --workers 4 --port 8080
+
+The master process loads the backend once, freezes the loaded objects out of the garbage collector and forks the
+workers, which share the listening socket. The locks of the shared objects are reset in every forked worker, since a
+background thread of the master (the block prefetch) may hold them at the fork. The posting lists, the document store
+snapshot and the impact indices are memory mapped, and the rest of the loaded objects are shared copy-on-write, so
+every worker adds little memory.
+
+Signals to the master:
+    SIGHUP - reloads the indices in the master, starts a new generation of workers and stops the old one gracefully.
+    SIGUSR1 - prints the memory of every worker.
+    SIGTERM / SIGINT - stops the workers gracefully and exits.
+"""
+import argparse
+import gc
+import mmap
+import os
+import select
+import signal
+import socket
+import struct
+import sys
+import threading
+from time import monotonic
+from werkzeug.serving import ThreadedWSGIServer, WSGIRequestHandler
+
+HEARTBEAT_INTERVAL = 1.0  # seconds between the heartbeats of a worker
+WORKER_TIMEOUT = 30.0  # seconds without a heartbeat before a worker is killed and replaced
+GRACEFUL_TIMEOUT = 30.0  # seconds for a stopping worker to finish its requests before it is killed
+KEEPALIVE_TIMEOUT = 5.0  # seconds an idle keep-alive connection holds a worker thread
+BACKLOG = 1024
+
+
+class Heartbeat:
+    """ Monotonic timestamp of a worker's last heartbeat, in a shared anonymous mapping. """
+
+    def __init__(self):
+        self._buffer = mmap.mmap(-1, 8)
+        self.beat()
+
+    def beat(self):
+        self._buffer[:8] = struct.pack('d', monotonic())
+
+    def age(self):
+        """
+        :return: seconds since the last heartbeat.
+        """
+        return monotonic() - struct.unpack('d', self._buffer[:8])[0]
+
+    def close(self):
+        self._buffer.close()
+
+
+class WorkerRequestHandler(WSGIRequestHandler):
+    """ Closes idle keep-alive connections, so a stopping worker doesn't wait for its clients. """
+    timeout = KEEPALIVE_TIMEOUT
+
+
+class WorkerServer(ThreadedWSGIServer):
+    """
+    Threaded WSGI server on the shared listening socket. The accept loop beats the worker's heartbeat, so a worker
+    whose loop is stuck stops beating. Requests run in non-daemon threads, which are joined when the server closes.
+    """
+    daemon_threads = False
+
+    def __init__(self, host, port, app, fd, heartbeat):
+        super().__init__(host, port, app, handler=WorkerRequestHandler, fd=fd)
+        # Every worker waits on the same socket - the ones that lose the race for a connection must not block.
+        self.socket.setblocking(False)
+        self.heartbeat = heartbeat
+
+    def service_actions(self):
+        self.heartbeat.beat()
+
+
+def run_worker(sock, host, port, heartbeat):
+    """
+    Serves requests until SIGTERM, then finishes the running requests and exits. Runs in a forked worker.
+    :param sock: listening socket.
+    :param host: host name, used for the WSGI environment.
+    :param port: port, used for the WSGI environment.
+    :param heartbeat: Heartbeat object of the worker.
+    """
+    import backend
+    from search_frontend import app
+    backend.start_segment_merger()
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the master stops the workers
+    server = WorkerServer(host, port, app, sock.fileno(), heartbeat)
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    print(f"worker {os.getpid()} serving")
+    try:
+        server.serve_forever(poll_interval=HEARTBEAT_INTERVAL / 2)
+    finally:
+        server.server_close()
+
+
+def memory_stats(pid):
+    """
+    Reads the memory of a process from /proc (Linux).
+    :param pid: process id.
+    :return: Dictionary - 'rss', 'pss' and 'private' in MB, or None if they are not available.
+    """
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            fields = dict(line.split(':', 1) for line in f if ':' in line and not line.startswith(' '))
+    except OSError:
+        return None
+
+    def mb(name):
+        return int(fields.get(name, '0 kB').split()[0]) / 1024
+
+    return {'rss': mb('Rss'), 'pss': mb('Pss'), 'private': mb('Private_Clean') + mb('Private_Dirty')}
+
+
+class Master:
+    """
+    Forks and supervises the workers: replaces workers that exit or stop beating, and handles the reload and stop
+    signals.
+    """
+
+    def __init__(self, host, port, n_workers, graceful_timeout=GRACEFUL_TIMEOUT, worker_timeout=WORKER_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.n_workers = n_workers
+        self.graceful_timeout = graceful_timeout
+        self.worker_timeout = worker_timeout
+        self.workers = {}  # pid: Heartbeat of the current generation
+        self.retiring = {}  # pid: deadline of the workers of older generations, which finish their requests
+        self.sock = socket.create_server((host, port), backlog=BACKLOG)
+        self.sock.set_inheritable(True)
+        self._signals = []
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_w, False)
+
+    def load(self):
+        """
+        Loads the backend and moves everything loaded so far to the permanent generation of the garbage collector,
+        so collections in the workers don't write to the shared pages. The segment merger is started in the workers,
+        so the master doesn't fork while it holds the locks of the segments.
+        """
+        os.environ['IR_PREFORK'] = '1'  # backend.PREFORK_ENV
+        import search_frontend  # noqa: F401 - loads the backend
+        gc.collect()
+        gc.freeze()
+
+    def spawn(self):
+        """
+        Forks a worker of the current generation.
+        """
+        heartbeat = Heartbeat()
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                signal.set_wakeup_fd(-1)
+                for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT, signal.SIGUSR1, signal.SIGCHLD):
+                    signal.signal(signum, signal.SIG_DFL)
+                os.close(self._wakeup_r)
+                os.close(self._wakeup_w)
+                run_worker(self.sock, self.host, self.port, heartbeat)
+            except BaseException as e:
+                print(f"worker {os.getpid()} failed: {e!r}", file=sys.stderr)
+                code = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(code)
+        self.workers[pid] = heartbeat
+
+    def reap(self):
+        """
+        Collects the exited workers.
+        """
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            if pid in self.workers:
+                self.workers.pop(pid).close()
+                print(f"worker {pid} exited with status {os.waitstatus_to_exitcode(status)}, replacing it")
+            self.retiring.pop(pid, None)
+
+    def check_heartbeats(self):
+        """
+        Kills the workers which stopped beating. They are replaced once they are reaped.
+        """
+        for pid, heartbeat in list(self.workers.items()):
+            if heartbeat.age() > self.worker_timeout:
+                print(f"worker {pid} missed its heartbeat for {heartbeat.age():.1f}s, killing it")
+                self._kill(pid, signal.SIGKILL)
+
+    def retire(self, pids):
+        """
+        Asks workers to stop gracefully. They are killed if they don't exit in time.
+        :param pids: process ids of the workers.
+        """
+        deadline = monotonic() + self.graceful_timeout
+        for pid in pids:
+            heartbeat = self.workers.pop(pid, None)
+            if heartbeat is not None:
+                heartbeat.close()
+            self.retiring[pid] = deadline
+            self._kill(pid, signal.SIGTERM)
+
+    def reload(self):
+        """
+        Reloads the indices in the master and replaces the workers, without closing the listening socket. The old
+        workers keep serving until the new ones are forked, and finish their running requests.
+        """
+        import backend
+        print("reloading")
+        gc.unfreeze()
+        try:
+            backend.reload_indices()
+        except Exception as e:
+            print(f"reload failed, keeping the current workers: {e!r}")
+            return
+        finally:
+            gc.collect()
+            gc.freeze()
+        old = list(self.workers)
+        for _ in range(self.n_workers):
+            self.spawn()
+        self.retire(old)
+
+    def print_memory(self):
+        """
+        Prints the memory of the master and of every worker. The PSS splits shared pages between the processes.
+        """
+        for name, pid in [('master', os.getpid())] + [('worker', pid) for pid in self.workers]:
+            stats = memory_stats(pid)
+            if stats is not None:
+                print(f"{name} {pid}: rss {stats['rss']:.1f}MB, pss {stats['pss']:.1f}MB, "
+                      f"private {stats['private']:.1f}MB")
+
+    def _kill(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def _on_signal(self, signum, frame):
+        self._signals.append(signum)
+
+    def run(self):
+        """
+        Loads the backend, forks the workers and supervises them until SIGTERM or SIGINT.
+        """
+        self.load()
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT, signal.SIGUSR1, signal.SIGCHLD):
+            signal.signal(signum, self._on_signal)
+        signal.set_wakeup_fd(self._wakeup_w)
+        for _ in range(self.n_workers):
+            self.spawn()
+        print(f"serving on {self.host}:{self.port} with {self.n_workers} workers")
+        stopping = False
+        while not stopping or self.workers or self.retiring:
+            self._wait(HEARTBEAT_INTERVAL)
+            while self._signals:
+                signum = self._signals.pop(0)
+                if signum in (signal.SIGTERM, signal.SIGINT) and not stopping:
+                    print("stopping")
+                    stopping = True
+                    self.retire(list(self.workers))
+                elif signum == signal.SIGHUP and not stopping:
+                    self.reload()
+                elif signum == signal.SIGUSR1:
+                    self.print_memory()
+            self.reap()
+            now = monotonic()
+            for pid, deadline in list(self.retiring.items()):
+                if now > deadline:
+                    print(f"worker {pid} did not stop in time, killing it")
+                    self._kill(pid, signal.SIGKILL)
+            if not stopping:
+                self.check_heartbeats()
+                while len(self.workers) < self.n_workers:
+                    self.spawn()
+        self.sock.close()
+
+    def _wait(self, timeout):
+        """
+        Sleeps until a signal arrives or the timeout passes.
+        """
+        readable, _, _ = select.select([self._wakeup_r], [], [], timeout)
+        if readable:
+            try:
+                os.read(self._wakeup_r, 1024)
+            except BlockingIOError:
+                pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pre-forking server of the search engine.')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--graceful-timeout', type=float, default=GRACEFUL_TIMEOUT)
+    parser.add_argument('--worker-timeout', type=float, default=WORKER_TIMEOUT)
+    args = parser.parse_args()
+    Master(args.host, args.port, args.workers, args.graceful_timeout, args.worker_timeout).run()
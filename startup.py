@@ -0,0 +1,228 @@
+import json
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from time import perf_counter
+import numpy as np
+from doc_store import DocumentStore
+from title_store import TitleStore
+from helperClasses import QueryProcessing
+
+SNAPSHOT_VERSION = 2
+SNAPSHOT_DIR = f"snapshot_v{SNAPSHOT_VERSION}"
+DOWNLOAD_WORKERS = 8
+# blob name: local file name. The page rank blob is found by its prefix, see `list_artifacts`.
+ARTIFACTS = {
+    "postings_gcp/text_inverted_index/index.pkl": "text_inverted_index.pkl",
+    "postings_gcp/title_inverted_index_with_stemming/index.pkl": "title_inverted_index_with_stemming.pkl",
+    "postings_gcp/anchor_inverted_index/index.pkl": "anchor_inverted_index.pkl",
+    "pv/page_views.pkl": "page_views.pkl",
+    "titles/doc_titles.pkl": "doc_titles.pkl",
+    "doc_norms/doc_norms.pkl": "doc_norms.pkl",
+    "doc_len/doc_len.pkl": "doc_len.pkl",
+}
+# Local files the document store snapshot is built from.
+SNAPSHOT_SOURCES = ("page_views.pkl", "pr.csv.gz", "doc_norms.pkl", "doc_len.pkl", "doc_titles.pkl")
+DOC_STORE_DTYPES = {'DL': np.uint32, 'doc_norms': np.float64, 'page_rank': np.float64, 'pr_norm': np.float64,
+                    'page_views': np.uint32}
+
+
+class PhaseTimer:
+    """ Measures and reports the duration of the startup phases. """
+
+    def __init__(self):
+        self.phases = {}
+        self._start = perf_counter()
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Measures a phase, used as `with timer.phase("name"):`.
+        :param name: phase name.
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = perf_counter() - start
+            print(f"{name} -- {self.phases[name]:.2f}s")
+
+    def report(self):
+        """
+        :return: Dictionary - phase name: seconds, with the total time since the timer was created.
+        """
+        return dict(self.phases, total=perf_counter() - self._start)
+
+
+def list_artifacts(bucket_loader):
+    """
+    Lists the artifacts the backend needs.
+    :param bucket_loader: BucketIndexLoader object.
+    :return: Dictionary - blob name: local file name.
+    :raises ValueError: if several page rank blobs match, since they would all be downloaded to pr.csv.gz.
+    """
+    artifacts = dict(ARTIFACTS)
+    page_rank_blobs = sorted(blob.name for blob in bucket_loader.client.list_blobs(bucket_loader.bucket_name,
+                                                                                   prefix='pr')
+                             if blob.name.endswith('csv.gz'))
+    if len(page_rank_blobs) > 1:
+        raise ValueError(f"ambiguous page rank blobs {page_rank_blobs}, expected a single csv.gz under 'pr'")
+    if page_rank_blobs:
+        artifacts[page_rank_blobs[0]] = "pr.csv.gz"
+    return artifacts
+
+
+def _meta_path(local_name):
+    return f"{local_name}.meta.json"
+
+
+def local_generation(local_name):
+    """
+    Returns the bucket generation a local file was downloaded from.
+    :param local_name: local file name.
+    :return: generation, or None if it is unknown.
+    """
+    try:
+        with open(_meta_path(local_name)) as f:
+            return json.load(f)['generation']
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def download_if_stale(bucket, blob_name, local_name):
+    """
+    Downloads a blob unless the local copy was downloaded from the same generation of the blob. A local file without
+    a recorded generation is considered fresh when its size matches the blob.
+    :param bucket: storage bucket.
+    :param blob_name: blob name.
+    :param local_name: local file name.
+    :return: tuple of (generation of the local copy, True if the file was downloaded).
+    """
+    blob = bucket.get_blob(blob_name)
+    generation = str(blob.generation)
+    if os.path.exists(local_name):
+        known = local_generation(local_name)
+        if known == generation or (known is None and os.path.getsize(local_name) == blob.size):
+            if known is None:
+                _write_meta(local_name, generation)
+            return generation, False
+    tmp_name = f"{local_name}.part"
+    blob.download_to_filename(tmp_name)
+    os.replace(tmp_name, local_name)
+    _write_meta(local_name, generation)
+    return generation, True
+
+
+def _write_meta(local_name, generation):
+    with open(_meta_path(local_name), 'w') as f:
+        json.dump({'generation': generation}, f)
+
+
+def download_artifacts(bucket_loader, artifacts, workers=DOWNLOAD_WORKERS):
+    """
+    Downloads the stale artifacts concurrently.
+    :param bucket_loader: BucketIndexLoader object.
+    :param artifacts: Dictionary - blob name: local file name.
+    :param workers: Number of concurrent downloads.
+    :return: Dictionary - local file name: generation.
+    """
+    with ThreadPoolExecutor(workers, thread_name_prefix="download") as executor:
+        futures = {local_name: executor.submit(download_if_stale, bucket_loader.bucket, blob_name, local_name)
+                   for blob_name, local_name in artifacts.items()}
+        results = {local_name: future.result() for local_name, future in futures.items()}
+    downloaded = [local_name for local_name, (_, fetched) in results.items() if fetched]
+    print(f"downloaded {len(downloaded)} of {len(results)} artifacts {downloaded}")
+    return {local_name: generation for local_name, (generation, _) in results.items()}
+
+
+def build_document_store(bucket_loader, doc_titles):
+    """
+    Builds the document store with pre-normalized page rank and page views from the downloaded artifacts.
+    :param bucket_loader: BucketIndexLoader object.
+    :param doc_titles: Dictionary of document titles, its doc_ids get a dense id.
+    :return: DocumentStore object.
+    """
+    page_views = bucket_loader.loda_page_views()
+    page_rank, pr_norm = bucket_loader.load_page_rank_to_df()
+    doc_store = DocumentStore.build({'DL': bucket_loader.load_doc_len(), 'doc_norms': bucket_loader.load_doc_norms(),
+                                     'page_rank': page_rank, 'pr_norm': pr_norm, 'page_views': page_views},
+                                    dtypes=DOC_STORE_DTYPES, extra_ids=doc_titles.keys())
+    page_views_norm = np.zeros(len(doc_store.ids), dtype=np.float64)
+    page_views_mask = doc_store.masks.get('page_views', np.ones(len(doc_store.ids), dtype=bool))
+    page_views_norm[page_views_mask] = QueryProcessing.normalize_array(doc_store.view('page_views').values())
+    doc_store.add_attribute('page_views_norm', page_views_norm, doc_store.masks.get('page_views'))
+    return doc_store
+
+
+def snapshot_is_fresh(generations, snapshot_dir=SNAPSHOT_DIR):
+    """
+    Checks if the snapshot was built from the current generation of its source artifacts.
+    :param generations: Dictionary - local file name: generation.
+    :param snapshot_dir: snapshot folder.
+    :return: Boolean.
+    """
+    try:
+        with open(os.path.join(snapshot_dir, 'manifest.json')) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return (manifest.get('version') == SNAPSHOT_VERSION and
+            manifest.get('sources') == {name: generations.get(name) for name in SNAPSHOT_SOURCES})
+
+
+def write_snapshot(doc_store, title_store, generations, snapshot_dir=SNAPSHOT_DIR):
+    """
+    Writes a versioned snapshot of the backend state, replacing the previous one atomically.
+    :param doc_store: DocumentStore object.
+    :param title_store: TitleStore object.
+    :param generations: Dictionary - local file name: generation.
+    :param snapshot_dir: snapshot folder.
+    """
+    tmp_dir = f"{snapshot_dir}.part"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    doc_store.save(os.path.join(tmp_dir, 'doc_store'))
+    title_store.save(os.path.join(tmp_dir, 'titles'))
+    with open(os.path.join(tmp_dir, 'manifest.json'), 'w') as f:
+        json.dump({'version': SNAPSHOT_VERSION,
+                   'sources': {name: generations.get(name) for name in SNAPSHOT_SOURCES}}, f)
+    old_dir = f"{snapshot_dir}.old"
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.exists(snapshot_dir):
+        os.replace(snapshot_dir, old_dir)
+    os.replace(tmp_dir, snapshot_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def map_snapshot(snapshot_dir=SNAPSHOT_DIR):
+    """
+    Memory-maps the stores of a snapshot.
+    :param snapshot_dir: snapshot folder.
+    :return: tuple of (DocumentStore, TitleStore) objects.
+    """
+    doc_store = DocumentStore.load(os.path.join(snapshot_dir, 'doc_store'))
+    return doc_store, TitleStore.load(os.path.join(snapshot_dir, 'titles'), doc_store)
+
+
+def load_document_store(bucket_loader, generations, timer, snapshot_dir=SNAPSHOT_DIR):
+    """
+    Memory-maps the document store and the title store from a fresh snapshot, or builds them and writes a new
+    snapshot. The titles dictionary is only unpickled to build the snapshot.
+    :param bucket_loader: BucketIndexLoader object.
+    :param generations: Dictionary - local file name: generation.
+    :param timer: PhaseTimer object.
+    :param snapshot_dir: snapshot folder.
+    :return: tuple of (DocumentStore, TitleStore) objects.
+    """
+    if snapshot_is_fresh(generations, snapshot_dir):
+        with timer.phase("mapping snapshot"):
+            return map_snapshot(snapshot_dir)
+    with timer.phase("loading titles"):
+        doc_titles = bucket_loader.load_doc_titles()
+    with timer.phase("building document store"):
+        doc_store = build_document_store(bucket_loader, doc_titles)
+        title_store = TitleStore.build(doc_titles, doc_store)
+    del doc_titles
+    with timer.phase("writing snapshot"):
+        write_snapshot(doc_store, title_store, generations, snapshot_dir)
+    return map_snapshot(snapshot_dir)
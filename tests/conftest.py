@@ -0,0 +1,74 @@
+import os
+import sys
+import tempfile
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# The serving modules create their caches (block_cache/) in the working directory.
+os.chdir(tempfile.mkdtemp(prefix='ir-tests-'))
+
+from doc_store import DocumentStore  # noqa: E402
+from loader import BucketIndexLoader  # noqa: E402
+
+
+class MemoryIndex:
+    """ InvertedIndex stand-in holding random posting lists in memory. """
+
+    def __init__(self, postings):
+        self.postings = postings
+        self.df = {token: len(doc_ids) for token, (doc_ids, _) in postings.items()}
+        self.posting_locs = {token: [] for token in postings}
+        self.term_total = {token: int(tfs.sum()) for token, (_, tfs) in postings.items()}
+
+
+def _memory_postings(token, index, folder_name):
+    if getattr(index, 'segmented', False):
+        return index.posting_arrays(token)
+    if token not in index.postings:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int32)
+    return index.postings[token]
+
+
+def random_corpus(seed, n_terms=8, ties=False):
+    """
+    Builds a random index and document store.
+    :param seed: random seed.
+    :param n_terms: number of terms, named t0, t1...
+    :param ties: give all the documents the same length and tfs of 1 or 2, so many scores are tied.
+    :return: tuple of (MemoryIndex, DocumentStore).
+    """
+    rng = np.random.default_rng(seed)
+    n_docs = int(rng.integers(20, 400))
+    ids = np.sort(rng.choice(10 * n_docs, size=n_docs, replace=False)).astype(np.int64)
+    lengths = np.full(n_docs, 50) if ties else rng.integers(1, 300, size=n_docs)
+    postings = {}
+    for i in range(n_terms):
+        df = int(rng.integers(1, n_docs + 1)) if i % 3 else int(rng.integers(1, 6))  # some rare terms
+        doc_ids = np.sort(rng.choice(ids, size=df, replace=False))
+        tfs = rng.integers(1, 3, size=df) if ties else rng.integers(1, 40, size=df)
+        postings[f't{i}'] = (doc_ids.astype(np.int64), tfs.astype(np.int32))
+    doc_store = DocumentStore(ids, {'DL': lengths.astype(np.uint32), 'doc_norms': rng.uniform(0.01, 2.0, size=n_docs)})
+    return MemoryIndex(postings), doc_store
+
+
+@pytest.fixture
+def corpus(monkeypatch):
+    """
+    Serves the posting lists of the random corpora through BucketIndexLoader, bypassing the posting list cache.
+    :return: the `random_corpus` function.
+    """
+    monkeypatch.setattr(BucketIndexLoader, 'load_posting_arrays_for_token', staticmethod(_memory_postings))
+    monkeypatch.setattr(BucketIndexLoader, 'read_posting_arrays', staticmethod(_memory_postings))
+    return random_corpus
+
+
+def random_query(seed, n_terms=8):
+    """
+    :return: List of 1 to 6 tokens drawn with repetition, sometimes with a token which is not in the index.
+    """
+    rng = np.random.default_rng(seed + 10 ** 6)
+    tokens = [f't{i}' for i in rng.integers(0, n_terms, size=int(rng.integers(1, 7)))]
+    if rng.random() < 0.2:
+        tokens.append('missing')
+    return tokens
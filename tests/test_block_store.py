@@ -0,0 +1,45 @@
+import os
+
+import numpy as np
+
+from block_store import BlockStore
+from local_bucket import LocalClient
+
+BLOCK_BYTES = 64
+
+
+def _bucket(tmp_path, n_blocks=10):
+    data = np.random.default_rng(0).integers(0, 256, size=n_blocks * BLOCK_BYTES, dtype=np.uint8).tobytes()
+    folder = tmp_path / 'bucket' / 'postings_gcp' / 'body'
+    folder.mkdir(parents=True)
+    (folder / 'body_0.bin').write_bytes(data)
+    return LocalClient(str(tmp_path / 'bucket')), data
+
+
+def _store(client, tmp_path, n_blocks):
+    return BlockStore(cache_dir=str(tmp_path / 'cache'), max_bytes=n_blocks * BLOCK_BYTES, block_bytes=BLOCK_BYTES,
+                      client=client)
+
+
+def _cached_bytes(tmp_path):
+    return sum(entry.stat().st_size for entry in os.scandir(tmp_path / 'cache') if not entry.name.startswith('.'))
+
+
+def test_read_spans_blocks(tmp_path):
+    client, data = _bucket(tmp_path)
+    store = _store(client, tmp_path, 4)
+    assert bytes(store.read([('body_0.bin', 10)], 150, 'body')) == data[10:160]
+    assert bytes(store.read([('body_0.bin', 70)], 20, 'body')) == data[70:90]
+    assert store.stats()['hits'] == 1
+
+
+def test_block_evicted_by_another_process_is_downloaded_again(tmp_path):
+    client, data = _bucket(tmp_path)
+    first, second = _store(client, tmp_path, 4), _store(client, tmp_path, 4)
+    assert bytes(first.read([('body_0.bin', 0)], 128, 'body')) == data[:128]
+    # The second store shares the cache directory, and evicts the blocks of the first one.
+    assert bytes(second.read([('body_0.bin', 256)], 384, 'body')) == data[256:]
+    assert _cached_bytes(tmp_path) <= 4 * BLOCK_BYTES
+    assert bytes(first.read([('body_0.bin', 0)], 128, 'body')) == data[:128]
+    assert _cached_bytes(tmp_path) <= 4 * BLOCK_BYTES
+    assert first.stats()['bytes'] == _cached_bytes(tmp_path)
@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+from BM25 import BM25Scorer
+from champion import ChampionTier, build_champion_tier
+from conftest import random_query
+
+
+@pytest.mark.parametrize('order', ['bm25', 'tf'])
+@pytest.mark.parametrize('r', [1, 5, 40])
+def test_answers_match_exhaustive_search(corpus, tmp_path, r, order):
+    answered = 0
+    for seed in range(40):
+        index, doc_store = corpus(seed, ties=seed % 5 == 0)
+        scorer = BM25Scorer(index, doc_store, folder_name='test')
+        build_champion_tier(index, 'test', scorer, 1.2, 0.75, r, order, directory=str(tmp_path))
+        tier = ChampionTier('test', str(tmp_path))
+        for i, (N, depth) in enumerate(((1, 1), (10, 3), (100, 10))):
+            tokens = random_query(seed * 3 + i)
+            res = tier.search(scorer, tokens, N, depth)
+            if res is None:
+                continue
+            answered += 1
+            expected = scorer.search(tokens, 1.2, 0.75, N)[:depth]
+            assert [doc_id for doc_id, _ in res[:depth]] == [doc_id for doc_id, _ in expected]
+            np.testing.assert_allclose([s for _, s in res[:depth]], [s for _, s in expected], rtol=1e-12)
+    assert answered
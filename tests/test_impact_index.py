@@ -0,0 +1,44 @@
+from collections import Counter
+import numpy as np
+import pytest
+from BM25 import BM25Scorer
+from impact_index import ImpactIndex, build_impact_index, quantize
+from conftest import random_query
+
+
+def quantized_ranking(index, doc_store, impact_index, tokenized_query, N):
+    """ Brute-force top N of the quantized scores, ties broken by doc_id. """
+    scorer = BM25Scorer(index, doc_store, folder_name='test')
+    k1, b = impact_index.k1, impact_index.b
+    scores = Counter()
+    for token, weight in Counter(tokenized_query).items():
+        if token not in index.postings:
+            continue
+        doc_ids, tfs = index.postings[token]
+        contributions = scorer.contributions(doc_ids, tfs, scorer.calc_idf([token])[token], k1, b)
+        for doc_id, impact in zip(doc_ids.tolist(), quantize(contributions, impact_index.scale, impact_index.bits)):
+            scores[doc_id] += int(impact) * weight
+    ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:N]
+    return [(doc_id, score * impact_index.scale) for doc_id, score in ranked]
+
+
+@pytest.mark.parametrize('bits', [8, 16])
+@pytest.mark.parametrize('seed', range(25))
+def test_search_matches_quantized_ranking(corpus, tmp_path, seed, bits):
+    index, doc_store = corpus(seed, ties=seed % 5 == 0)
+    build_impact_index(index, 'test', doc_store, 1.2, 0.75, bits, directory=str(tmp_path))
+    impact_index = ImpactIndex('test', doc_store, str(tmp_path))
+    for i, N in enumerate((1, 10, 100)):
+        tokens = random_query(seed * 3 + i)
+        res = impact_index.search(tokens, N)
+        expected = quantized_ranking(index, doc_store, impact_index, tokens, N)
+        assert [doc_id for doc_id, _ in res] == [doc_id for doc_id, _ in expected]
+        np.testing.assert_allclose([s for _, s in res], [s for _, s in expected], rtol=1e-12)
+
+
+def test_rejects_another_document_store(corpus, tmp_path):
+    index, doc_store = corpus(1)
+    build_impact_index(index, 'test', doc_store, 1.2, 0.75, directory=str(tmp_path))
+    _, other_store = corpus(2)
+    with pytest.raises(ValueError):
+        ImpactIndex('test', other_store, str(tmp_path))
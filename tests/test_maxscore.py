@@ -0,0 +1,72 @@
+import pickle
+import pytest
+from BM25 import BM25Scorer, rankings_match, verify_top_k
+from conftest import random_query
+
+PARAMS = [(1.5, 0.75), (5, 0.2), (2, 0.05), (0.5, 1.0)]
+
+
+@pytest.mark.parametrize('seed', range(40))
+@pytest.mark.parametrize('N', [1, 5, 30, 100])
+def test_search_top_k_matches_search(corpus, seed, N):
+    index, doc_store = corpus(seed, ties=seed % 4 == 0)
+    scorer = BM25Scorer(index, doc_store, folder_name='test')
+    tokens = random_query(seed)
+    k1, b = PARAMS[seed % len(PARAMS)]
+    assert scorer.search_top_k(tokens, k1, b, N) == scorer.search(tokens, k1, b, N)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_search_top_k_matches_bm25(corpus, seed):
+    index, doc_store = corpus(seed, ties=seed % 2 == 0)
+    scorer = BM25Scorer(index, doc_store, folder_name='test')
+    for k1, b in PARAMS:
+        assert verify_top_k(scorer, doc_store.view('DL'), random_query(seed), k1, b, N=10)
+
+
+def test_repeated_terms_count_every_occurrence(corpus):
+    index, doc_store = corpus(7)
+    scorer = BM25Scorer(index, doc_store, folder_name='test')
+    once = dict(scorer.search(['t1', 't2'], 1.5, 0.75, 1000))
+    twice = dict(scorer.search_top_k(['t1', 't2', 't1'], 1.5, 0.75, 1000))
+    t1 = dict(scorer.search(['t1'], 1.5, 0.75, 1000))
+    assert twice.keys() == once.keys()
+    for doc_id, score in twice.items():
+        assert score == pytest.approx(once[doc_id] + t1.get(doc_id, 0.0))
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_loaded_max_impacts_match_search(corpus, tmp_path, seed):
+    index, doc_store = corpus(seed)
+    k1, b = PARAMS[seed % len(PARAMS)]
+    path = str(tmp_path / 'test_max_impacts.pkl')
+    table = BM25Scorer(index, doc_store, folder_name='test').build_max_impacts(k1, b, path)
+    # A term added after the table was built is computed from its posting list.
+    with open(path, 'rb') as f:
+        saved = pickle.load(f)
+    del saved['max_impacts']['t1']
+    with open(path, 'wb') as f:
+        pickle.dump(saved, f)
+    scorer = BM25Scorer(index, doc_store, folder_name='test')
+    assert scorer.load_max_impacts(path) == (k1, b)
+    assert scorer.max_impact('t1', k1, b) == table['t1']
+    for i in range(5):
+        tokens = random_query(seed * 5 + i)
+        assert scorer.search_top_k(tokens, k1, b, 10) == scorer.search(tokens, k1, b, 10)
+    assert 't1' not in scorer._max_impacts[(k1, b)]
+
+
+def test_load_max_impacts_rejects_another_collection(corpus, tmp_path):
+    index, doc_store = corpus(1)
+    path = str(tmp_path / 'test_max_impacts.pkl')
+    BM25Scorer(index, doc_store, folder_name='test').build_max_impacts(1.5, 0.75, path)
+    other_index, other_store = corpus(2)
+    with pytest.raises(ValueError):
+        BM25Scorer(other_index, other_store, folder_name='test').load_max_impacts(path)
+
+
+def test_rankings_match_allows_ties_at_the_cutoff():
+    exact = [(1, 3.0), (2, 2.0), (3, 1.0)]
+    assert rankings_match(exact, [(1, 3.0), (2, 2.0), (4, 1.0)])
+    assert not rankings_match(exact, [(1, 3.0), (4, 2.0), (3, 1.0)])
+    assert not rankings_match(exact, [(1, 3.0), (2, 2.0)])
@@ -0,0 +1,53 @@
+import numpy as np
+
+from posting_compression import CompressedPostingReader, CompressedPostingWriter, decode_postings, encode_postings
+
+
+def _write(postings, directory):
+    writer = CompressedPostingWriter('body', str(directory))
+    for token, (doc_ids, tfs) in postings.items():
+        writer.add(token, doc_ids, tfs)
+    writer.close()
+
+
+def _random_postings(seed):
+    rng = np.random.default_rng(seed)
+    postings = {}
+    for i in range(20):
+        n = int(rng.integers(1, 300))
+        doc_ids = np.sort(rng.choice(2 ** 30, size=n, replace=False)).astype(np.int64)
+        postings[f'term{i}'] = doc_ids, rng.integers(1, 2 ** 20, size=n).astype(np.int32)
+    return postings
+
+
+def test_encode_round_trip():
+    for doc_ids, tfs in _random_postings(0).values():
+        decoded_ids, decoded_tfs = decode_postings(encode_postings(doc_ids, tfs).tobytes())
+        assert np.array_equal(decoded_ids, doc_ids)
+        assert np.array_equal(decoded_tfs, tfs)
+
+
+def test_reader_reads_every_list(tmp_path):
+    postings = _random_postings(1)
+    _write(postings, tmp_path)
+    assert CompressedPostingReader.exists('body', str(tmp_path))
+    reader = CompressedPostingReader('body', str(tmp_path))
+    for token, (doc_ids, tfs) in postings.items():
+        decoded_ids, decoded_tfs = reader.read_arrays(token)
+        assert np.array_equal(decoded_ids, doc_ids)
+        assert np.array_equal(decoded_tfs, tfs)
+    assert len(reader.read_arrays('missing')[0]) == 0
+
+
+def test_reader_keeps_its_lists_across_conversions(tmp_path):
+    first, second = _random_postings(2), _random_postings(3)
+    _write(first, tmp_path)
+    reader = CompressedPostingReader('body', str(tmp_path))
+    _write(second, tmp_path)
+    for token, (doc_ids, _) in first.items():
+        assert np.array_equal(reader.read_arrays(token)[0], doc_ids)
+    new_reader = CompressedPostingReader('body', str(tmp_path))
+    for token, (doc_ids, _) in second.items():
+        assert np.array_equal(new_reader.read_arrays(token)[0], doc_ids)
+    _write(first, tmp_path)
+    assert len(list(tmp_path.glob('body_postings.*.vb'))) == 2
@@ -0,0 +1,161 @@
+from collections import Counter
+import numpy as np
+import pytest
+from BM25 import BM25Scorer
+from index_builder import ANCHOR_FOLDER, BODY_FOLDER, TITLE_FOLDER
+from segments import DeltaSegment, SegmentedIndex, overlay_stores
+from title_store import TitleStore
+
+FOLDERS = (BODY_FOLDER, TITLE_FOLDER, ANCHOR_FOLDER)
+
+
+def random_segments(seed, doc_store, n_segments=4, n_terms=8):
+    """
+    Builds random segments over a base store, which edit, add, delete and re-add documents, and link to documents
+    of the base and of the segments.
+    :return: List of DeltaSegment objects, oldest first.
+    """
+    rng = np.random.default_rng(seed + 2 * 10 ** 6)
+    known = doc_store.ids.tolist()
+    next_id = int(doc_store.ids.max()) + 1
+    segments = []
+    for i in range(n_segments):
+        edited = rng.choice(known, size=int(rng.integers(0, 8)), replace=False).tolist()
+        added = list(range(next_id, next_id + int(rng.integers(0, 6))))
+        next_id += len(added)
+        doc_ids = np.array(sorted(set(edited) | set(added)), dtype=np.int64)
+        others = [doc_id for doc_id in known if doc_id not in set(edited)]
+        tombstones = np.unique(rng.choice(others, size=int(rng.integers(0, 6)), replace=False)).astype(np.int64)
+        known += added
+        postings = {}
+        for folder in FOLDERS:
+            targets = np.array(known) if folder == ANCHOR_FOLDER else doc_ids
+            terms = {}
+            for t in range(n_terms):
+                if len(targets) and rng.random() < 0.7:
+                    ids = np.unique(rng.choice(targets, size=int(rng.integers(1, len(targets) + 1)))).astype(np.int64)
+                    terms[f't{t}'] = ids, rng.integers(1, 20, size=len(ids)).astype(np.int32)
+            postings[folder] = terms
+        segments.append(DeltaSegment(f'delta_{i}', doc_ids, rng.integers(1, 300, size=len(doc_ids)),
+                                     rng.uniform(0.01, 2.0, size=len(doc_ids)), [f'title {d}' for d in doc_ids],
+                                     postings, tombstones))
+    return segments
+
+
+def expected_postings(index, segments, folder):
+    """
+    Applies the segments one by one to the base postings: an edited or deleted document loses its body and title
+    postings, and only a deleted document loses its anchor postings, which come from the links of other documents.
+    :return: Dictionary - token: {doc_id: tf}.
+    """
+    terms = {token: dict(zip(doc_ids.tolist(), tfs.tolist())) for token, (doc_ids, tfs) in index.postings.items()}
+    for segment in segments:
+        hidden = set(segment.tombstones.tolist())
+        if folder != ANCHOR_FOLDER:
+            hidden.update(segment.doc_ids.tolist())
+        for postings in terms.values():
+            for doc_id in hidden & postings.keys():
+                del postings[doc_id]
+        for token, (doc_ids, tfs) in segment.postings[folder].items():
+            postings = terms.setdefault(token, {})
+            for doc_id, tf in zip(doc_ids.tolist(), tfs.tolist()):
+                postings[doc_id] = postings.get(doc_id, 0) + tf
+    return {token: postings for token, postings in terms.items() if postings}
+
+
+def expected_documents(doc_store, segments):
+    """
+    :return: Dictionary - doc_id: length of the live documents.
+    """
+    lengths = dict(zip(doc_store.ids.tolist(), doc_store.attributes['DL'].tolist()))
+    for segment in segments:
+        for doc_id in segment.tombstones.tolist():
+            lengths.pop(doc_id, None)
+        lengths.update(zip(segment.doc_ids.tolist(), segment.lengths.tolist()))
+    return lengths
+
+
+def title_store(doc_store):
+    n = len(doc_store.ids)
+    return TitleStore(doc_store, np.empty(0, dtype=np.uint8), np.zeros(n + 1, dtype=np.int64), np.ones(n, dtype=bool))
+
+
+def segmented_postings(index, segments, folder):
+    segmented = SegmentedIndex(index, folder, segments)
+    res = {}
+    for token in segmented.posting_locs:
+        doc_ids, tfs = segmented.posting_arrays(token)
+        assert np.all(np.diff(doc_ids) > 0)
+        if len(doc_ids):
+            res[token] = dict(zip(doc_ids.tolist(), tfs.tolist()))
+            assert segmented.df[token] == len(doc_ids)
+        else:
+            assert token not in segmented.df
+    return res
+
+
+@pytest.mark.parametrize('seed', range(20))
+@pytest.mark.parametrize('folder', FOLDERS)
+def test_postings_match_the_final_documents(corpus, seed, folder):
+    index, doc_store = corpus(seed)
+    segments = random_segments(seed, doc_store)
+    assert segmented_postings(index, segments, folder) == expected_postings(index, segments, folder)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_merged_segments_match_the_unmerged_ones(corpus, seed):
+    index, doc_store = corpus(seed)
+    segments = random_segments(seed, doc_store, n_segments=5)
+    start, end = sorted(np.random.default_rng(seed).choice(6, size=2, replace=False).tolist())
+    if end - start < 2:
+        start, end = 0, 5
+    merged = segments[:start] + [DeltaSegment.merge('merged', segments[start:end])] + segments[end:]
+    for folder in FOLDERS:
+        assert segmented_postings(index, merged, folder) == segmented_postings(index, segments, folder)
+    store, _ = overlay_stores(doc_store, title_store(doc_store), segments)
+    merged_store, _ = overlay_stores(doc_store, title_store(doc_store), merged)
+    lengths = store.view('DL')
+    merged_lengths = merged_store.view('DL')
+    assert sorted(lengths) == sorted(merged_lengths)
+    assert all(lengths[doc_id] == merged_lengths[doc_id] for doc_id in lengths)
+    tokens = [f't{i}' for i in range(4)]
+    body = BM25Scorer(SegmentedIndex(index, BODY_FOLDER, segments), store, BODY_FOLDER)
+    merged_body = BM25Scorer(SegmentedIndex(index, BODY_FOLDER, merged), merged_store, BODY_FOLDER)
+    res, merged_res = body.search(tokens, 1.5, 0.75, 20), merged_body.search(tokens, 1.5, 0.75, 20)
+    assert [doc_id for doc_id, _ in res] == [doc_id for doc_id, _ in merged_res]
+    np.testing.assert_allclose([s for _, s in res], [s for _, s in merged_res], rtol=1e-12)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_overlay_store_hides_deleted_and_edited_documents(corpus, seed):
+    index, doc_store = corpus(seed)
+    segments = random_segments(seed, doc_store)
+    store, titles = overlay_stores(doc_store, title_store(doc_store), segments)
+    lengths = expected_documents(doc_store, segments)
+    latest = {}
+    for segment in segments:
+        latest.update((doc_id, segment) for doc_id in segment.doc_ids.tolist())
+    deleted = sorted((set(doc_store.ids.tolist()) | set(latest)) - set(lengths))
+    doc_ids = np.array(sorted(lengths) + deleted, dtype=np.int64)
+    pos, found = store.dense_ids(doc_ids)
+    assert found.tolist() == [doc_id in lengths for doc_id in doc_ids.tolist()]
+    assert [store.dense_id(doc_id) for doc_id in doc_ids.tolist()] == np.where(found, pos, -1).tolist()
+    assert store.gather('DL', doc_ids).tolist() == [lengths.get(doc_id, 0) for doc_id in doc_ids.tolist()]
+    # The norms of the segment documents come from their latest segment, the others from the base.
+    base_norms = dict(zip(doc_store.ids.tolist(), doc_store.attributes['doc_norms'].tolist()))
+    for doc_id, norm in zip(doc_ids.tolist(), store.gather('doc_norms', doc_ids, default=-1).tolist()):
+        if doc_id not in lengths:
+            assert norm == -1
+        elif doc_id in latest:
+            segment = latest[doc_id]
+            assert norm == segment.norms[np.searchsorted(segment.doc_ids, doc_id)]
+        else:
+            assert norm == base_norms[doc_id]
+    assert [titles.get(doc_id) for doc_id in latest if doc_id in lengths] == \
+        [f'title {doc_id}' for doc_id in latest if doc_id in lengths]
+    # The collection statistics count the live documents only.
+    scorer = BM25Scorer(SegmentedIndex(index, BODY_FOLDER, segments), store, BODY_FOLDER)
+    assert scorer.N == len(lengths)
+    assert scorer.AVGDL == pytest.approx(sum(lengths.values()) / len(lengths))
+    df = Counter({token: len(postings) for token, postings in expected_postings(index, segments, BODY_FOLDER).items()})
+    assert {token: scorer.index.df[token] for token in df} == df
@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+from helperClasses import Calculator
+from tfidf import TfIdfScorer
+from conftest import random_query
+
+
+def dict_scores(index, doc_store, tokenized_query):
+    """ The dict based cosine similarity, with the weights of every query term of a document. """
+    DL, doc_norms = doc_store.view('DL'), doc_store.view('doc_norms')
+    Q = Calculator.get_tfidf_for_query(tokenized_query, index)
+    D = {}
+    for token in Q:
+        idf = np.log10(len(DL) / index.df[token])
+        for doc_id, tf in zip(*(array.tolist() for array in index.postings[token])):
+            D.setdefault(doc_id, {})[token] = tf / DL[doc_id] * idf
+    sims = Calculator.dict_cosine_similarity(D, Q, {doc_id: doc_norms[doc_id] for doc_id in D})
+    return Q, sims
+
+
+@pytest.mark.parametrize('seed', range(30))
+def test_score_matches_dict_cosine(corpus, seed):
+    index, doc_store = corpus(seed)
+    tokens = random_query(seed)
+    Q, expected = dict_scores(index, doc_store, tokens)
+    candidates, scores = TfIdfScorer(index, doc_store, folder_name='test').score(tokens)
+    assert sorted(expected) == candidates.tolist()
+    if Q:
+        np.testing.assert_allclose(scores, [expected[doc_id] for doc_id in candidates.tolist()], rtol=1e-12)
+
+
+def test_every_query_term_counts(corpus):
+    index, doc_store = corpus(3)
+    scorer = TfIdfScorer(index, doc_store, folder_name='test')
+    both = dict(zip(*(array.tolist() for array in scorer.score(['t1', 't2']))))
+    t1 = dict(zip(*(array.tolist() for array in scorer.score(['t1']))))
+    t2 = dict(zip(*(array.tolist() for array in scorer.score(['t2']))))
+    q1, q2 = (np.linalg.norm(list(Calculator.get_tfidf_for_query(q, index).values())) for q in (['t1'], ['t2']))
+    q12 = np.linalg.norm(list(Calculator.get_tfidf_for_query(['t1', 't2'], index).values()))
+    common = set(t1) & set(t2)
+    assert common
+    for doc_id in common:  # the dot products of the two terms add up
+        assert both[doc_id] * q12 == pytest.approx((t1[doc_id] * q1 + t2[doc_id] * q2) / 2, rel=1e-12)
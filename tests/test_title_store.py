@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+from title_store import TitleStore
+from conftest import random_corpus
+
+WORDS = ['Tel Aviv', 'São Paulo', 'Zürich', '東京', 'Ω', '', 'Rock & roll', 'x' * 300, '🎸 guitar']
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_lookups_match_the_dictionary(tmp_path, seed):
+    rng = np.random.default_rng(seed)
+    _, doc_store = random_corpus(seed)
+    titled = rng.choice(doc_store.ids, size=len(doc_store.ids) // 2, replace=False).tolist()
+    doc_titles = {doc_id: f'{WORDS[i % len(WORDS)]} {i}' if i % 7 else '' for i, doc_id in enumerate(titled)}
+    doc_titles[-5] = 'not in the document store'
+    TitleStore.build(doc_titles, doc_store).save(str(tmp_path))
+    titles = TitleStore.load(str(tmp_path), doc_store)
+    del doc_titles[-5]
+    assert dict(titles) == doc_titles
+    assert len(titles) == len(doc_titles)
+    queried = np.concatenate([doc_store.ids, [-5, 10 ** 9]])
+    assert titles.lookup(queried) == [doc_titles.get(doc_id) for doc_id in queried.tolist()]
+    assert titles.has_titles(queried).tolist() == [doc_id in doc_titles for doc_id in queried.tolist()]
+    ranked = titled[::-1][:20]
+    assert titles.materialize(np.array(ranked)) == [(doc_id, doc_titles[doc_id]) for doc_id in ranked]
+    missing = next(doc_id for doc_id in doc_store.ids.tolist() if doc_id not in doc_titles)
+    with pytest.raises(KeyError):
+        titles.materialize([ranked[0], missing])
+
+
+def test_rejects_another_document_store(tmp_path):
+    _, doc_store = random_corpus(1)
+    TitleStore.build({int(doc_store.ids[0]): 'a'}, doc_store).save(str(tmp_path))
+    _, other_store = random_corpus(4)
+    with pytest.raises(ValueError):
+        TitleStore.load(str(tmp_path), other_store)
@@ -0,0 +1,74 @@
+import numpy as np
+from helperClasses import Calculator, sorted_unique, epsilon
+from loader import BucketIndexLoader
+from BM25 import BM25Scorer
+from inverted_index_gcp import InvertedIndex
+from instrumentation import count
+
+
+class TfIdfScorer:
+    """
+    Array based TF-IDF cosine similarity scorer, used by `search_body`.
+    The query-weighted tf-idf of every term is accumulated into one score array over the candidate documents, which is
+    then divided by the document lengths, document norms and query norm in one vectorized step.
+    Document lengths and norms are taken from the 'DL' and 'doc_norms' attributes of a DocumentStore, and combined
+    once into a dense array of 1 / (doc_len * doc_norm).
+    """
+
+    def __init__(self, index: InvertedIndex, doc_store, folder_name="text_inverted_index"):
+        self.index = index
+        self.folder_name = folder_name
+        self.doc_store = doc_store
+        self.N = len(doc_store.view('DL'))
+        n_docs = len(doc_store.ids)
+        doc_lens = np.where(doc_store.masks.get('DL', np.ones(n_docs, dtype=bool)),
+                            doc_store.attributes['DL'], 1 / epsilon).astype(np.float64)
+        norms = np.where(doc_store.masks.get('doc_norms', np.ones(n_docs, dtype=bool)),
+                         doc_store.attributes['doc_norms'], 0).astype(np.float64)
+        # Documents without a norm get a score of 0.
+        self.inv_doc_weights = np.divide(1.0, doc_lens * norms, out=np.zeros(n_docs), where=norms > 0)
+
+    def load_postings(self, query_weights):
+        """
+        Loads the posting arrays of the weighted query tokens.
+        :param query_weights: Dictionary - token: tfidf, of tokens which appear in the index.
+        :return: Dictionary - token: (doc_ids, tfs)
+        """
+        return {token: BucketIndexLoader.load_posting_arrays_for_token(token, self.index, self.folder_name)
+                for token in query_weights}
+
+    def score(self, tokenized_query, postings=None):
+        """
+        Scores all the candidate documents of the query. A document's weight for a term is tf / doc_len * idf, with
+        idf = log10(N / df), and its score is the cosine similarity of its weights with the query tf-idf vector.
+        Documents without a length get a length of 1 / epsilon, and documents without a norm get a score of 0.
+        :param tokenized_query: List of tokens.
+        :param postings: Optional dictionary of already loaded postings - token: (doc_ids, tfs).
+        :return: tuple of (candidate doc_ids, scores) numpy arrays.
+        """
+        Q = Calculator.get_tfidf_for_query(tokenized_query, self.index)
+        if postings is None:
+            postings = self.load_postings(Q)
+        postings = {token: pl for token, pl in postings.items() if token in Q and len(pl[0])}
+        if not postings:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+        candidates = sorted_unique(np.concatenate([doc_ids for doc_ids, _ in postings.values()]))
+        count('candidates', len(candidates))
+        dot = np.zeros(len(candidates), dtype=np.float64)
+        for token, (doc_ids, tfs) in postings.items():
+            idf = np.log10(self.N / self.index.df[token])
+            dot += np.bincount(np.searchsorted(candidates, doc_ids), weights=tfs * (Q[token] * idf),
+                               minlength=len(candidates))
+        pos, found = self.doc_store.dense_ids(candidates)
+        q_norm = np.linalg.norm(list(Q.values())) or 1.0
+        return candidates, dot * np.where(found, self.inv_doc_weights[pos], 0.0) / q_norm
+
+    def search(self, tokenized_query, N=100):
+        """
+        Searches for the documents most similar to the query.
+        :param tokenized_query: List of tokens.
+        :param N: Maximum length of the result.
+        :return: Sorted list of (doc_id, score), with maximum length of N.
+        """
+        candidates, scores = self.score(tokenized_query)
+        return BM25Scorer.top_n(candidates, scores, N)
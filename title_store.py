@@ -0,0 +1,160 @@
+import json
+import os
+import pickle
+import sys
+from collections.abc import Mapping
+import numpy as np
+
+TITLE_STORE_FORMAT = 1
+
+
+class TitleStore(Mapping):
+    """
+    Compact store of the document titles, aligned with the dense ids of a DocumentStore.
+    All the titles are kept in one UTF-8 blob, and the title of dense id i is blob[offsets[i]:offsets[i + 1]].
+    Documents without a title are marked in a mask. The store is saved as .npy files, which are memory-mapped when
+    loaded, so titles are decoded only for the returned results.
+    It is also a read-only dictionary of doc_id: title, like the `doc_titles.pkl` dictionary it replaces.
+    """
+
+    def __init__(self, doc_store, blob, offsets, mask):
+        self.doc_store = doc_store
+        self.blob = blob
+        self.offsets = offsets
+        self.mask = mask
+        self._len = int(np.count_nonzero(mask))
+
+    @staticmethod
+    def build(doc_titles, doc_store):
+        """
+        Building a store from a dictionary of titles.
+        :param doc_titles: Dictionary - doc_id: title. Documents which are not in the document store are dropped.
+        :param doc_store: DocumentStore object.
+        :return: TitleStore object.
+        """
+        n_docs = len(doc_store.ids)
+        keys = np.fromiter(doc_titles.keys(), dtype=np.int64, count=len(doc_titles))
+        pos, found = doc_store.dense_ids(keys)
+        encoded = [title.encode('utf-8') for title in doc_titles.values()]
+        order = np.flatnonzero(found)[np.argsort(pos[found], kind='stable')]
+        lengths = np.zeros(n_docs, dtype=np.int64)
+        lengths[pos[order]] = np.fromiter((len(encoded[i]) for i in order), dtype=np.int64, count=len(order))
+        offsets = np.zeros(n_docs + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        blob = np.frombuffer(b''.join([encoded[i] for i in order]), dtype=np.uint8)
+        mask = np.zeros(n_docs, dtype=bool)
+        mask[pos[order]] = True
+        return TitleStore(doc_store, blob, offsets, mask)
+
+    def save(self, folder):
+        """
+        Saving the store as .npy files in a folder.
+        :param folder: folder path, created if needed.
+        """
+        os.makedirs(folder, exist_ok=True)
+        np.save(os.path.join(folder, 'titles.npy'), self.blob)
+        np.save(os.path.join(folder, 'offsets.npy'), self.offsets)
+        np.save(os.path.join(folder, 'mask.npy'), self.mask)
+        with open(os.path.join(folder, 'meta.json'), 'w') as f:
+            json.dump({'format': TITLE_STORE_FORMAT, 'n_docs': len(self.mask), 'n_bytes': len(self.blob)}, f)
+
+    @staticmethod
+    def load(folder, doc_store, mmap_mode='r'):
+        """
+        Loading a store saved with `save`.
+        :param folder: folder path.
+        :param doc_store: the DocumentStore object the store was built with.
+        :param mmap_mode: numpy memory-map mode, None to read the arrays into memory.
+        :return: TitleStore object.
+        """
+        with open(os.path.join(folder, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['format'] != TITLE_STORE_FORMAT:
+            raise ValueError(f"unsupported title store format {meta['format']} in {folder}")
+        if meta['n_docs'] != len(doc_store.ids):
+            raise ValueError(f"the title store in {folder} was built with a different document store")
+        # An empty array can't be memory-mapped.
+        blob = np.load(os.path.join(folder, 'titles.npy'), mmap_mode=mmap_mode if meta['n_bytes'] else None)
+        return TitleStore(doc_store, blob, np.load(os.path.join(folder, 'offsets.npy'), mmap_mode=mmap_mode),
+                          np.load(os.path.join(folder, 'mask.npy'), mmap_mode=mmap_mode))
+
+    @staticmethod
+    def exists(folder):
+        """
+        Checks if a store was saved in a folder.
+        :param folder: folder path.
+        :return: Boolean.
+        """
+        return os.path.exists(os.path.join(folder, 'meta.json'))
+
+    def _title(self, pos):
+        return self.blob[self.offsets[pos]:self.offsets[pos + 1]].tobytes().decode('utf-8')
+
+    def has_titles(self, doc_ids):
+        """
+        Checking which documents of a batch have a title.
+        :param doc_ids: Iterable or numpy array of wiki ids.
+        :return: boolean numpy array aligned with doc_ids.
+        """
+        pos, found = self.doc_store.dense_ids(doc_ids)
+        return found & self.mask[pos]
+
+    def lookup(self, doc_ids):
+        """
+        Returning the titles of a batch of documents.
+        :param doc_ids: Iterable or numpy array of wiki ids.
+        :return: List of titles aligned with doc_ids, None for documents without a title.
+        """
+        pos, found = self.doc_store.dense_ids(doc_ids)
+        found &= self.mask[pos]
+        return [self._title(p) if f else None for p, f in zip(pos.tolist(), found.tolist())]
+
+    def materialize(self, doc_ids):
+        """
+        Pairing a ranked list of doc_ids with their titles, for the final results.
+        :param doc_ids: List or numpy array of wiki ids, which must have a title.
+        :return: List of (doc_id, title).
+        :raises KeyError: if a document has no title.
+        """
+        doc_ids = doc_ids.tolist() if isinstance(doc_ids, np.ndarray) else list(doc_ids)
+        titles = self.lookup(doc_ids)
+        for doc_id, title in zip(doc_ids, titles):
+            if title is None:
+                raise KeyError(doc_id)
+        return list(zip(doc_ids, titles))
+
+    def __getitem__(self, doc_id):
+        pos = self.doc_store.dense_id(doc_id)
+        if pos < 0 or not self.mask[pos]:
+            raise KeyError(doc_id)
+        return self._title(pos)
+
+    def __contains__(self, doc_id):
+        pos = self.doc_store.dense_id(doc_id)
+        return pos >= 0 and bool(self.mask[pos])
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return iter(self.doc_store.ids[self.mask].tolist())
+
+
+def convert(pkl_path, doc_store, folder):
+    """
+    Converting a pickled titles dictionary (like doc_titles.pkl) to a title store.
+    :param pkl_path: path of the .pkl file.
+    :param doc_store: DocumentStore object the titles are aligned with.
+    :param folder: folder to save the store to.
+    """
+    with open(pkl_path, 'rb') as f:
+        doc_titles = pickle.load(f)
+    TitleStore.build(doc_titles, doc_store).save(folder)
+
+
+if __name__ == '__main__':
+    # python title_store.py [doc_titles.pkl] - converts the titles into the title store of the startup snapshot.
+    from doc_store import DocumentStore
+    from startup import SNAPSHOT_DIR
+    convert(sys.argv[1] if len(sys.argv) > 1 else 'doc_titles.pkl',
+            DocumentStore.load(os.path.join(SNAPSHOT_DIR, 'doc_store')), os.path.join(SNAPSHOT_DIR, 'titles'))